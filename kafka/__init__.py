@@ -1,6 +1,8 @@
-__all__ = ['inference','linear_kf.LinearKalman','input_output', 'observation_operators']
+__all__ = ['inference','linear_kf.LinearKalman',
+           'tiled_kf.TiledKalman','input_output', 'observation_operators']
 # deprecated to keep older scripts who import this from breaking
 from .inference import *
 from .input_output import *
 from linear_kf import LinearKalman
+from tiled_kf import TiledKalman
 from .observation_operators import *
@@ -1,6 +1,12 @@
-__all__ = ['kf_tools', 'solvers', 'utils']
+__all__ = ['block_diagonal', 'emulator_cache', 'kf_tools', 'solver_context',
+           'solvers', 'state_grid', 'strategies', 'utils']
 # deprecated to keep older scripts who import this from breaking
+from .block_diagonal import *
+from .emulator_cache import *
 from .kf_tools import *
 #from .linear_kf import *
+from .solver_context import *
 from .solvers import *
+from .state_grid import *
+from .strategies import *
 from .utils import *
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""A compact block-diagonal matrix type for per-pixel (inverse) covariances"""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+import scipy.sparse as sp
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017 J Gomez-Dans"
+__version__ = "1.0 (09.03.2017)"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+
+def _invert_blocks(blocks):
+    """Inverts a stack of blocks in double precision. Singular blocks give
+    NaNs rather than failing the whole stack."""
+    blocks = blocks.astype(np.float64)
+    try:
+        return np.linalg.inv(blocks)
+    except np.linalg.LinAlgError:
+        inverse = np.full_like(blocks, np.nan)
+        for i, block in enumerate(blocks):
+            try:
+                inverse[i] = np.linalg.inv(block)
+            except np.linalg.LinAlgError:
+                pass
+        return inverse
+
+
+class BlockDiagonalPrecision(object):
+    """A block-diagonal matrix with one dense `n_params x n_params` block per
+    pixel, stored as a contiguous `(n_pixels, n_params, n_params)` array.
+    The state vector is ordered as all the parameters of the first pixel,
+    then all the parameters of the second pixel, and so on, so this is the
+    natural shape of the prior, forecast and analysis inverse covariance
+    matrices in KaFKA.
+
+    The class mimics the bits of the scipy sparse matrix interface that the
+    filter uses (`dot`, `diagonal`, `shape`, `astype`, `tocsc`, arithmetic
+    with scalars and other matrices), so it can be passed around wherever a
+    sparse inverse covariance matrix was used before. Arithmetic with another
+    `BlockDiagonalPrecision` stays in the compact form, while arithmetic
+    with a scipy sparse matrix falls back to a sparse result."""
+
+    # Make sure numpy and scipy defer to our reflected operators
+    __array_priority__ = 20.
+
+    def __init__(self, blocks):
+        blocks = np.asarray(blocks)
+        if blocks.ndim != 3 or blocks.shape[1] != blocks.shape[2]:
+            raise ValueError("Blocks must be an (n_pixels, n_params, " +
+                             "n_params) array, got shape {}".format(
+                                 blocks.shape))
+        self.blocks = np.ascontiguousarray(blocks)
+
+    @classmethod
+    def from_block(cls, block, n_pixels, dtype=np.float32):
+        """Repeats the same `n_params x n_params` block for `n_pixels`"""
+        block = np.asarray(block, dtype=dtype)
+        return cls(np.tile(block, (n_pixels, 1, 1)))
+
+    @classmethod
+    def from_sparse(cls, matrix, n_params, dtype=np.float32, strict=True):
+        """Extracts the per-pixel blocks of a block-diagonal sparse (or dense)
+        matrix. Raises `ValueError` if the matrix couples different
+        pixels, or returns `None` if `strict` is `False`."""
+        if isinstance(matrix, cls):
+            return matrix.astype(dtype)
+        n_pixels = matrix.shape[0] // n_params
+        is_block_diagonal = matrix.shape == (n_pixels*n_params,
+                                             n_pixels*n_params)
+        if is_block_diagonal:
+            # The BSR conversion finds the non-empty blocks (and adds up any
+            # duplicate entries)
+            matrix = sp.csr_matrix(matrix).tobsr(
+                blocksize=(n_params, n_params))
+            block_rows = np.repeat(np.arange(n_pixels),
+                                   np.diff(matrix.indptr))
+            is_block_diagonal = np.all(matrix.indices == block_rows)
+        if not is_block_diagonal:
+            if strict:
+                raise ValueError("The matrix is not block-diagonal per pixel")
+            return None
+        blocks = np.zeros((n_pixels, n_params, n_params), dtype=dtype)
+        blocks[block_rows] = matrix.data
+        return cls(blocks)
+
+    @property
+    def n_pixels(self):
+        return self.blocks.shape[0]
+
+    @property
+    def n_params(self):
+        return self.blocks.shape[1]
+
+    @property
+    def shape(self):
+        n = self.n_pixels*self.n_params
+        return (n, n)
+
+    @property
+    def dtype(self):
+        return self.blocks.dtype
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    def transpose(self):
+        return BlockDiagonalPrecision(self.blocks.transpose(0, 2, 1))
+
+    def astype(self, dtype):
+        return BlockDiagonalPrecision(self.blocks.astype(dtype))
+
+    def copy(self):
+        return BlockDiagonalPrecision(self.blocks.copy())
+
+    def take(self, pixels):
+        """Returns a new matrix with the blocks of the selected pixels only.
+        `pixels` can be an integer index array or a boolean mask."""
+        return BlockDiagonalPrecision(self.blocks[pixels])
+
+    def diagonal(self):
+        """The main diagonal, in state vector order"""
+        return np.einsum("nii->ni", self.blocks).ravel()
+
+    def dot(self, other):
+        """Matrix product with a state vector, a 2D array with the state
+        along the first dimension, another block-diagonal matrix or a scipy
+        sparse matrix."""
+        if isinstance(other, BlockDiagonalPrecision):
+            self._check_shape(other)
+            return BlockDiagonalPrecision(np.einsum("nij,njk->nik",
+                                                    self.blocks,
+                                                    other.blocks))
+        if sp.issparse(other):
+            return self.tobsr().dot(other)
+        other = np.asarray(other)
+        if other.shape[0] != self.shape[1]:
+            raise ValueError("Dimension mismatch: {} and {}".format(
+                self.shape, other.shape))
+        x = other.reshape((self.n_pixels, self.n_params, -1))
+        return np.einsum("nij,njk->nik", self.blocks, x).reshape(other.shape)
+
+    def inverse(self):
+        """Inverts all blocks in one batched call"""
+        return BlockDiagonalPrecision(np.linalg.inv(self.blocks))
+
+    def covariance(self, chunk_size=20000):
+        """The inverse of every block, as `inverse`, but inverted in double
+        precision `chunk_size` pixels at a time to bound the memory used
+        (on top of the result). Singular blocks give NaNs rather than
+        failing the whole matrix."""
+        cov = np.empty(self.blocks.shape, dtype=np.float64)
+        for start in xrange(0, self.n_pixels, chunk_size):
+            cov[start:(start + chunk_size)] = _invert_blocks(
+                self.blocks[start:(start + chunk_size)])
+        return BlockDiagonalPrecision(cov)
+
+    def marginal_std(self, chunk_size=20000):
+        """Exact marginal standard deviations of each parameter, taking
+        into account the correlations between the parameters of a pixel
+        (i.e. the square root of the diagonal of the inverse of each block).
+        Blocks are inverted in double precision, `chunk_size` pixels at a
+        time to bound the memory used. Returns a `(n_pixels, n_params)`
+        array."""
+        std = np.empty((self.n_pixels, self.n_params), dtype=np.float32)
+        for start in xrange(0, self.n_pixels, chunk_size):
+            cov = _invert_blocks(self.blocks[start:(start + chunk_size)])
+            std[start:(start + chunk_size)] = np.sqrt(
+                np.einsum("nii->ni", cov))
+        return std
+
+    def solve(self, b):
+        """Solves `self.dot(x) = b` for `x`, one pixel block at a time but
+        for all pixels in one batched call."""
+        b = np.asarray(b)
+        b_blocks = b.reshape((self.n_pixels, self.n_params, -1))
+        return np.linalg.solve(self.blocks, b_blocks).reshape(b.shape)
+
+    def tobsr(self):
+        n_pixels = self.n_pixels
+        return sp.bsr_matrix((self.blocks, np.arange(n_pixels),
+                              np.arange(n_pixels + 1)), shape=self.shape)
+
+    def tocsr(self):
+        return self.tobsr().tocsr()
+
+    def tocsc(self):
+        return self.tobsr().tocsc()
+
+    def tocoo(self):
+        return self.tobsr().tocoo()
+
+    def toarray(self):
+        return self.tobsr().toarray()
+
+    def todense(self):
+        return self.tobsr().todense()
+
+    def _check_shape(self, other):
+        if other.shape != self.shape:
+            raise ValueError("Dimension mismatch: {} and {}".format(
+                self.shape, other.shape))
+
+    def __add__(self, other):
+        if isinstance(other, BlockDiagonalPrecision):
+            self._check_shape(other)
+            return BlockDiagonalPrecision(self.blocks + other.blocks)
+        if np.isscalar(other) and other == 0:
+            return self.copy()
+        if sp.issparse(other):
+            self._check_shape(other)
+            return self.tobsr() + other
+        if isinstance(other, np.ndarray) and other.ndim == 2:
+            return self.toarray() + other
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return BlockDiagonalPrecision(-self.blocks)
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __rsub__(self, other):
+        return (-self) + other
+
+    def __mul__(self, other):
+        # Same semantics as scipy sparse matrices: scaling by a scalar,
+        # matrix product otherwise
+        if np.isscalar(other):
+            return BlockDiagonalPrecision(self.blocks*other)
+        return self.dot(other)
+
+    def __rmul__(self, other):
+        if np.isscalar(other):
+            return BlockDiagonalPrecision(other*self.blocks)
+        return NotImplemented
+
+    def __repr__(self):
+        return "<{:d}x{:d} BlockDiagonalPrecision with {:d} blocks " \
+            "of size {:d}, dtype {}>".format(self.shape[0], self.shape[1],
+                                             self.n_pixels, self.n_params,
+                                             self.dtype)
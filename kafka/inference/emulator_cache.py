@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""A bounded cache of emulator outputs, shared across Gauss-Newton
+iterations, bands and dates"""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+import numpy as np
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017 J Gomez-Dans"
+__version__ = "1.0 (09.03.2017)"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+LOG = logging.getLogger(__name__)
+
+
+def row_keys(x):
+    """One opaque (void) scalar per row of the 2D array `x`, so that rows
+    can be sorted, compared and searched for as a whole"""
+    x = np.ascontiguousarray(x)
+    return x.view(np.dtype((np.void, x.dtype.itemsize*x.shape[1]))).ravel()
+
+
+class _EmulatorEntries(object):
+    """The cached values of one emulator: the row keys (sorted), emulator
+    values and gradients, and the tick of their last use. Emulators keyed
+    by their `id` are held, so that the `id` can't be reused while they
+    have entries."""
+    def __init__(self, n_dims, emulator=None):
+        self.emulator = emulator
+        self.keys = row_keys(np.zeros((0, n_dims)))
+        self.H = np.zeros(0)
+        self.dH = np.zeros((0, n_dims))
+        self.last_used = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, keys):
+        """Positions of `keys` in the entries, and which of them are there"""
+        position = np.searchsorted(self.keys, keys)
+        found = position < len(self.keys)
+        found[found] = self.keys[position[found]] == keys[found]
+        return position, found
+
+    def insert(self, keys, H, dH, tick):
+        keys = np.concatenate([self.keys, keys])
+        order = np.argsort(keys, kind="mergesort")
+        self.keys = keys[order]
+        self.H = np.concatenate([self.H, H])[order]
+        self.dH = np.concatenate([self.dH, dH])[order]
+        self.last_used = np.concatenate([
+            self.last_used, np.full(len(H), tick, dtype=np.int64)])[order]
+
+    def keep(self, kept):
+        self.keys = self.keys[kept]
+        self.H = self.H[kept]
+        self.dH = self.dH[kept]
+        self.last_used = self.last_used[kept]
+
+
+class EmulatorCache(object):
+    """An LRU cache of emulator values and gradients. Entries are keyed by the
+    emulator key and the input vector. The key of an emulator is the one
+    given to `wrap`, or else its `cache_key` attribute (which
+    `EmulatorRegistry` sets to the file it was loaded from, so entries
+    outlive the emulator being dropped and loaded again), or else the
+    emulator object itself, by `id`. If `step` is given, input
+    vectors are quantised to a grid of that spacing (a scalar or one value
+    per input dimension) before being looked up, and the emulator is run at
+    the quantised location, so vectors that are closer than `step` share an
+    entry. With `step=None`, only exact repeats are served from the cache.
+
+    Lookups are vectorised: the entries of each emulator are kept sorted by
+    input vector, and every `predict` call is a `np.unique` of its rows and
+    a `np.searchsorted`. Recency is tracked per call, and when the cache
+    grows over `max_entries` vectors, the entries used longest ago are
+    evicted. Emulators keyed by `id` are only referenced while they have
+    entries. Hits and misses (in rows) are counted in `hits` and `misses`.
+    Use `wrap` to put the cache in front of an emulator object, e.g.::
+
+        cache = EmulatorCache(step=1e-4)
+        H0, dH = run_emulator(cache.wrap(gp), x)
+    """
+    def __init__(self, max_entries=500000, step=None):
+        self.max_entries = int(max_entries)
+        self.step = step
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._tick = 0
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._entries.values())
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Returns a dictionary with the cache counters"""
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(self),
+                "hit_rate": self.hits/float(total) if total > 0 else 0.}
+
+    def wrap(self, emulator, key=None):
+        """Returns a version of `emulator` whose `predict` method goes through
+        the cache, with its entries under `key` (see the class docstring for
+        the default). Objects without a `predict` method (e.g. plain forward
+        model functions) are returned unchanged."""
+        if emulator is None or not hasattr(emulator, "predict"):
+            return emulator
+        if isinstance(emulator, CachedEmulator):
+            return emulator
+        return CachedEmulator(emulator, self, key=key)
+
+    def quantise(self, x):
+        if self.step is None:
+            return np.ascontiguousarray(x, dtype=np.float64)
+        step = np.asarray(self.step, dtype=np.float64)
+        return np.ascontiguousarray(np.round(x/step)*step)
+
+    def predict(self, emulator, x, key=None):
+        """Returns the emulator value and gradient for the rows of `x`,
+        running the emulator only for the rows that are not in the cache
+        under the emulator `key`."""
+        x = np.atleast_2d(x)
+        n, n_dims = x.shape
+        self._tick += 1
+        if key is None:
+            key = getattr(emulator, "cache_key", None)
+        held = None
+        if key is None:
+            key, held = ("id", id(emulator)), emulator
+        entries = self._entries.get(key)
+        if entries is None or entries.dH.shape[1] != n_dims:
+            entries = _EmulatorEntries(n_dims, emulator=held)
+            self._entries[key] = entries
+        xq = self.quantise(x)
+        keys, first, inverse = np.unique(row_keys(xq), return_index=True,
+                                         return_inverse=True)
+        position, found = entries.find(keys)
+        entries.last_used[position[found]] = self._tick
+        n_found = np.bincount(inverse.ravel(), minlength=len(keys))[found]
+        self.hits += n_found.sum()
+        self.misses += n - n_found.sum()
+
+        H = np.zeros(len(keys))
+        dH = np.zeros((len(keys), n_dims))
+        H[found] = entries.H[position[found]]
+        dH[found] = entries.dH[position[found]]
+        missing = np.flatnonzero(~found)
+        if len(missing) > 0:
+            x_missing = xq[first[missing]]
+            try:
+                H_, dH_ = emulator.predict(x_missing, do_unc=False)
+            except ValueError:
+                # Needed for newer gp version
+                H_, _, dH_ = emulator.predict(x_missing, do_unc=False)
+            H[missing] = H_
+            dH[missing] = dH_
+            entries.insert(keys[missing], H[missing], dH[missing],
+                           self._tick)
+            self._evict()
+        inverse = inverse.ravel()
+        return H[inverse], dH[inverse]
+
+    def _evict(self):
+        """Drops the entries used longest ago, so that at most `max_entries`
+        are kept, and forgets emulators without entries"""
+        n_extra = len(self) - self.max_entries
+        if n_extra > 0:
+            ids = list(self._entries.keys())
+            last_used = np.concatenate([self._entries[i].last_used
+                                        for i in ids])
+            # The entries of a call share a tick: only as many entries of
+            # the call at the cutoff as needed are evicted
+            cutoff = np.sort(last_used)[n_extra - 1]
+            n_at_cutoff = n_extra - np.sum(last_used < cutoff)
+            for i in ids:
+                entries = self._entries[i]
+                kept = entries.last_used > cutoff
+                at_cutoff = np.flatnonzero(entries.last_used == cutoff)
+                n_drop = min(n_at_cutoff, len(at_cutoff))
+                kept[at_cutoff[n_drop:]] = True
+                n_at_cutoff -= n_drop
+                entries.keep(kept)
+        for i in [i for i, entries in self._entries.items()
+                  if len(entries) == 0]:
+            del self._entries[i]
+
+
+class CachedEmulator(object):
+    """An emulator wrapper that serves `predict` calls from an
+    `EmulatorCache`. Any other attribute is taken from the wrapped
+    emulator."""
+    def __init__(self, emulator, cache, key=None):
+        self.emulator = emulator
+        self.cache = cache
+        self.key = key
+
+    def predict(self, x, do_unc=False, **kwargs):
+        if do_unc:
+            # We don't cache uncertainties
+            return self.emulator.predict(x, do_unc=do_unc, **kwargs)
+        return self.cache.predict(self.emulator, x, key=self.key)
+
+    def __getattr__(self, name):
+        if name in ["emulator", "cache", "key"]:
+            # Not set yet (e.g. while unpickling)
+            raise AttributeError(name)
+        return getattr(self.emulator, name)
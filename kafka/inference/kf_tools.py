@@ -8,7 +8,9 @@ import numpy as np
 import scipy.sparse as sp
 import scipy.sparse.linalg as spl
 
-from utils import block_diag
+from block_diagonal import BlockDiagonalPrecision
+from state_grid import as_state_grid
+from utils import inverse_variance_vector
 
 class NoHessianMethod(Exception):
     """An exception triggered when the forward model isn't able to provide an
@@ -42,25 +44,23 @@ def hessian_correction(gp, x0, R_mat, innovation, mask, state_mask, band,
         # The observation operator does not provide a Hessian method. We just
         # return 0, meaning no Hessian correction.
         return 0.
-    C_obs_inv = R_mat.diagonal()[state_mask.flatten()]
-    mask = mask[state_mask].flatten()
-    little_hess = []
+    state_grid = as_state_grid(state_mask)
+    C_obs_inv = inverse_variance_vector(R_mat, state_grid)
+    mask = state_grid.gather(mask)
+    little_hess = np.zeros((len(mask), nparams, nparams), dtype=np.float32)
     for i, (innov, C, m) in enumerate(zip(innovation, C_obs_inv, mask)):
-        if not m:
-            # Pixel is masked
-            hessian_corr = np.zeros((nparams, nparams))
-        else:
+        if m:
             # Get state for current pixel
             x0_pixel = x0.squeeze()[(nparams*i):(nparams*(i + 1))]
             # Calculate the Hessian correction for this pixel
-            hessian_corr = m * hessian_correction_pixel(gp, x0_pixel, C,
-                                                        innov, band, nparams)
-        little_hess.append(hessian_corr)
-    hessian_corr = block_diag(little_hess)
+            little_hess[i] = hessian_correction_pixel(gp, x0_pixel, C,
+                                                      innov, band, nparams)
+    hessian_corr = BlockDiagonalPrecision(little_hess)
     return hessian_corr
 
 
-def blend_prior(prior_mean, prior_cov_inverse, x_forecast, P_forecast_inverse):
+def blend_prior(prior_mean, prior_cov_inverse, x_forecast, P_forecast_inverse,
+                context=None):
     """
     combine prior mean and inverse covariance with the mean and inverse covariance
     from the previous timestep as the product of gaussian distributions
@@ -71,6 +71,7 @@ def blend_prior(prior_mean, prior_cov_inverse, x_forecast, P_forecast_inverse):
     :param x_forecast:
 
     :param P_forecast_inverse:
+    :param context: an optional `SolverContext` for the sparse solve
     :return: the combined mean and inverse covariance matrix
     """
     # calculate combined covariance
@@ -78,8 +79,13 @@ def blend_prior(prior_mean, prior_cov_inverse, x_forecast, P_forecast_inverse):
     b = P_forecast_inverse.dot(prior_mean) + prior_cov_inverse.dot(x_forecast)
     b = b.astype(np.float32)
     # Solve for combined mean
-    AI = sp.linalg.splu(combined_cov_inv.tocsc())
-    x_combined = AI.solve(b)
+    if isinstance(combined_cov_inv, BlockDiagonalPrecision):
+        x_combined = combined_cov_inv.solve(b)
+    elif context is not None:
+        x_combined = context.solve(combined_cov_inv, b)
+    else:
+        AI = sp.linalg.splu(combined_cov_inv.tocsc())
+        x_combined = AI.solve(b)
 
     return x_combined, combined_cov_inv
 
@@ -114,16 +120,17 @@ def tip_prior_full(prior):
     # the real code when we know what the priors look like.
     x_prior, c_prior, c_inv_prior = tip_prior()
     n_pixels = prior['n_pixels']
-    mean = np.array([x_prior for i in xrange(n_pixels)]).flatten()
-    c_inv_prior_mat = [c_inv_prior for n in xrange(n_pixels)]
-    prior_cov_inverse=block_diag(c_inv_prior_mat, dtype=np.float32)
+    mean = np.tile(x_prior, n_pixels)
+    prior_cov_inverse = BlockDiagonalPrecision.from_block(c_inv_prior,
+                                                          n_pixels)
 
     return mean, prior_cov_inverse
 
 
 def propagate_and_blend_prior(x_analysis, P_analysis, P_analysis_inverse,
                               M_matrix, Q_matrix, 
-                              prior=None, state_propagator=None, date=None):
+                              prior=None, state_propagator=None, date=None,
+                              solver_context=None):
     """
 
     :param x_analysis:
@@ -136,6 +143,7 @@ def propagate_and_blend_prior(x_analysis, P_analysis, P_analysis_inverse,
     see tip_prior for example). Other dictionary items are optional arguments for
     the prior.
     :param state_propagator:
+    :param solver_context: an optional `SolverContext` to blend the prior
     :return:
     """
     if state_propagator is not None:
@@ -148,7 +156,8 @@ def propagate_and_blend_prior(x_analysis, P_analysis, P_analysis_inverse,
         prior_mean, prior_cov_inverse = prior.process_prior(date, inv_cov=True)
     if prior is not None and state_propagator is not None:
         x_combined, combined_cov_inv = blend_prior(prior_mean, prior_cov_inverse,
-                                                   x_forecast, P_forecast_inverse)
+                                                   x_forecast, P_forecast_inverse,
+                                                   context=solver_context)
         return x_combined, None, combined_cov_inv
     elif prior is not None:
         return prior_mean, None, prior_cov_inverse
@@ -227,6 +236,8 @@ def propagate_information_filter_SLOW(x_analysis, P_analysis, P_analysis_inverse
     n, n = P_analysis_inverse.shape
     S= P_analysis_inverse.dot(Q_matrix)
     A = (sp.eye(n) + S).tocsc()
+    if isinstance(P_analysis_inverse, BlockDiagonalPrecision):
+        P_analysis_inverse = P_analysis_inverse.tocsc()
     P_forecast_inverse = spl.spsolve(A, P_analysis_inverse)
     logging.info("DOne with propagation")
 
@@ -286,16 +297,13 @@ def propagate_information_filter_LAI(x_analysis, P_analysis,
     x_forecast = M_matrix.dot(x_analysis)
     x_prior, c_prior, c_inv_prior = tip_prior()
     n_pixels = len(x_analysis)/7
-    x0 = np.array([x_prior for i in xrange(n_pixels)]).flatten()
+    x0 = np.tile(x_prior, n_pixels)
     x0[6::7] = x_forecast[6::7] # Update LAI
     print "LAI:", -2*np.log(x_forecast[6::7])
-    lai_post_cov = P_analysis_inverse.diagonal()
-    c_inv_prior_mat = []
-    for n in xrange(n_pixels):
-        c_inv_prior[6,6] =  lai_post_cov[n]
-        c_inv_prior_mat.append(c_inv_prior)
-
-    P_forecast_inverse=block_diag(c_inv_prior_mat, dtype=np.float32)
+    lai_post_cov = P_analysis_inverse.diagonal()[6::7]
+    P_forecast_inverse = BlockDiagonalPrecision.from_block(c_inv_prior,
+                                                           n_pixels)
+    P_forecast_inverse.blocks[:, 6, 6] = lai_post_cov
 
     return x0, None, P_forecast_inverse
 
@@ -332,8 +340,8 @@ def no_propagation(x_analysis, P_analysis,
 
     x_prior, c_prior, c_inv_prior = tip_prior()
     n_pixels = len(x_analysis)/7
-    x_forecast = np.array([x_prior for i in xrange(n_pixels)]).flatten()
-    c_inv_prior_mat = [c_inv_prior for n in xrange(n_pixels)]
-    P_forecast_inverse=block_diag(c_inv_prior_mat, dtype=np.float32)
+    x_forecast = np.tile(x_prior, n_pixels)
+    P_forecast_inverse = BlockDiagonalPrecision.from_block(c_inv_prior,
+                                                           n_pixels)
 
     return x_forecast, None, P_forecast_inverse
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""A context for the sparse solves of a run, which keeps what only depends
+on the sparsity pattern of the Hessian between iterations and dates."""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg
+
+try:
+    from sksparse.cholmod import analyze as cholmod_analyze
+    from sksparse.cholmod import CholmodError
+except ImportError:
+    cholmod_analyze = None
+
+LOG = logging.getLogger(__name__)
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017 J Gomez-Dans"
+__version__ = "1.0 (09.03.2017)"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+
+class SolverContext(object):
+    """Caches the parts of the sparse solves that only depend on the
+    sparsity pattern of the Hessian: the index arrays of per-pixel
+    block-diagonal Hessians (see `block_matrix`), and the CHOLMOD symbolic
+    factorisation of the last general Hessian, if `scikit-sparse` is
+    installed and `use_cholmod` is set. Solving with a Hessian of the same
+    pattern as the previous one then only does the numeric factorisation.
+    SuperLU can't start from a previous analysis, so without CHOLMOD every
+    general Hessian is factorised from scratch. Block-diagonal Hessians
+    don't need an ordering at all, as they have no fill-in in their natural
+    order.
+
+    The number of symbolic analyses and of numeric factorisations are kept
+    in `n_analyses` and `n_factorisations`."""
+    def __init__(self, use_cholmod=True):
+        self.use_cholmod = use_cholmod and cholmod_analyze is not None
+        self.n_analyses = 0
+        self.n_factorisations = 0
+        self._pattern = None
+        self._factor = None
+        self._block_indices = {}
+
+    def block_matrix(self, blocks):
+        """Returns the CSC matrix with the `(n_pixels, n_params, n_params)`
+        stack of dense `blocks` on its diagonal. The index arrays only depend
+        on the shape, and are reused."""
+        n_pixels, n_params = blocks.shape[:2]
+        key = (n_pixels, n_params)
+        if key not in self._block_indices:
+            # Column j of pixel k has rows k*n_params ... (k+1)*n_params - 1
+            n = n_pixels*n_params
+            indptr = np.arange(0, n*n_params + 1, n_params, dtype=np.int32)
+            indices = (np.repeat(np.arange(n_pixels, dtype=np.int32)*n_params,
+                                 n_params*n_params) +
+                       np.tile(np.arange(n_params, dtype=np.int32), n))
+            # Only keep the latest shapes, the active set changes
+            if len(self._block_indices) > 4:
+                self._block_indices.clear()
+            self._block_indices[key] = (indptr, indices)
+        indptr, indices = self._block_indices[key]
+        # CSC stores each block column by column
+        data = np.ascontiguousarray(blocks.transpose(0, 2, 1)).ravel()
+        return sp.csc_matrix((data, indices, indptr),
+                             shape=(n_pixels*n_params, n_pixels*n_params))
+
+    def _same_pattern(self, A):
+        if self._pattern is None:
+            return False
+        shape, indptr, indices = self._pattern
+        return (A.shape == shape and np.array_equal(A.indptr, indptr) and
+                np.array_equal(A.indices, indices))
+
+    def _set_pattern(self, A):
+        self._pattern = (A.shape, A.indptr.copy(), A.indices.copy())
+
+    def solve(self, A, b, block_diagonal=False):
+        """Solves `A x = b` for a symmetric positive definite sparse `A`. Set
+        `block_diagonal` if `A` is block-diagonal in its natural order (e.g.
+        it comes from `block_matrix`)."""
+        A = sp.csc_matrix(A)
+        A.sum_duplicates()
+        self.n_factorisations += 1
+        if self.use_cholmod:
+            try:
+                return self._cholmod_solve(A, b)
+            except CholmodError as error:
+                LOG.warning("CHOLMOD failed ({}), using SuperLU".format(
+                    error))
+                self.use_cholmod = False
+                self._pattern = self._factor = None
+        if block_diagonal:
+            return sp.linalg.splu(A, permc_spec="NATURAL").solve(b)
+        self.n_analyses += 1
+        return sp.linalg.splu(A).solve(b)
+
+    def _cholmod_solve(self, A, b):
+        A = A.astype(np.float64)
+        if self._factor is None or not self._same_pattern(A):
+            self._factor = cholmod_analyze(A)
+            self._set_pattern(A)
+            self.n_analyses += 1
+        self._factor.cholesky_inplace(A)
+        return self._factor(np.asarray(b, dtype=np.float64)).astype(
+            np.result_type(b, np.float32))
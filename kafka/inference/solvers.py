@@ -24,6 +24,10 @@ import numpy as np
 import scipy.sparse as sp
 import matplotlib.pyplot as plt
 
+from block_diagonal import BlockDiagonalPrecision
+from state_grid import as_state_grid
+from utils import inverse_variance_vector
+
 #from utils import  matrix_squeeze, spsolve2, reconstruct_array
 
 # Set up logging
@@ -39,18 +43,26 @@ __email__ = "j.gomez-dans@ucl.ac.uk"
 
 
 def variational_kalman( observations, mask, state_mask, uncertainty, H_matrix, n_params,
-            x_forecast, P_forecast, P_forecast_inv, the_metadata, approx_diagonal=True):
+            x_forecast, P_forecast, P_forecast_inv, the_metadata, approx_diagonal=True,
+            solver_mode="splu", compact=False):
     """We can just use """
+    if solver_mode == "block":
+        return variational_kalman_multiband(
+            [observations], [mask], state_mask, [uncertainty], [H_matrix],
+            n_params, x_forecast, x_forecast, P_forecast, P_forecast_inv,
+            [the_metadata], approx_diagonal=approx_diagonal,
+            solver_mode=solver_mode, compact=compact)
     if len(H_matrix) == 2:
         non_linear = True
         H0, H_matrix_ = H_matrix
     else:
         H0 = 0.
         non_linear = False
-    R_mat = sp.diags(uncertainty.diagonal()[state_mask.flatten()])
+    state_mask = as_state_grid(state_mask)
+    R_mat = sp.diags(inverse_variance_vector(uncertainty, state_mask))
     LOG.info("Creating linear problem")
-    y = observations[state_mask]
-    y = np.where(mask[state_mask], y, 0.)
+    y = state_mask.gather(observations)
+    y = np.where(state_mask.gather(mask), y, 0.)
     y_orig = y*1.
     if non_linear:
         y = y + H_matrix_.dot(x_forecast) - H0
@@ -64,9 +76,8 @@ def variational_kalman( observations, mask, state_mask, uncertainty, H_matrix, n
     # Here we can either do a spLU of A, and solve, or we can have a first go
     # by assuming P_forecast_inv is diagonal, and use the inverse of A_approx as
     # a preconditioner
-    LOG.info("Solving")
-    AI = sp.linalg.splu (A)
-    x_analysis = AI.solve (b)
+    x_analysis = _splu_solve(A, b, x_forecast, [mask], state_mask, n_params,
+                             compact)
     # So retval is the solution vector and A is the Hessian 
     # (->inv(A) is posterior cov)
     fwd_modelled = H_matrix_.dot(x_analysis-x_forecast) + H0
@@ -87,9 +98,10 @@ def sort_band_data(H_matrix, observations, uncertainty, mask,
         H0 = 0.
         H_matrix_ = H_matrix
         non_linear = False
-    R = uncertainty.diagonal()[state_mask.flatten()]
-    y = observations[state_mask]
-    y = np.where(mask[state_mask], y, 0.)
+    state_mask = as_state_grid(state_mask)
+    R = inverse_variance_vector(uncertainty, state_mask)
+    y = state_mask.gather(observations)
+    y = np.where(state_mask.gather(mask), y, 0.)
     y_orig = y*1.
     if non_linear:
         y = y + H_matrix_.dot(x0) - H0
@@ -97,10 +109,251 @@ def sort_band_data(H_matrix, observations, uncertainty, mask,
         
 
 
+def pixel_jacobian_blocks(H_matrix, n_params, strict=True):
+    """Collapses a per-pixel observation operator into a dense array. The
+    operators we use have one row per pixel, and each row only touches the
+    parameters of that pixel, so the whole of `H_matrix` fits in an
+    `(n_pixels, n_params)` array.
+
+    Parameters
+    -----------
+    H_matrix: sparse matrix
+        The `(n_pixels, n_pixels*n_params)` linearised observation operator.
+    n_params: int
+        Number of parameters per pixel
+    strict: bool
+        Whether to raise `ValueError` if `H_matrix` isn't block-diagonal per
+        pixel. If `False`, `None` is returned instead.
+
+    Returns
+    --------
+    The `(n_pixels, n_params)` Jacobian array.
+    """
+    H_matrix = sp.coo_matrix(H_matrix)
+    H_matrix.sum_duplicates()
+    n_pixels = H_matrix.shape[0]
+    if H_matrix.shape[1] != n_pixels*n_params or np.any(
+            H_matrix.col // n_params != H_matrix.row):
+        if strict:
+            raise ValueError("The observation operator is not " +
+                             "block-diagonal per pixel")
+        return None
+    jac = np.zeros((n_pixels, n_params), dtype=np.float32)
+    jac[H_matrix.row, H_matrix.col % n_params] = H_matrix.data
+    return jac
+
+
+def pixel_cost(observations_b, mask_b, state_mask, uncertainty_b,
+               H_matrix_b, n_params, x, x_forecast, P_forecast_inv):
+    """Evaluates the cost function of each pixel,
+    `J(x) = 0.5*((y - h(x))^T R^-1 (y - h(x)) + (x - x_f)^T P_f^-1 (x - x_f))`.
+    The observation operators in `H_matrix_b` must have been linearised
+    around `x`, so that `h(x)` is just their `H0` term (linear operators are
+    applied to `x`). Masked observations don't contribute to the cost.
+
+    Parameters
+    -----------
+    observations_b, mask_b, uncertainty_b, H_matrix_b: lists
+        The per-band observations, masks, uncertainties and observation
+        operators, as given to `variational_kalman_multiband`
+    state_mask: array or StateGrid
+        The state mask
+    n_params: int
+        Number of parameters per pixel
+    x, x_forecast: arrays
+        The point where the cost is evaluated and the forecast mean
+    P_forecast_inv: sparse matrix
+        The forecast precision, block-diagonal per pixel
+
+    Returns
+    --------
+    An array with the cost of each state pixel.
+    """
+    state_mask = as_state_grid(state_mask)
+    n_pixels = state_mask.n_pixels
+    cost = np.zeros(n_pixels)
+    for observations, mask, uncertainty, H_matrix in zip(
+            observations_b, mask_b, uncertainty_b, H_matrix_b):
+        H_matrix_, H0, R, y, y_orig = sort_band_data(
+            H_matrix, observations, uncertainty, mask, x, x_forecast,
+            state_mask)
+        if len(H_matrix) != 2:
+            H0 = H_matrix_.dot(x)
+        valid = state_mask.gather(mask)
+        r = np.where(valid, R, 0.)
+        residual = np.where(valid, y_orig - H0, 0.)
+        cost += r*residual**2
+    dx = (x - x_forecast).reshape((n_pixels, n_params))
+    P_blocks = BlockDiagonalPrecision.from_sparse(P_forecast_inv,
+                                                  n_params).blocks
+    cost += np.einsum("ni,nij,nj->n", dx, P_blocks, dx)
+    return 0.5*cost
+
+
+def _damp_blocks(A_blocks, b_blocks, damping, x_anchor):
+    """Adds the Levenberg-Marquardt term `damping*diag(A)*(x - x_anchor)**2`
+    to a stack of per-pixel systems"""
+    n_params = A_blocks.shape[-1]
+    diagonal = damping[:, None]*A_blocks[:, np.arange(n_params),
+                                         np.arange(n_params)]
+    A_blocks = A_blocks.copy()
+    A_blocks[:, np.arange(n_params), np.arange(n_params)] += diagonal
+    return A_blocks, b_blocks + diagonal*x_anchor
+
+
+def _pixel_blocks(H_matrix, P_forecast_inv, n_params, strict=True):
+    """The per-band Jacobian arrays (see `pixel_jacobian_blocks`) of the
+    observation operators in `H_matrix`, and the blocks of the forecast
+    precision. If any of them isn't block-diagonal per pixel, raises
+    `ValueError`, or returns `None` if `strict` is `False`."""
+    P_blocks = BlockDiagonalPrecision.from_sparse(P_forecast_inv, n_params,
+                                                  strict=strict)
+    if P_blocks is None:
+        return None
+    jac = [pixel_jacobian_blocks(H, n_params, strict=strict)
+           for H in H_matrix]
+    if any(jac_b is None for jac_b in jac):
+        return None
+    return np.array(jac), P_blocks.blocks
+
+
+def _solve_multiband_blocks(jac, H0, R_mat, y, y_orig, obs_mask,
+                            n_params, x_forecast, P_blocks,
+                            compact=False, damping=None, x_anchor=None,
+                            context=None):
+    """Solves the linearised problem one pixel at a time, but for all pixels
+    in one go. `jac` and `P_blocks` are the per-band Jacobian arrays and the
+    forecast precision blocks (see `_pixel_blocks`), the other per-band
+    lists are the outputs of `sort_band_data`, and `obs_mask` is a list of
+    per-band boolean arrays over the state pixels.
+    With `compact`, only the pixels observed in some band are solved, and
+    the rest keep their forecast mean and precision. `damping` and
+    `x_anchor` are as in `variational_kalman_multiband`. With a
+    `SolverContext`, the blocks are put in a sparse matrix and solved by
+    the context, and the Hessian is returned as a sparse matrix too."""
+    n_pixels = P_blocks.shape[0]
+    obs_mask = np.array(obs_mask)
+    # Masked pixels have an infinite (or undefined) inverse variance and an
+    # empty Jacobian row, so they are given no weight at all
+    r = np.where(obs_mask, np.array(R_mat), 0.).astype(np.float32)
+    y = np.array(y, dtype=np.float32)
+    x_f = x_forecast.reshape((n_pixels, n_params))
+    if compact:
+        active = np.flatnonzero(obs_mask.any(axis=0))
+    else:
+        active = np.arange(n_pixels)
+    # A = H^T R H + P_forecast_inv and b = H^T R y + P_forecast_inv x_forecast,
+    # one (n_params, n_params) system per active pixel
+    P_act = P_blocks[active]
+    jac_act = jac[:, active]
+    r_act = r[:, active]
+    A_act = P_act + np.einsum("bn,bni,bnj->nij", r_act, jac_act, jac_act)
+    b_act = np.einsum("bn,bni->ni", r_act*y[:, active], jac_act) + \
+        np.einsum("nij,nj->ni", P_act, x_f[active])
+    LOG.info("Solving %d pixel blocks (%d without observations)" % (
+        len(active), n_pixels - len(active)))
+    A_blocks = P_blocks.astype(np.float32)
+    A_blocks[active] = A_act
+    if damping is not None:
+        A_act, b_act = _damp_blocks(
+            A_act, b_act, damping[active],
+            x_anchor.reshape((n_pixels, n_params))[active])
+    x_analysis = x_f.copy()
+    if len(active) > 0 and context is not None:
+        x_analysis[active] = context.solve(
+            context.block_matrix(A_act.astype(np.float32)),
+            b_act.astype(np.float32).ravel(),
+            block_diagonal=True).reshape((-1, n_params))
+    elif len(active) > 0:
+        x_analysis[active] = np.linalg.solve(
+            A_act.astype(np.float32),
+            b_act.astype(np.float32)[..., None])[..., 0]
+    dx = x_analysis - x_f
+    fwd_modelled = np.hstack([(jac_b*dx).sum(axis=1) + H0_b
+                              for jac_b, H0_b in zip(jac, H0)])
+    innovations = np.hstack(y_orig) - fwd_modelled
+    if context is not None:
+        A = context.block_matrix(A_blocks)
+    else:
+        A = BlockDiagonalPrecision(A_blocks)
+    return x_analysis.ravel(), None, A, innovations, fwd_modelled
+
+
+def _splu_solve(A, b, x_forecast, mask_b, state_mask, n_params,
+                compact=False, context=None):
+    """Solves `A x = b` with a sparse LU decomposition (or with the
+    `SolverContext` `context`, if given). With `compact`, only
+    the state elements of the observed pixels are solved for (if the
+    Hessian allows it, see `_active_state_elements`), and the rest are taken
+    from `x_forecast`."""
+    active = None
+    if compact:
+        active = _active_state_elements(mask_b, state_mask, n_params, A)
+    if active is None:
+        LOG.info("Solving")
+        if context is not None:
+            return context.solve(A, b)
+        AI = sp.linalg.splu(A)
+        return AI.solve(b)
+    LOG.info("Solving for %d of %d state elements" % (len(active),
+                                                      A.shape[0]))
+    x_analysis = x_forecast.astype(np.float32)
+    if len(active) > 0:
+        A_act = A.tocsr()[active][:, active]
+        if context is not None:
+            x_analysis[active] = context.solve(A_act, b[active])
+        else:
+            AI = sp.linalg.splu(A_act.tocsc())
+            x_analysis[active] = AI.solve(b[active])
+    return x_analysis
+
+
+def _active_state_elements(mask_b, state_mask, n_params, A):
+    """Returns the state vector elements of the pixels that are observed in
+    some band, or `None` if the Hessian `A` couples them to the rest of the
+    pixels (in which case all the state has to be solved together)."""
+    state_mask = as_state_grid(state_mask)
+    observed = np.zeros(state_mask.n_pixels, dtype=bool)
+    for mask in mask_b:
+        observed |= state_mask.gather(mask)
+    elements = np.repeat(observed, n_params)
+    if elements.all():
+        return None
+    A = sp.csr_matrix(A)
+    if A[elements][:, ~elements].nnz > 0:
+        return None
+    return np.flatnonzero(elements)
+
+
 def variational_kalman_multiband( observations_b, mask_b, state_mask, uncertainty_b, H_matrix_b, n_params,
-            x0, x_forecast, P_forecast, P_forecast_inv, the_metadata_b, approx_diagonal=True):
-    """We can just use """
+            x0, x_forecast, P_forecast, P_forecast_inv, the_metadata_b, approx_diagonal=True,
+            solver_mode="splu", compact=False, damping=None, x_anchor=None,
+            context=None):
+    """We can just use a sparse LU decomposition of the Hessian over the
+    entire state (`solver_mode="splu"`), or, as both the observation operators
+    and the prior are block-diagonal per pixel, solve a stack of small
+    `n_params x n_params` systems at once (`solver_mode="block"`).
+
+    With `compact`, pixels that have no valid observation in any band are
+    left out of the solve, and keep their forecast mean and precision. This
+    is exact as long as the forecast precision doesn't couple them to the
+    observed pixels (if it does, the whole state is solved). It's off by
+    default, so every pixel goes through the solver.
+
+    `damping` is an optional array with a Levenberg-Marquardt factor per
+    state pixel: the term `damping*diag(A)*(x - x_anchor)**2` is added to
+    the cost of each pixel, which shortens the step towards `x_anchor`.
+    The returned Hessian doesn't include the damping.
+
+    A `SolverContext` given in `context` keeps the sparsity structure and
+    the symbolic factorisation between calls (`"splu"` mode only). If the
+    problem is block-diagonal per pixel, the Hessian is then assembled
+    straight into the cached block structure, rather than with sparse
+    matrix products."""
+    if solver_mode not in ["splu", "block"]:
+        raise ValueError("Unknown solver mode {}".format(solver_mode))
     n_bands = len(observations_b)
+    state_mask = as_state_grid(state_mask)
     
     y = []
     y_orig = []
@@ -115,6 +368,18 @@ def variational_kalman_multiband( observations_b, mask_b, state_mask, uncertaint
         R_mat.append(c)
         y.append(d)
         y_orig.append(e)
+    if solver_mode == "block" or context is not None:
+        # The block solver needs the problem to be block-diagonal per pixel,
+        # the general assembly below doesn't
+        blocks = _pixel_blocks(H_matrix, P_forecast_inv, n_params,
+                               strict=solver_mode == "block")
+        if blocks is not None:
+            obs_mask = [state_mask.gather(mask) for mask in mask_b]
+            return _solve_multiband_blocks(
+                blocks[0], H0, R_mat, y, y_orig, obs_mask, n_params,
+                x_forecast, blocks[1], compact=compact, damping=damping,
+                x_anchor=x_anchor,
+                context=context if solver_mode == "splu" else None)
     H_matrix_ = sp.vstack(H_matrix)
     H0 = np.hstack(H0)
     R_mat = sp.diags(np.hstack(R_mat))
@@ -126,12 +391,16 @@ def variational_kalman_multiband( observations_b, mask_b, state_mask, uncertaint
     b = H_matrix_.T.dot(R_mat).dot(y) + P_forecast_inv.dot (x_forecast)
     b = b.astype(np.float32)
     A = A.astype(np.float32)
+    A_solve = A
+    if damping is not None:
+        diagonal = np.repeat(damping, n_params)*A.diagonal()
+        A_solve = (A + sp.diags(diagonal)).astype(np.float32)
+        b = (b + diagonal*x_anchor).astype(np.float32)
     # Here we can either do a spLU of A, and solve, or we can have a first go
     # by assuming P_forecast_inv is diagonal, and use the inverse of A_approx as
     # a preconditioner
-    LOG.info("Solving")
-    AI = sp.linalg.splu (A)
-    x_analysis = AI.solve (b)
+    x_analysis = _splu_solve(A_solve, b, x_forecast, mask_b, state_mask,
+                             n_params, compact, context=context)
     # So retval is the solution vector and A is the Hessian 
     # (->inv(A) is posterior cov)
     fwd_modelled = H_matrix_.dot(x_analysis-x_forecast) + H0
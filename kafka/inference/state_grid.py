@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""The state grid: the state mask, plus the indices that map between rasters
+on its grid and the state vector, worked out once per run."""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017 J Gomez-Dans"
+__version__ = "1.0 (09.03.2017)"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+
+class StateGrid(object):
+    """A boolean state mask, with the flat indices of its state pixels (in
+    state vector order) and the bounding box of the state pixels, so that
+    moving data between rasters and the state vector is a `np.take` (see
+    `gather`) or an indexed assignment (see `scatter`) rather than a fresh
+    boolean mask operation every time.
+
+    A `StateGrid` can be used where a boolean state mask is expected: it
+    converts to the mask with `np.asarray`, so `image[state_grid]` works,
+    and it has the `shape`, `size`, `ndim`, `sum`, `ravel`, `flatten` and
+    `nonzero` of the mask.
+
+    Parameters
+    -----------
+    state_mask: array
+        The 2D boolean state mask
+    """
+    def __init__(self, state_mask):
+        self.mask = np.array(state_mask, dtype=bool)
+        self.mask.setflags(write=False)
+        self.shape = self.mask.shape
+        self.size = self.mask.size
+        self.ndim = self.mask.ndim
+        dtype = np.int32 if self.size < 2**31 else np.int64
+        self.flat_index = np.flatnonzero(self.mask).astype(dtype)
+        self.n_pixels = len(self.flat_index)
+        self._window = None
+        self._window_index = None
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.mask
+        return self.mask.astype(dtype)
+
+    def sum(self, *args, **kwargs):
+        if not args and not kwargs:
+            return self.n_pixels
+        return self.mask.sum(*args, **kwargs)
+
+    def ravel(self):
+        return self.mask.ravel()
+
+    def flatten(self):
+        return self.mask.flatten()
+
+    def nonzero(self):
+        return self.mask.nonzero()
+
+    @property
+    def window(self):
+        """The bounding box of the state pixels, as a tuple of row and
+        column slices"""
+        if self._window is None:
+            if self.n_pixels > 0:
+                rows = self.flat_index // self.shape[1]
+                cols = self.flat_index % self.shape[1]
+                self._window = (slice(rows.min(), rows.max() + 1),
+                                slice(cols.min(), cols.max() + 1))
+            else:
+                self._window = (slice(0, 0), slice(0, 0))
+        return self._window
+
+    @property
+    def window_shape(self):
+        """Shape of the bounding box of the state pixels"""
+        return (self.window[0].stop - self.window[0].start,
+                self.window[1].stop - self.window[1].start)
+
+    @property
+    def window_index(self):
+        """Flat indices of the state pixels within the bounding box"""
+        if self._window_index is None:
+            rows = self.flat_index // self.shape[1] - self.window[0].start
+            cols = self.flat_index % self.shape[1] - self.window[1].start
+            index = rows*self.window_shape[1] + cols
+            self._window_index = index.astype(self.flat_index.dtype)
+        return self._window_index
+
+    def gather(self, image):
+        """Returns the values of the state pixels of `image`, in state
+        vector order. `image` can be on the full grid, or on the bounding
+        box `window`, and can have leading dimensions (e.g. bands), which
+        are kept. Flattened images are accepted too."""
+        image = np.asarray(image)
+        if image.shape[-2:] == self.shape:
+            index = self.flat_index
+            image = image.reshape(image.shape[:-2] + (-1,))
+        elif image.shape[-2:] == self.window_shape:
+            index = self.window_index
+            image = image.reshape(image.shape[:-2] + (-1,))
+        elif image.shape[-1] == self.size:
+            index = self.flat_index
+        else:
+            raise ValueError("An image of shape {} isn't on a state grid of "
+                             "shape {}".format(image.shape, self.shape))
+        return np.take(image, index, axis=-1)
+
+    def scatter(self, values, fill=0, dtype=None, window=False):
+        """Puts the state vector order `values` of the state pixels on an
+        image of the grid (or of the bounding box, with `window`), with
+        `fill` elsewhere"""
+        values = np.asarray(values)
+        if dtype is None:
+            dtype = values.dtype
+        if window:
+            shape, index = self.window_shape, self.window_index
+        else:
+            shape, index = self.shape, self.flat_index
+        if fill == 0:
+            # Zeroed memory is much cheaper than filling it
+            image = np.zeros(shape[0]*shape[1], dtype=dtype)
+        else:
+            image = np.full(shape[0]*shape[1], fill, dtype=dtype)
+        image[index] = values
+        return image.reshape(shape)
+
+    def parameter(self, x, n_params, i):
+        """A (strided) view of parameter `i` of all the state pixels in the
+        pixel-major state vector `x`"""
+        return x[i::n_params]
+
+    def crop(self, window):
+        """The `StateGrid` of a window (a tuple of row and column slices) of
+        this grid"""
+        return StateGrid(self.mask[window])
+
+
+def as_state_grid(state_mask):
+    """Returns `state_mask` if it already is a `StateGrid`, or builds one"""
+    if isinstance(state_mask, StateGrid):
+        return state_mask
+    return StateGrid(state_mask)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""Iteration strategies for the nonlinear (iterated) update. Each
+iteration linearises the observation operators around the current point,
+and solves the linearised problem; strategies decide what to make of that
+solution, one pixel at a time."""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017 J Gomez-Dans"
+__version__ = "1.0 (09.03.2017)"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+
+class GaussNewton(object):
+    """Plain (undamped) Gauss-Newton: the solution of the linearised problem
+    is the next linearisation point.
+
+    Strategies are called by `LinearKalman.do_all_bands` as follows: `reset`
+    at the start of each date, then in every iteration `evaluate` with the
+    cost `J(x)` of each pixel at the current linearisation point (only if
+    `needs_cost` is set), `damping` to get the per-pixel damping added to
+    the linearised problem, and `next_point` with the solution of the
+    linearised problem. Once the iterations stop, `final_point` gives the
+    analysis from the last point."""
+    name = "gauss-newton"
+    needs_cost = False
+
+    def reset(self, x_forecast, n_params):
+        self.n_params = n_params
+
+    def evaluate(self, x, cost, active):
+        pass
+
+    def damping(self):
+        """Returns the per-pixel damping factors and the point the damping
+        pulls towards, or `(None, None)` for no damping"""
+        return None, None
+
+    def next_point(self, x, x_solved, active):
+        return x_solved
+
+    def final_point(self, x):
+        """The analysis, from the point `x` the iterations stopped at"""
+        return x
+
+
+class LevenbergMarquardt(GaussNewton):
+    """Levenberg-Marquardt: the linearised problem of each pixel is damped
+    by `lambda*diag(A)*(x - x_best)**2`, where `x_best` is the point with the
+    lowest cost found so far. `lambda` starts at zero (a plain Gauss-Newton
+    step), is multiplied by `increase` (or set to `initial_damping` if it
+    was zero) when a step doesn't lower the cost of the pixel, and divided
+    by `decrease` when it does (back to zero below `min_damping`). Pixels
+    where Gauss-Newton behaves are therefore never damped. Pixels whose last
+    step didn't lower their cost end up at their best point."""
+    name = "levenberg-marquardt"
+    needs_cost = True
+
+    def __init__(self, initial_damping=1e-2, increase=10., decrease=10.,
+                 min_damping=1e-4, max_damping=1e7):
+        self.initial_damping = initial_damping
+        self.increase = increase
+        self.decrease = decrease
+        self.min_damping = min_damping
+        self.max_damping = max_damping
+
+    def reset(self, x_forecast, n_params):
+        n_pixels = len(x_forecast) // n_params
+        self.n_params = n_params
+        self.lambdas = np.zeros(n_pixels)
+        self.x_best = x_forecast.copy()
+        self.cost_best = np.full(n_pixels, np.inf)
+        self.rejected = np.zeros(n_pixels, dtype=bool)
+
+    def evaluate(self, x, cost, active):
+        better = active & (cost <= self.cost_best)
+        worse = active & ~better
+        self.rejected[active] = worse[active]
+        self.x_best.reshape((-1, self.n_params))[better] = \
+            x.reshape((-1, self.n_params))[better]
+        self.cost_best[better] = cost[better]
+        lambdas = self.lambdas[better]/self.decrease
+        self.lambdas[better] = np.where(lambdas < self.min_damping, 0.,
+                                        lambdas)
+        self.lambdas[worse] = np.clip(self.lambdas[worse]*self.increase,
+                                      self.initial_damping, self.max_damping)
+
+    def damping(self):
+        if not self.lambdas.any():
+            return None, None
+        return self.lambdas, self.x_best
+
+    def final_point(self, x):
+        x = x.reshape((-1, self.n_params)).copy()
+        x[self.rejected] = self.x_best.reshape((-1, self.n_params))[
+            self.rejected]
+        return x.ravel()
+
+
+class LineSearch(GaussNewton):
+    """Gauss-Newton with a backtracking line search on the cost of each
+    pixel: if the cost at the new point isn't lower than at the best point
+    so far, the step from the best point is halved (down to
+    `min_step`, after which the pixel stays at its best point). Pixels
+    whose last step was rejected end up at their best point."""
+    name = "line-search"
+    needs_cost = True
+
+    def __init__(self, shrink=0.5, min_step=1./64):
+        self.shrink = shrink
+        self.min_step = min_step
+
+    def reset(self, x_forecast, n_params):
+        n_pixels = len(x_forecast) // n_params
+        self.n_params = n_params
+        self.steps = np.ones(n_pixels)
+        self.x_best = x_forecast.reshape((-1, n_params)).copy()
+        self.cost_best = np.full(n_pixels, np.inf)
+        self.directions = np.zeros_like(self.x_best)
+        self.rejected = np.zeros(n_pixels, dtype=bool)
+
+    def evaluate(self, x, cost, active):
+        better = active & (cost <= self.cost_best)
+        # Frozen pixels keep the outcome of their last evaluation
+        self.rejected[active] = ~better[active]
+        self.x_best[better] = x.reshape((-1, self.n_params))[better]
+        self.cost_best[better] = cost[better]
+        self.steps[better] = 1.
+        self.steps[self.rejected] *= self.shrink
+
+    def next_point(self, x, x_solved, active):
+        x_next = x_solved.reshape((-1, self.n_params)).copy()
+        accepted = active & ~self.rejected
+        self.directions[accepted] = x_next[accepted] - \
+            self.x_best[accepted]
+        rejected = active & self.rejected
+        x_next[rejected] = self.x_best[rejected] + \
+            self.steps[rejected][:, None]*self.directions[rejected]
+        give_up = rejected & (self.steps < self.min_step)
+        x_next[give_up] = self.x_best[give_up]
+        return x_next.ravel()
+
+    def final_point(self, x):
+        x = x.reshape((-1, self.n_params)).copy()
+        x[self.rejected] = self.x_best[self.rejected]
+        return x.ravel()
+
+
+STRATEGIES = dict((strategy.name, strategy) for strategy in
+                  [GaussNewton, LevenbergMarquardt, LineSearch])
+
+
+def get_strategy(strategy):
+    """Returns an iteration strategy object from its name (one of
+    `STRATEGIES`), or the object itself"""
+    if strategy is None:
+        return GaussNewton()
+    if isinstance(strategy, basestring):
+        try:
+            return STRATEGIES[strategy]()
+        except KeyError:
+            raise ValueError("Unknown iteration strategy {}".format(
+                strategy))
+    return strategy
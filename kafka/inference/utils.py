@@ -30,10 +30,14 @@ import numpy as np
 
 import scipy.sparse as sp
 import scipy.sparse.linalg as spl
+from scipy.spatial import cKDTree
 import datetime as dt
 import os
 import gdal
 
+from block_diagonal import BlockDiagonalPrecision
+from state_grid import as_state_grid
+
 import logging
 LOG = logging.getLogger(__name__)
 
@@ -62,47 +66,221 @@ def iterate_time_grid(time_grid, the_dates):
             yield timestep, locate_times, False
 
 
-def run_emulator(gp, x, tol=None):
+def _predict(gp, x, chunk_size=100000):
+    """Calls the emulator on `x` in chunks of `chunk_size` rows, to bound the
+    size of the temporary arrays the emulator creates."""
+    H = []
+    dH = []
+    for start in range(0, x.shape[0], chunk_size):
+        x_chunk = x[start:(start + chunk_size)]
+        try:
+            H_, dH_ = gp.predict(x_chunk, do_unc=False)
+        except ValueError:
+            # Needed for newer gp version
+            H_, _, dH_ = gp.predict(x_chunk, do_unc=False)
+        H.append(H_)
+        dH.append(dH_)
+    return np.concatenate(H), np.concatenate(dH)
+
+
+def _estimate_unique_rows(x, n_sample=100000):
+    """Estimates the number of unique rows of `x` from a random sample of
+    `n_sample` rows, with the (bias corrected) Chao1 estimator: the unique
+    rows in the sample, plus a correction from the rows seen only once and
+    twice. Samples of mostly repeated rows give about the number of unique
+    rows in the sample, and samples of mostly different rows give a large
+    number."""
+    if x.shape[0] <= n_sample:
+        return len(np.unique(x, axis=0))
+    sample = x[np.random.choice(x.shape[0], n_sample, replace=False)]
+    _, counts = np.unique(sample, axis=0, return_counts=True)
+    f1 = np.sum(counts == 1)
+    f2 = np.sum(counts == 2)
+    return len(counts) + f1*(f1 - 1)/(2.*(f2 + 1))
+
+
+def run_emulator(gp, x, tol=None, max_unique=1e6, lut_size=5000,
+                 method="grid", return_error=False):
+    """Runs the emulator `gp` on the rows of `x`, but only evaluates each
+    unique row once. If there are (an estimated, see
+    `_estimate_unique_rows`) more than `max_unique` unique rows, the
+    parameter space is clustered into a LUT of about `lut_size` entries, and
+    pixels get the emulator output of their LUT entry (see
+    `emulate_clustered`). In that case, `tol` is the maximum emulation error
+    allowed, and `method` selects how the LUT is built. If `return_error`
+    is `True`, the (estimated) maximum emulation error is returned too (zero
+    if every row was emulated exactly)."""
     # We select the unique values in vector x
     # Note that we could have done this using e.g. a histogram
     # or some other method to select solutions "close enough"
-    unique_vectors = np.vstack({tuple(row) for row in x})
-    if len(unique_vectors) == 1:  # Prior!
-        cluster_labels = np.zeros(x.shape[0], dtype=np.int16)
-    elif len(unique_vectors) > 1e6:
-
+    if x.shape[0] == 0:
+        # Nothing to emulate (e.g. everything masked out)
+        H, dH, max_error = np.zeros(0), np.zeros_like(x), 0.
+    elif x.shape[0] > max_unique and \
+            _estimate_unique_rows(x) > max_unique:
         LOG.info("Clustering parameter space")
-        mean = np.mean(x, axis=0)  # 7 dimensions
-        cov = np.cov(x, rowvar=0)  # 4 x 4 dimensions
-        # Draw a 300 element LUT
-        unique_vectors = np.random.multivariate_normal(mean, cov,
-                                                       5000)
-        # Assign each element of x to a LUT/cluster entry
-        cluster_labels = locate_in_lut(unique_vectors, x)
-    # Runs emulator for emulation subset
-    try:
-        H_, dH_ = gp.predict(unique_vectors, do_unc=False)
-    except ValueError:
-        # Needed for newer gp version
-        H_, _, dH_ = gp.predict(unique_vectors, do_unc=False)
-
-    H = np.zeros(x.shape[0])
-    dH = np.zeros_like(x)
-    try:
-        nclust = cluster_labels.shape
-    except NameError:
-        for i, uniq in enumerate(unique_vectors):
-            passer = np.all(x == uniq, axis=1)
-            H[passer] = H_[i]
-            dH[passer, :] = dH_[i, :]
-        return H, dH
-
-    for label in np.unique(cluster_labels):
-        H[cluster_labels == label] = H_[label]
-        dH[cluster_labels == label, :] = dH_[label, :]
+        H, dH, max_error = emulate_clustered(gp, x, tol=tol,
+                                             lut_size=lut_size,
+                                             method=method)
+    else:
+        # `cluster_labels` maps every row of x to its unique vector, so the
+        # emulator output can be scattered back with a single gather
+        unique_vectors, cluster_labels = np.unique(x, axis=0,
+                                                   return_inverse=True)
+        cluster_labels = cluster_labels.ravel()
+        LOG.info("Emulating %d unique vectors out of %d" % (
+            len(unique_vectors), x.shape[0]))
+        # Runs emulator for emulation subset
+        H_, dH_ = _predict(gp, unique_vectors)
+        H = H_[cluster_labels]
+        dH = dH_[cluster_labels, :]
+        max_error = 0.
+    if return_error:
+        return H, dH, max_error
     return H, dH
 
 
+def _grid_cells(scaled, n_bins):
+    """Labels the occupied cells of a regular grid with `n_bins` per
+    dimension. `scaled` is the data scaled to [0, 1]."""
+    cells = np.minimum(np.floor(scaled*n_bins), n_bins - 1).astype(np.int64)
+    if float(n_bins)**cells.shape[1] < 2**62:
+        # Cheaper to find unique integer cell codes than unique rows
+        codes = np.ravel_multi_index(cells.T, (n_bins,)*cells.shape[1])
+        _, labels = np.unique(codes, return_inverse=True)
+    else:
+        _, labels = np.unique(cells, axis=0, return_inverse=True)
+    return labels.ravel()
+
+
+def quantise_lut(x, lut_size):
+    """Builds a LUT by quantising `x` on a regular grid spanning the data. The
+    grid is refined for as long as the number of occupied cells stays under
+    `lut_size`. Each LUT entry is the mean of the rows of `x` that fall in
+    its cell.
+
+    Returns
+    --------
+    The `(n_entries, n_dims)` LUT and the LUT entry of every row of `x`.
+    """
+    lo = x.min(axis=0)
+    span = x.max(axis=0) - lo
+    span[span == 0] = 1.
+    scaled = (x - lo)/span
+    n_bins = max(1, int(lut_size**(1./x.shape[1])))
+    labels = _grid_cells(scaled, n_bins)
+    while labels.max() + 1 < min(lut_size, x.shape[0]) and n_bins < 2**15:
+        n_bins = int(np.ceil(n_bins*1.5))
+        new_labels = _grid_cells(scaled, n_bins)
+        if new_labels.max() + 1 > lut_size:
+            break
+        labels = new_labels
+    n_entries = labels.max() + 1
+    counts = np.bincount(labels, minlength=n_entries).astype(np.float64)
+    lut = np.array([np.bincount(labels, weights=x[:, i],
+                                minlength=n_entries)
+                    for i in range(x.shape[1])]).T/counts[:, None]
+    return lut, labels
+
+
+def kmeans_lut(x, lut_size, n_sample=100000):
+    """Builds a LUT with k-means centres trained on (up to) `n_sample` rows of
+    `x`, and assigns every row of `x` to its nearest centre.
+
+    Returns
+    --------
+    The `(n_entries, n_dims)` LUT and the LUT entry of every row of `x`.
+    """
+    from scipy.cluster.vq import kmeans2
+    if x.shape[0] > n_sample:
+        sample = x[np.random.choice(x.shape[0], n_sample, replace=False)]
+    else:
+        sample = x
+    lut, _ = kmeans2(sample, min(lut_size, sample.shape[0]), minit="points")
+    labels = locate_in_lut(lut, x)
+    return lut, labels
+
+
+def emulate_clustered(gp, x, tol=None, lut_size=5000, method="grid",
+                      n_check=1000, max_rounds=5):
+    """Approximate emulation for very large numbers of different vectors. The
+    rows of `x` are clustered into a LUT (see `quantise_lut` and
+    `kmeans_lut`), the emulator is run on the LUT entries, and every row
+    gets the value and gradient of its LUT entry.
+
+    The emulation error of each row is estimated from a Taylor expansion
+    around its LUT entry, as `|dH_lut.d| + c*|d|**2`, with `d = x - x_lut`.
+    The curvature term `c` is calibrated on `n_check` random rows that are
+    emulated exactly: it's the smallest value that covers the error of all
+    the checked rows. If `tol` is given, rows with an estimate above `tol`
+    are emulated exactly, and more rows are checked (and `c` updated) until
+    all the checked rows are within `tol`, for up to `max_rounds` rounds. If
+    the checked rows are still over `tol` by then, the estimate can't be
+    relied on, and every row is emulated exactly. The error of the rows that
+    are not emulated exactly is never measured, so the maximum error is an
+    estimate, not a bound.
+
+    Returns
+    --------
+    H, dH, and the estimated maximum emulation error (the largest scaled
+    error estimate of the rows that weren't emulated exactly).
+    """
+    if method == "grid":
+        lut, labels = quantise_lut(x, lut_size)
+    elif method == "kmeans":
+        lut, labels = kmeans_lut(x, lut_size)
+    else:
+        raise ValueError("Unknown LUT method {}".format(method))
+    H_, dH_ = _predict(gp, lut)
+    H = H_[labels]
+    dH = dH_[labels, :]
+    offset = x - lut[labels]
+    slope = np.abs(np.sum(dH*offset, axis=1))
+    distance = np.sum(offset**2, axis=1)
+    exact = np.zeros(x.shape[0], dtype=bool)
+    curvature = 0.
+
+    def emulate_exactly(rows):
+        H[rows], dH[rows] = _predict(gp, x[rows])
+        exact[rows] = True
+
+    for _ in xrange(max_rounds):
+        if tol is not None:
+            bad = np.flatnonzero(~exact & (slope + curvature*distance > tol))
+            if len(bad) > 0:
+                LOG.info("Emulating %d vectors exactly" % len(bad))
+                emulate_exactly(bad)
+        candidates = np.flatnonzero(~exact)
+        if n_check == 0 or len(candidates) == 0:
+            break
+        check = np.random.choice(candidates, min(n_check, len(candidates)),
+                                 replace=False)
+        H_lut = H[check].copy()
+        emulate_exactly(check)
+        true_error = np.abs(H[check] - H_lut)
+        missed = (true_error - slope[check])/np.maximum(distance[check],
+                                                         1e-12)
+        curvature = max(curvature, missed.max())
+        if tol is None or true_error.max() <= tol:
+            break
+    else:
+        if tol is not None:
+            LOG.warning("Emulation errors above %g after %d rounds, "
+                        "emulating every vector exactly" % (tol, max_rounds))
+            if not exact.all():
+                emulate_exactly(np.flatnonzero(~exact))
+    estimate = slope + curvature*distance
+    if tol is not None:
+        # Rows that are over the tolerance with the final calibration
+        bad = np.flatnonzero(~exact & (estimate > tol))
+        if len(bad) > 0:
+            emulate_exactly(bad)
+    max_error = estimate[~exact].max() if not exact.all() else 0.
+    LOG.info("LUT of %d entries, %d vectors emulated exactly, estimated "
+             "max emulation error %g" % (len(lut), exact.sum(), max_error))
+    return H, dH, max_error
+
+
 def create_uncertainty(uncertainty, mask):
     """Creates the observational uncertainty matrix. We assume that
     uncertainty is a single value and we return a diagonal matrix back.
@@ -113,6 +291,49 @@ def create_uncertainty(uncertainty, mask):
     return sp.dia_matrix((R_mat, 0), shape=(R_mat.shape[0], R_mat.shape[0]))
 
 
+def inverse_variance(sigma, mask, state_mask=None):
+    """Returns the inverse variances `1/sigma**2` of the unmasked pixels
+    of an image of observational uncertainties `sigma`, with zeros for the
+    masked pixels, in single precision. If `state_mask` is given, only the
+    state pixels are returned, as a vector in state vector order."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv_var = np.where(mask, 1./np.asarray(sigma, dtype=np.float32)**2,
+                           0.).astype(np.float32)
+    if state_mask is not None:
+        inv_var = as_state_grid(state_mask).gather(inv_var)
+    return inv_var
+
+
+def inverse_variance_vector(uncertainty, state_mask):
+    """Returns the observational inverse variances of the state pixels, as
+    a single precision vector in state vector order. The readers'
+    `get_band_data` give the uncertainty as that vector already (with zeros
+    for masked pixels), or as an image of inverse variances on the grid of
+    `state_mask`. Older readers give a diagonal `N x N` (sparse) matrix over
+    the whole grid, which is also accepted."""
+    state_grid = as_state_grid(state_mask)
+    if sp.issparse(uncertainty):
+        uncertainty = uncertainty.diagonal()
+    else:
+        uncertainty = np.asarray(uncertainty)
+        if uncertainty.shape == state_grid.shape:
+            uncertainty = state_grid.gather(uncertainty)
+        elif uncertainty.ndim == 2 and \
+                uncertainty.shape[0] == uncertainty.shape[1]:
+            uncertainty = uncertainty.diagonal()
+    if uncertainty.ndim != 1:
+        raise ValueError("Can't interpret an uncertainty of shape {}".format(
+            uncertainty.shape))
+    if len(uncertainty) == state_grid.size and \
+            len(uncertainty) != state_grid.n_pixels:
+        uncertainty = state_grid.gather(uncertainty)
+    elif len(uncertainty) != state_grid.n_pixels:
+        raise ValueError("The uncertainty has {:d} entries, and there are "
+                         "{:d} state pixels".format(len(uncertainty),
+                                                    state_grid.n_pixels))
+    return uncertainty.astype(np.float32)
+
+
 def create_linear_observation_operator(obs_op, n_params, metadata,
                                        mask, state_mask,
                                        x_forecast, band=None):
@@ -124,22 +345,84 @@ def create_linear_observation_operator(obs_op, n_params, metadata,
 
 
 
+def gather_state_pixels(x_forecast, n_params, pixels, state_mapper=None):
+    """Gathers the state of some pixels into an `(n, n_mapped)` array.
+
+    Parameters
+    -----------
+    x_forecast: array
+        The state vector, ordered as all the parameters of pixel 0, then all
+        the parameters of pixel 1, etc.
+    n_params: int
+        Number of parameters per pixel
+    pixels: array
+        Integer indices of the required pixels within the state
+    state_mapper: array
+        The (optional) parameters to select for each pixel. If `None`, all
+        parameters are returned.
+
+    Returns
+    --------
+    An `(len(pixels), len(state_mapper))` array
+    """
+    x = x_forecast.reshape((-1, n_params))
+    if state_mapper is None:
+        return x[pixels]
+    return x[np.ix_(pixels, state_mapper)]
+
+
+def create_pixel_jacobian(dH, pixels, n_pixels, n_params, state_mapper=None):
+    """Scatters per-pixel Jacobians into the sparse linearised observation
+    operator. The operator has a row per pixel in the state, and each row
+    only has non-zero elements for the parameters of that pixel (selected
+    by `state_mapper`), so the CSR arrays can be built directly.
+
+    Parameters
+    -----------
+    dH: array
+        An `(len(pixels), len(state_mapper))` array with the Jacobians
+    pixels: array
+        Integer indices of the pixels `dH` refers to
+    n_pixels: int
+        Total number of pixels in the state
+    n_params: int
+        Number of parameters per pixel
+    state_mapper: array
+        Location of the columns of `dH` within each pixel's parameters. If
+        `None`, `dH` has all `n_params` parameters.
+
+    Returns
+    --------
+    An `(n_pixels, n_pixels*n_params)` CSR matrix
+    """
+    if state_mapper is None:
+        state_mapper = np.arange(n_params)
+    order = np.argsort(state_mapper)
+    columns = np.asarray(state_mapper)[order]
+    row_length = np.zeros(n_pixels, dtype=np.int64)
+    row_length[pixels] = len(columns)
+    indptr = np.concatenate([[0], np.cumsum(row_length)])
+    indices = (n_params*np.asarray(pixels)[:, None] + columns[None, :])
+    data = np.asarray(dH, dtype=np.float32)[:, order]
+    return sp.csr_matrix((data.ravel(), indices.ravel(), indptr),
+                         shape=(n_pixels, n_params*n_pixels))
+
+
 def create_nonlinear_observation_operator(n_params, emulator, metadata,
-                                          mask, state_mask,  x_forecast, band):
+                                          mask, state_mask,  x_forecast, band,
+                                          emulation_options=None):
     """Using an emulator of the nonlinear model around `x_forecast`.
     This case is quite special, as I'm focusing on a BHR SAIL
     version (or the JRC TIP), which have spectral parameters
     (e.g. leaf single scattering albedo in two bands, etc.). This
     is achieved by using the `state_mapper` to select which bits
-    of the state vector (and model Jacobian) are used."""
+    of the state vector (and model Jacobian) are used.
+    `emulation_options` are passed on to `run_emulator` (e.g. the `tol` of
+    the clustered emulation)."""
     LOG.info("Creating the ObsOp for band %d" % band)
-    n_times = x_forecast.shape[0] / n_params
-    good_obs = mask.sum()
-    H_matrix = sp.lil_matrix((n_times, n_params * n_times),
-                             dtype=np.float32)
+    n_times = x_forecast.shape[0] // n_params
     H0 = np.zeros(n_times, dtype=np.float32)
 
-
     # So the model has spectral components.
     if band == 0:
         # ssa, asym, TLAI, rsoil
@@ -148,72 +431,55 @@ def create_nonlinear_observation_operator(n_params, emulator, metadata,
         # ssa, asym, TLAI, rsoil
         state_mapper = np.array([3, 4, 6, 5])
 
-    # This loop can be JIT'ed
-    x0 = np.zeros((n_times, 4))
-    for i, m in enumerate(mask[state_mask].flatten()):
-        if m:
-            x0[i, :] = x_forecast[(n_params * i) + state_mapper]
+    pixels = np.flatnonzero(as_state_grid(state_mask).gather(mask))
+    x0 = gather_state_pixels(x_forecast, n_params, pixels, state_mapper)
     LOG.info("Running emulators")
     # Calls the run_emulator method that only does different vectors
     # It might be here that we do some sort of clustering
 
-    H0_, dH = run_emulator(emulator, x0[mask[state_mask]])
+    H0_, dH = run_emulator(emulator, x0, **(emulation_options or {}))
 
     LOG.info("Storing emulators in H matrix")
-    # This loop can be JIT'ed too
-    n = 0
-    for i, m in enumerate(mask[state_mask].flatten()):
-        if m:
-            H_matrix[i, state_mapper + n_params * i] = dH[n]
-            H0[i] = H0_[n]
-            n += 1
+    H0[pixels] = H0_
+    H_matrix = create_pixel_jacobian(dH, pixels, n_times, n_params,
+                                     state_mapper)
 
     LOG.info("\tDone!")
 
-    return (H0, H_matrix.tocsr())
+    return (H0, H_matrix)
 
 
 
 def create_prosail_observation_operator(n_params, emulator, metadata,
-                                          mask, state_mask,  x_forecast, band):
+                                          mask, state_mask,  x_forecast, band,
+                                          emulation_options=None):
     """Using an emulator of the nonlinear model around `x_forecast`.
     This case is quite special, as I'm focusing on a BHR SAIL
     version (or the JRC TIP), which have spectral parameters
     (e.g. leaf single scattering albedo in two bands, etc.). This
     is achieved by using the `state_mapper` to select which bits
-    of the state vector (and model Jacobian) are used."""
+    of the state vector (and model Jacobian) are used.
+    `emulation_options` are passed on to `run_emulator` (e.g. the `tol` of
+    the clustered emulation)."""
     LOG.info("Creating the ObsOp for band %d" % band)
-    n_times = x_forecast.shape[0] / n_params
-    good_obs = mask.sum()
-    H_matrix = sp.lil_matrix((n_times, n_params * n_times),
-                             dtype=np.float32)
+    n_times = x_forecast.shape[0] // n_params
     H0 = np.zeros(n_times, dtype=np.float32)
 
-
-
-    # This loop can be JIT'ed
-    x0 = np.zeros((n_times, n_params))
-    for i, m in enumerate(mask[state_mask].flatten()):
-        if m:
-            x0[i, :] = x_forecast[(n_params*i):(n_params*(i+1))]
+    pixels = np.flatnonzero(as_state_grid(state_mask).gather(mask))
+    x0 = gather_state_pixels(x_forecast, n_params, pixels)
     LOG.info("Running emulators")
     # Calls the run_emulator method that only does different vectors
     # It might be here that we do some sort of clustering
 
-    H0_, dH = run_emulator(emulator, x0[mask[state_mask]])
+    H0_, dH = run_emulator(emulator, x0, **(emulation_options or {}))
 
     LOG.info("Storing emulators in H matrix")
-    # This loop can be JIT'ed too
-    n = 0
-    for i, m in enumerate(mask[state_mask].flatten()):
-        if m:
-            H_matrix[i,  (n_params*i):(n_params*(i+1))] = dH[n]
-            H0[i] = H0_[n]
-            n += 1
+    H0[pixels] = H0_
+    H_matrix = create_pixel_jacobian(dH, pixels, n_times, n_params)
 
     LOG.info("\tDone!")
 
-    return (H0, H_matrix.tocsr())
+    return (H0, H_matrix)
 
 
 
@@ -225,9 +491,9 @@ def locate_in_lut(lut, im):
     and `np` is not too big. We will look for the location of the row of
     `lut` that is closest to each row in `im`.
     It returns `idx`, an array with an integer index to the first dimension
-    of lut."""
+    of lut. The search uses a KD-tree, so memory use is linear in `m + n`."""
     assert (lut.shape[1] == im.shape[1])
-    idx = np.linalg.norm(lut[:, None, :] - im, axis=2).argmin(axis=0)
+    _, idx = cKDTree(lut).query(im)
     return idx
 
 
@@ -279,16 +545,7 @@ def block_diag(mats, format=None, dtype=None):
            [ 0,  0,  0,  0,  9, 10],
            [ 0,  0,  0,  0, 11, 12]])
     """
-    import scipy.sparse as sp
-    import scipy.sparse.sputils as spu
-    from scipy.sparse.sputils import upcast, get_index_dtype
-
-    from scipy.sparse.csr import csr_matrix
-    from scipy.sparse.csc import csc_matrix
-    from scipy.sparse.bsr import bsr_matrix
     from scipy.sparse.coo import coo_matrix
-    from scipy.sparse.dia import dia_matrix
-
     from scipy.sparse import issparse
 
     n = len(mats)
@@ -344,3 +601,41 @@ def spsolve2(a, b):
         bb = np.array(b_csc[j, :].todense()).squeeze()
         out[j, j] = a_lu.solve(bb)[j]
     return out.tocsr()
+
+
+def marginal_uncertainty(P_analysis_inv, n_params, full_covariance=False,
+                         chunk_size=20000):
+    """Exact marginal posterior standard deviations from the analysis
+    inverse covariance matrix (a `BlockDiagonalPrecision` or a per-pixel
+    block-diagonal sparse matrix). All the `n_params x n_params` blocks are
+    inverted in batches of `chunk_size` pixels, so that the correlations
+    between parameters within a pixel are taken into account (unlike
+    `1/sqrt(P_analysis_inv.diagonal())`), at a fraction of the cost of
+    `spsolve2`.
+
+    Parameters
+    -----------
+    P_analysis_inv: BlockDiagonalPrecision or sparse matrix
+        The analysis inverse covariance matrix
+    n_params: int
+        Number of parameters per pixel
+    full_covariance: bool
+        Whether to also return the per-pixel covariance blocks
+    chunk_size: int
+        Number of pixels inverted in each batch
+
+    Returns
+    --------
+    The standard deviations in state vector order and, if `full_covariance`
+    is set, the analysis covariance as a `BlockDiagonalPrecision` (see
+    `BlockDiagonalPrecision.covariance`). Pixels with a singular block get
+    NaNs.
+    """
+    if not isinstance(P_analysis_inv, BlockDiagonalPrecision):
+        P_analysis_inv = BlockDiagonalPrecision.from_sparse(
+            P_analysis_inv, n_params, dtype=np.float64)
+    if full_covariance:
+        cov = P_analysis_inv.covariance(chunk_size=chunk_size)
+        std = np.sqrt(np.einsum("nii->ni", cov.blocks)).astype(np.float32)
+        return std.ravel(), cov
+    return P_analysis_inv.marginal_std(chunk_size=chunk_size).ravel()
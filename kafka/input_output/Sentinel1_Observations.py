@@ -11,9 +11,10 @@ import gdal
 
 import numpy as np
 
-import osr
-
-import scipy.sparse as sp
+from ..inference.state_grid import as_state_grid
+from ..inference.utils import inverse_variance
+from .reprojection import ReprojectionCache
+from ..pipeline import ThreadedMap
 
 WRONG_VALUE = -999.0  # TODO tentative missing value
 
@@ -21,38 +22,14 @@ SARdata = namedtuple('SARdata',
                      'observations uncertainty mask metadata emulator')
 
 
-def reproject_image(source_img, target_img, dstSRSs=None):
-    """Reprojects/Warps an image to fit exactly another image.
-    Additionally, you can set the destination SRS if you want
-    to or if it isn't defined in the source image."""
-    g = gdal.Open(target_img)
-    geo_t = g.GetGeoTransform()
-    x_size, y_size = g.RasterXSize, g.RasterYSize
-    xmin = min(geo_t[0], geo_t[0] + x_size * geo_t[1])
-    xmax = max(geo_t[0], geo_t[0] + x_size * geo_t[1])
-    ymin = min(geo_t[3], geo_t[3] + y_size * geo_t[5])
-    ymax = max(geo_t[3], geo_t[3] + y_size * geo_t[5])
-    xRes, yRes = abs(geo_t[1]), abs(geo_t[5])
-    if dstSRSs is None:
-        dstSRS = osr.SpatialReference()
-        raster_wkt = g.GetProjection()
-        dstSRS.ImportFromWkt(raster_wkt)
-    else:
-        dstSRS = dstSRSs
-    g = gdal.Warp('', source_img, format='MEM',
-                  outputBounds=[xmin, ymin, xmax, ymax], xRes=xRes, yRes=yRes,
-                  dstSRS=dstSRS)
-    if g is None:
-        raise ValueError("Something failed with GDAL!")
-    return g
-
-
 class S1Observations(object):
     """
     """
+    # `get_band_data` can read a window of the state grid
+    supports_window = True
 
     def __init__(self, data_folder, state_mask,
-                 emulators={'VV': 'SOmething', 'VH': 'Other'}):
+                 emulators={'VV': 'SOmething', 'VH': 'Other'}, n_threads=3):
 
         """
 
@@ -77,7 +54,24 @@ class S1Observations(object):
         self.bands_per_observation = {}
         for the_date in self.dates:
             self.bands_per_observation[the_date] = 2 # 2 bands
-
+        self._reprojection = None
+        # The polarisations and the incidence angle are read in parallel
+        self._band_reader = ThreadedMap(n_threads)
+
+    def _get_reprojection(self):
+        """The `ReprojectionCache` onto the state grid (which also keeps its
+        `StateGrid`), made on first use"""
+        if self._reprojection is None:
+            self._reprojection = ReprojectionCache(self.state_mask)
+        return self._reprojection
+
+    def _get_state_pixels(self, window=None):
+        """The `StateGrid` of the state mask (or the boolean state mask of a
+        `window` of it)"""
+        state_grid = self._get_reprojection().state_grid
+        if window is None:
+            return state_grid
+        return state_grid.mask[window]
 
     def _read_backscatter(self, obs_ptr):
         """
@@ -141,11 +135,19 @@ class S1Observations(object):
 
         """
 
-        mask = np.ones_like(backscatter, dtype=np.bool)
+        mask = np.ones_like(backscatter, dtype=bool)
         mask[backscatter == WRONG_VALUE] = False
         return mask
 
-    def get_band_data(self, timestep, band):
+    def get_band_files(self, timestep, band):
+        """The files `band` on `timestep` is read from"""
+        return [self.date_data[timestep]]
+
+    def get_band_emulator(self, timestep, band):
+        """The emulator of polarisation `band`"""
+        return self.emulators[['VV', 'VH'][band]]
+
+    def get_band_data(self, timestep, band, window=None):
         """
         get all relevant S1 data information for one timestep to get processing
         done
@@ -155,6 +157,7 @@ class S1Observations(object):
         ------
         timestep
         band
+        window (optional tuple of row and column slices of the state grid)
 
         Output
         ------
@@ -163,32 +166,43 @@ class S1Observations(object):
 
         """
 
-        if band == 0:
-            polarisation = 'VV'
-        elif band == 1:
-            polarisation = 'VH'
+        return self._read_polarisations(timestep, [band], window=window)[0]
+
+    def get_date_data(self, timestep, window=None):
+        """
+        get the data of both polarisations for one timestep, in band order
+        (as `get_band_data` would). The incidence angle is only read once,
+        and shared by both polarisations. The three layers are read (and the
+        backscatter masked, and its inverse variances worked out) in parallel,
+        in a pool of `n_threads` threads.
+        """
+        return self._read_polarisations(timestep, [0, 1], window=window)
+
+    def _read_polarisations(self, timestep, bands, window=None):
+        polarisations = ['VV', 'VH']
         this_file = self.date_data[timestep]
-        fname = 'NETCDF:"{:s}":sigma0_{:s}'.format(this_file, polarisation)
-        obs_ptr = reproject_image(fname, self.state_mask)
-        observations = self._read_backscatter(obs_ptr)
-        uncertainty = self._calculate_uncertainty(observations)
-        mask = self._get_mask(observations)
-        R_mat = np.zeros_like(observations)
-        R_mat = uncertainty
-        R_mat[np.logical_not(mask)] = 0.
-        N = mask.ravel().shape[0]
-        R_mat_sp = sp.lil_matrix((N, N))
-        R_mat_sp.setdiag(1./(R_mat.ravel())**2)
-        R_mat_sp = R_mat_sp.tocsr()
-
-        emulator = self.emulators[polarisation]
+        reprojection = self._get_reprojection()
         # TODO read in angle of incidence from netcdf file
         # metadata['incidence_angle_deg'] =
-        fname = 'NETCDF:"{:s}":{:s}'.format(this_file, "theta")
-        obs_ptr = reproject_image(fname, self.state_mask)
-        metadata = {'incidence_angle': obs_ptr.ReadAsArray()}
-        sardata = SARdata(observations, R_mat_sp, mask, metadata, emulator)
-        return sardata
+        layers = ["sigma0_" + polarisations[band] for band in bands] + \
+            ["theta"]
+        state_pixels = as_state_grid(self._get_state_pixels(window))
+
+        def read_layer(layer):
+            values = reprojection.read('NETCDF:"{:s}":{:s}'.format(
+                this_file, layer), window=window)
+            if layer == "theta":
+                return values
+            mask = self._get_mask(values)
+            # Inverse variances of the state pixels only
+            return values, mask, inverse_variance(
+                self._calculate_uncertainty(values), mask, state_pixels)
+        layers = self._band_reader.map(read_layer, layers)
+        metadata = {'incidence_angle': layers[-1]}
+        return [SARdata(backscatter, R_mat, mask, metadata,
+                        self.emulators[polarisations[band]])
+                for (backscatter, mask, R_mat), band in zip(layers[:-1],
+                                                            bands)]
 
 
 if __name__ == "__main__":
@@ -1,18 +1,20 @@
 #!/usr/bin/env python
-import cPickle
 import datetime
 import glob
 import os
 import sys
 
 import numpy as np
-import scipy.sparse as sp # Required for unc
 import gdal
-import osr
-
 import xml.etree.ElementTree as ET
 from collections import namedtuple
 
+from .emulators import EmulatorRegistry
+from ..inference.utils import inverse_variance
+from .reprojection import ReprojectionCache
+from ..inference.state_grid import as_state_grid
+from ..pipeline import ThreadedMap
+
 def parse_xml(filename):
     """Parses the XML metadata file to extract view/incidence 
     angles. The file has grids and all sorts of stuff, but
@@ -46,37 +48,15 @@ def parse_xml(filename):
     return sza, saa, np.mean(vza), np.mean(vaa)
 
 
-def reproject_image(source_img, target_img, dstSRSs=None):
-    """Reprojects/Warps an image to fit exactly another image.
-    Additionally, you can set the destination SRS if you want
-    to or if it isn't defined in the source image."""
-    g = gdal.Open(target_img)
-    geo_t = g.GetGeoTransform()
-    x_size, y_size = g.RasterXSize, g.RasterYSize
-    xmin = min(geo_t[0], geo_t[0] + x_size * geo_t[1])
-    xmax = max(geo_t[0], geo_t[0] + x_size * geo_t[1])
-    ymin = min(geo_t[3], geo_t[3] + y_size * geo_t[5])
-    ymax = max(geo_t[3], geo_t[3] + y_size * geo_t[5])
-    xRes, yRes = abs(geo_t[1]), abs(geo_t[5])
-    if dstSRSs is None:
-        dstSRS = osr.SpatialReference()
-        raster_wkt = g.GetProjection()
-        dstSRS.ImportFromWkt(raster_wkt)
-    else:
-        dstSRS = dstSRSs
-    g = gdal.Warp('', source_img, format='MEM',
-                  outputBounds=[xmin, ymin, xmax, ymax], xRes=xRes, yRes=yRes,
-                  dstSRS=dstSRS)
-    if g is None:
-        raise ValueError("Something failed with GDAL!")
-    return g
-
-
 S2MSIdata = namedtuple('S2MSIdata',
                      'observations uncertainty mask metadata emulator')
 
 class Sentinel2Observations(object):
-    def __init__(self, parent_folder, emulator_folder, state_mask):
+    # `get_band_data` can read a window of the state grid
+    supports_window = True
+
+    def __init__(self, parent_folder, emulator_folder, state_mask,
+                 max_emulators=4, max_emulator_bytes=None, n_threads=4):
         if not os.path.exists(parent_folder):
             raise IOError("S2 data folder doesn't exist")
         self.parent = parent_folder
@@ -85,9 +65,31 @@ class Sentinel2Observations(object):
         self._find_granules(self.parent)
         self.band_map = ['02', '03', '04', '05', '06', '07',
                          '08', '8A', '09', '12']
-        emulators = glob.glob(os.path.join(self.emulator_folder, "*.pkl"))
-        emulators.sort()
-        self.emulator_files = emulators
+        self.emulator_band_map = [2, 3, 4, 5, 6, 7, 8, 9, 12, 13]
+        # Emulators are indexed once, and loaded once per geometry
+        self.emulators = EmulatorRegistry(self.emulator_folder,
+                                          max_loaded=max_emulators,
+                                          max_bytes=max_emulator_bytes)
+        self.emulator_files = self.emulators.files
+        self._metadata = {}
+        self._reprojection = None
+        # Bands are read and preprocessed in parallel
+        self._band_reader = ThreadedMap(n_threads)
+
+    def _get_reprojection(self):
+        """The `ReprojectionCache` onto the state grid (which also keeps its
+        `StateGrid`), made on first use"""
+        if self._reprojection is None:
+            self._reprojection = ReprojectionCache(self.state_mask)
+        return self._reprojection
+
+    def _get_state_pixels(self, window=None):
+        """The `StateGrid` of the state mask (or the boolean state mask of a
+        `window` of it)"""
+        state_grid = self._get_reprojection().state_grid
+        if window is None:
+            return state_grid
+        return state_grid.mask[window]
 
     def define_output(self):
         g = gdal.Open(self.state_mask)
@@ -117,52 +119,76 @@ class Sentinel2Observations(object):
 
 
     def _find_emulator(self, sza, saa, vza, vaa):
-        raa = vaa - saa
-        vzas = np.array([float(s.split("_")[-3]) 
-                         for s in self.emulator_files])
-        szas = np.array([float(s.split("_")[-2]) 
-                         for s in self.emulator_files])
-        raas = np.array([float(s.split("_")[-1].split(".")[0]) 
-                         for s in self.emulator_files])        
-        e1 = szas == szas[np.argmin(np.abs(szas - sza))]
-        e2 = vzas == vzas[np.argmin(np.abs(vzas - vza))]
-        e3 = raas == raas[np.argmin(np.abs(raas - raa))]
-        iloc = np.where(e1*e2*e3)[0][0]
-        return self.emulator_files[iloc]
-
-
-    def get_band_data(self, timestep, band):
-        
-        current_folder = self.date_data[timestep]
-
-        meta_file = os.path.join(current_folder, "metadata.xml")
-        sza, saa, vza, vaa = parse_xml(meta_file)
-        metadata = dict (zip(["sza", "saa", "vza", "vaa"],
-                            [sza, saa, vza, vaa]))
+        return self.emulators.find(sza, saa, vza, vaa)
+
+    def _get_metadata(self, timestep):
+        """Parses (once per date) the acquisition angles"""
+        if timestep not in self._metadata:
+            current_folder = self.date_data[timestep]
+            meta_file = os.path.join(current_folder, "metadata.xml")
+            sza, saa, vza, vaa = parse_xml(meta_file)
+            self._metadata[timestep] = dict(zip(["sza", "saa", "vza", "vaa"],
+                                                [sza, saa, vza, vaa]))
+        return self._metadata[timestep]
+
+    def _band_file(self, timestep, band):
+        return os.path.join(self.date_data[timestep],
+                            "B{}_sur.tif".format(self.band_map[band]))
+
+    def get_band_files(self, timestep, band):
+        """The files `band` on `timestep` is read from"""
+        return [self._band_file(timestep, band),
+                os.path.join(self.date_data[timestep], "metadata.xml")]
+
+    def get_band_emulator(self, timestep, band):
+        """The emulator of `band` for the acquisition geometry of
+        `timestep` (only the metadata file is read)"""
+        metadata = self._get_metadata(timestep)
+        emulator = self.emulators.get_emulator(metadata["sza"],
+                                               metadata["saa"],
+                                               metadata["vza"],
+                                               metadata["vaa"])
+        return emulator["S2A_MSI_{:02d}".format(self.emulator_band_map[band])]
+
+    def get_band_data(self, timestep, band, window=None):
+        """Returns the reflectance for `band` on `timestep`, reprojected to
+        the state grid (or to a `window` of it, given as a tuple of row and
+        column slices)."""
+        return self._read_bands(timestep, [band], window=window)[0]
+
+    def get_date_data(self, timestep, window=None):
+        """Returns the data of all the bands of `timestep` in band order,
+        as `get_band_data` would. The angles and the emulators are looked up
+        once for the date, and the reflectances of all the bands are read
+        (in a pool of `n_threads` threads) into one `(n_bands, rows, cols)`
+        array, that the band data share."""
+        return self._read_bands(timestep, range(len(self.band_map)),
+                                window=window)
+
+    def _read_bands(self, timestep, bands, window=None):
+        metadata = self._get_metadata(timestep).copy()
         # This should be really using EmulatorEngine...
-        emulator_file = self._find_emulator(sza, saa, vza, vaa)
-        emulator = cPickle.load(open (emulator_file, 'rb'))
-        
-        # Read and reproject S2 surface reflectance
-        the_band = self.band_map[band]
-        original_s2_file = os.path.join ( current_folder, 
-                                         "B{}_sur.tif".format(the_band))
-        print(original_s2_file)
-        g = reproject_image( original_s2_file, self.state_mask)
-        rho_surface = g.ReadAsArray()
-        mask = rho_surface > 0
-        rho_surface = np.where(mask, rho_surface/10000., 0)
-        # Read and reproject S2 angles
-        emulator_band_map = [2, 3, 4, 5, 6, 7, 8, 9, 12, 13]
-        
-        
-        R_mat = rho_surface*0.05
-        R_mat[np.logical_not(mask)] = 0.
-        N = mask.ravel().shape[0]
-        R_mat_sp = sp.lil_matrix((N, N))
-        R_mat_sp.setdiag(1./(R_mat.ravel())**2)
-        R_mat_sp = R_mat_sp.tocsr()
-        
-        s2data = S2MSIdata (rho_surface, R_mat_sp, mask, metadata, 
-                            emulator["S2A_MSI_{:02d}".format(emulator_band_map[band])])
-        return s2data
+        emulator = self.emulators.get_emulator(metadata["sza"],
+                                               metadata["saa"],
+                                               metadata["vza"],
+                                               metadata["vaa"])
+
+        # Read, reproject and preprocess the S2 surface reflectance of each
+        # band in a thread. Bands on the same grid share the mapping onto
+        # the state grid
+        reprojection = self._get_reprojection()
+        state_pixels = as_state_grid(self._get_state_pixels(window))
+
+        def read_band(band):
+            rho = reprojection.read(self._band_file(timestep, band),
+                                    window=window)
+            mask = rho > 0
+            rho = np.where(mask, rho/10000., 0).astype(np.float32)
+            # Inverse variances of the state pixels only
+            return rho, mask, inverse_variance(rho*0.05, mask, state_pixels)
+        rho_surface, mask, R_mat = [np.array(stack) for stack in zip(
+            *self._band_reader.map(read_band, bands))]
+        return [S2MSIdata(rho_surface[i], R_mat[i], mask[i], metadata,
+                          emulator["S2A_MSI_{:02d}".format(
+                              self.emulator_band_map[band])])
+                for i, band in enumerate(bands)]
@@ -1,5 +1,12 @@
-__all__ = ["observations", "Sentinel1_Observations", "Sentinel2_Observations"]
+__all__ = ["observations", "emulators", "prefetch", "reprojection",
+           "observation_cache", "Sentinel1_Observations",
+           "Sentinel2_Observations"]
 
 from .observations import *
+from .emulators import EmulatorRegistry, ArrayGaussianProcess, \
+    load_array_emulator, save_array_emulator
+from .prefetch import PrefetchingObservations, ParallelBandObservations
+from .reprojection import ReprojectionCache, reproject_image
+from .observation_cache import CachedObservations
 from .Sentinel1_Observations import S1Observations
 from .Sentinel2_Observations import Sentinel2Observations
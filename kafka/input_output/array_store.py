@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+A minimal on-disk container for a bunch of named arrays: a folder with one
+`.npy` file per array and a JSON file with (small) attributes. Arrays are
+loaded memory-mapped and read-only, so several processes reading the same
+container share a single copy in the page cache.
+"""
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+ATTRIBUTES_FILE = "attributes.json"
+
+
+def save_arrays(folder, arrays, attributes=None):
+    """Saves the dictionary `arrays` (names to numpy arrays) and the JSON
+    serialisable dictionary `attributes` in `folder`. The container is
+    written to a temporary folder first and then moved in place, so readers
+    never see a half written container."""
+    folder = os.path.normpath(folder)
+    tmp_folder = "{}.tmp{:d}.{:d}".format(folder, os.getpid(),
+                                          threading.current_thread().ident)
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_folder, name + ".npy"),
+                np.ascontiguousarray(array))
+    with open(os.path.join(tmp_folder, ATTRIBUTES_FILE), 'w') as fp:
+        json.dump(attributes or {}, fp)
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.rename(tmp_folder, folder)
+
+
+def load_arrays(folder, mmap_mode='r'):
+    """Loads a container written by `save_arrays`. Returns a dictionary of
+    (memory-mapped, unless `mmap_mode` is `None`) arrays and the attributes
+    dictionary."""
+    if not os.path.isdir(folder):
+        raise IOError("{} is not an array container".format(folder))
+    with open(os.path.join(folder, ATTRIBUTES_FILE), 'r') as fp:
+        attributes = json.load(fp)
+    arrays = {}
+    for fname in os.listdir(folder):
+        if fname.endswith(".npy"):
+            arrays[fname[:-4]] = np.load(os.path.join(folder, fname),
+                                         mmap_mode=mmap_mode)
+    return arrays, attributes
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""
+An emulator registry: indexes a folder of emulator files by acquisition
+geometry once, and keeps the most recently used emulators in memory.
+
+Emulators can be stored either as pickles, or in a compact array format
+(a folder with an `.emu` extension, see `save_array_emulator`), which is
+memory-mapped on load. Pickles can be converted with::
+
+    python -m kafka.input_output.emulators emulator_1.pkl [emulator_2.pkl ...]
+"""
+import cPickle
+import glob
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from scipy.spatial.distance import cdist
+
+from .array_store import load_arrays, save_arrays
+
+LOG = logging.getLogger(__name__)
+
+ARRAY_EMULATOR_EXTENSION = ".emu"
+
+
+class ArrayGaussianProcess(object):
+    """A Gaussian Process emulator that only holds the arrays needed for
+    prediction: the training inputs, the (log) hyperparameters `theta` and
+    the precomputed `invQt` (and optionally `invQ`, needed for predictive
+    uncertainties). It gives the same predictions as the pickled
+    `gp_emulator.GaussianProcess` objects it is converted from, and the
+    arrays can be memory-mapped."""
+    def __init__(self, inputs, theta, invQt, invQ=None):
+        self.inputs = inputs
+        self.theta = theta
+        self.invQt = invQt
+        self.invQ = invQ
+        self.D = inputs.shape[1]
+
+    def predict(self, testing, do_deriv=True, do_unc=True):
+        """Predicts the emulator output and its gradient for the rows of
+        `testing`. Returns `(mu, deriv)` if `do_unc` is `False`, and
+        `(mu, var, deriv)` otherwise. `deriv` is `None` if `do_deriv` is
+        `False`."""
+        testing = np.atleast_2d(testing)
+        if testing.shape[1] != self.D:
+            raise ValueError("Expected {:d} input dimensions, got {:d}".format(
+                self.D, testing.shape[1]))
+        expX = np.exp(self.theta)
+        scale = np.sqrt(expX[:self.D])
+        a = cdist(scale*self.inputs, scale*testing, 'sqeuclidean')
+        a = expX[self.D]*np.exp(-0.5*a)
+        # Weights for each training point and test location
+        w = a.T*self.invQt
+        mu = w.sum(axis=1)
+        deriv = None
+        if do_deriv:
+            deriv = expX[:self.D]*(w.dot(self.inputs) - testing*mu[:, None])
+        if do_unc:
+            if self.invQ is None:
+                raise ValueError("This emulator was stored without invQ, " +
+                                 "so it can't predict uncertainties")
+            var = expX[self.D] - np.sum(a*np.dot(self.invQ, a), axis=0)
+            return mu, var, deriv
+        return mu, deriv
+
+
+def _gp_arrays(gp, with_invQ=True):
+    """Extracts the arrays needed for prediction from a GP object"""
+    if isinstance(gp, ArrayGaussianProcess):
+        arrays = {"inputs": gp.inputs, "theta": gp.theta, "invQt": gp.invQt}
+        if with_invQ and gp.invQ is not None:
+            arrays["invQ"] = gp.invQ
+        return arrays
+    if not hasattr(gp, "inputs") or not hasattr(gp, "theta"):
+        raise ValueError("Don't know how to convert a {} emulator".format(
+            type(gp).__name__))
+    if not hasattr(gp, "invQt"):
+        gp._prepare_likelihood()
+    arrays = {"inputs": np.asarray(gp.inputs, dtype=np.float64),
+              "theta": np.asarray(gp.theta, dtype=np.float64),
+              "invQt": np.asarray(gp.invQt, dtype=np.float64)}
+    if with_invQ:
+        arrays["invQ"] = np.asarray(gp.invQ, dtype=np.float64)
+    return arrays
+
+
+def save_array_emulator(emulator, folder, with_invQ=True):
+    """Saves a GP emulator, or a dictionary of GP emulators (e.g. one per
+    band), in the array format. `invQ` is by far the largest array, and it's
+    only needed for predictive uncertainties, so it can be left out with
+    `with_invQ=False`."""
+    if isinstance(emulator, dict):
+        keys = list(emulator.keys())
+        gps = [emulator[key] for key in keys]
+    else:
+        keys, gps = None, [emulator]
+    arrays = {}
+    for i, gp in enumerate(gps):
+        for name, array in _gp_arrays(gp, with_invQ=with_invQ).items():
+            arrays["{:d}.{}".format(i, name)] = array
+    save_arrays(folder, arrays, {"keys": keys, "n_emulators": len(gps)})
+
+
+def load_array_emulator(folder, mmap_mode='r'):
+    """Loads an emulator (or dictionary of emulators) saved with
+    `save_array_emulator`. Arrays are memory-mapped by default."""
+    arrays, attributes = load_arrays(folder, mmap_mode=mmap_mode)
+    gps = [ArrayGaussianProcess(arrays["{:d}.inputs".format(i)],
+                                arrays["{:d}.theta".format(i)],
+                                arrays["{:d}.invQt".format(i)],
+                                arrays.get("{:d}.invQ".format(i)))
+           for i in xrange(attributes["n_emulators"])]
+    keys = attributes["keys"]
+    if keys is None:
+        return gps[0]
+    # JSON turns tuple keys into lists
+    keys = [tuple(key) if isinstance(key, list) else key for key in keys]
+    return dict(zip(keys, gps))
+
+
+def load_emulator_file(fname):
+    """Loads an emulator (or a dictionary of emulators) from disk, either
+    from an array format folder or a pickle"""
+    if os.path.isdir(fname):
+        return load_array_emulator(fname)
+    with open(fname, 'rb') as fp:
+        return cPickle.load(fp)
+
+
+def convert_emulator_file(fname, folder=None, with_invQ=True):
+    """Converts a pickled emulator to the array format. The output folder
+    defaults to the pickle filename with an `.emu` extension."""
+    if folder is None:
+        folder = os.path.splitext(fname)[0] + ARRAY_EMULATOR_EXTENSION
+    save_array_emulator(load_emulator_file(fname), folder,
+                        with_invQ=with_invQ)
+    return folder
+
+
+def _file_size(fname):
+    if os.path.isdir(fname):
+        return sum(os.path.getsize(os.path.join(fname, f))
+                   for f in os.listdir(fname))
+    return os.path.getsize(fname)
+
+
+def _set_cache_keys(emulator, fname):
+    """Sets the `cache_key` of the emulator loaded from `fname` (or of each
+    emulator of a dictionary of them), so that an `EmulatorCache` finds its
+    entries again after the emulator is dropped and loaded again"""
+    if isinstance(emulator, dict):
+        emulators = [((fname, key), gp) for key, gp in emulator.items()]
+    else:
+        emulators = [(fname, emulator)]
+    for key, gp in emulators:
+        if hasattr(gp, "predict"):
+            try:
+                gp.cache_key = key
+            except AttributeError:
+                LOG.debug("Can't set the cache key of {}".format(key))
+
+
+class _PendingLoad(object):
+    """An emulator that one thread is loading, and others wait for"""
+    def __init__(self):
+        self._done = threading.Event()
+        self._emulator = None
+        self._error = None
+
+    def set_result(self, emulator):
+        self._emulator = emulator
+        self._done.set()
+
+    def set_error(self, error):
+        self._error = error
+        self._done.set()
+
+    def result(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._emulator
+
+
+class EmulatorRegistry(object):
+    """A registry of emulators stored in `folder`. The emulator filenames end
+    in `_<vza>_<sza>_<raa>.<ext>`, and are parsed only once, when the
+    registry is created. If an emulator is available both as a pickle and in
+    the array format, the array format is used. Emulators are loaded lazily
+    the first time they are requested, and kept in an LRU of at most
+    `max_loaded` emulators and `max_bytes` (measured as their file size on
+    disk). The most recently used emulator is always kept, even if it is
+    bigger than `max_bytes`. The number of emulators loaded so far is kept
+    in `n_loads`. Loaded emulators get a `cache_key` attribute, with the
+    filename (and the key of each emulator, for dictionaries of them), see
+    `EmulatorCache`.
+
+    The registry can be used from several threads. Emulators are loaded
+    without holding the registry lock, so a slow load doesn't hold up
+    threads that want other emulators, and threads that want an emulator
+    that is being loaded wait for that load rather than starting another.
+    """
+    def __init__(self, folder, pattern=("*" + ARRAY_EMULATOR_EXTENSION,
+                                        "*.pkl"),
+                 max_loaded=4, max_bytes=None, loader=load_emulator_file):
+        self.folder = folder
+        if isinstance(pattern, basestring):
+            pattern = [pattern]
+        files = {}
+        for this_pattern in pattern:
+            for fname in glob.glob(os.path.join(folder, this_pattern)):
+                files.setdefault(os.path.splitext(fname)[0], fname)
+        self.files = sorted(files.values())
+        if len(self.files) == 0:
+            LOG.warning("No emulators found in {}".format(folder))
+        self.vzas = np.array([float(s.split("_")[-3]) for s in self.files])
+        self.szas = np.array([float(s.split("_")[-2]) for s in self.files])
+        self.raas = np.array([float(s.split("_")[-1].split(".")[0])
+                              for s in self.files])
+        self.max_loaded = max_loaded
+        self.max_bytes = max_bytes
+        self.n_loads = 0
+        self._loader = loader
+        self._loaded = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def find(self, sza, saa, vza, vaa):
+        """Returns the filename of the emulator closest to the given angles"""
+        raa = vaa - saa
+        szas, vzas, raas = self.szas, self.vzas, self.raas
+        e1 = szas == szas[np.argmin(np.abs(szas - sza))]
+        e2 = vzas == vzas[np.argmin(np.abs(vzas - vza))]
+        e3 = raas == raas[np.argmin(np.abs(raas - raa))]
+        iloc = np.where(e1*e2*e3)[0][0]
+        return self.files[iloc]
+
+    def get(self, fname):
+        """Returns the emulator stored in `fname`, loading it if needed"""
+        with self._lock:
+            if fname in self._loaded:
+                # Most recently used goes last
+                self._loaded[fname] = self._loaded.pop(fname)
+                return self._loaded[fname][0]
+            pending = self._loading.get(fname)
+            if pending is None:
+                pending = _PendingLoad()
+                self._loading[fname] = pending
+                is_loader = True
+            else:
+                is_loader = False
+        if not is_loader:
+            # Another thread is loading it
+            return pending.result()
+        try:
+            LOG.info("Loading emulator {}".format(fname))
+            emulator = self._loader(fname)
+            _set_cache_keys(emulator, fname)
+            size = _file_size(fname)
+        except Exception as error:
+            with self._lock:
+                del self._loading[fname]
+            pending.set_error(error)
+            raise
+        with self._lock:
+            self.n_loads += 1
+            self._loaded[fname] = (emulator, size)
+            self._evict()
+            del self._loading[fname]
+        pending.set_result(emulator)
+        return emulator
+
+    def get_emulator(self, sza, saa, vza, vaa):
+        """Returns the emulator closest to the given angles"""
+        return self.get(self.find(sza, saa, vza, vaa))
+
+    def _evict(self):
+        while len(self._loaded) > 1:
+            n_bytes = sum(size for _, size in self._loaded.values())
+            if len(self._loaded) > self.max_loaded or (
+                    self.max_bytes is not None and n_bytes > self.max_bytes):
+                fname, _ = self._loaded.popitem(last=False)
+                LOG.info("Dropping emulator {}".format(fname))
+            else:
+                break
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for fname in sys.argv[1:]:
+        LOG.info("{} -> {}".format(fname, convert_emulator_file(fname)))
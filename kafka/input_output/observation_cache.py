@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""
+An on-disk cache of preprocessed observations. The band data returned by a
+reader's `get_band_data` (reflectance, inverse variances, mask and the
+per-date metadata) are stored compressed to the state pixels, in an array
+container (see `array_store`) per date and band. Re-running the same tile
+(e.g. with different priors or model errors) then loads the memory-mapped
+arrays, and doesn't open any of the products with GDAL.
+
+Entries are keyed by the product files of the band (with their modification
+times and sizes), the band, and a hash of the state mask, so changing any of
+them reads the products again.
+"""
+import datetime
+import hashlib
+import logging
+import os
+from collections import namedtuple
+
+import gdal
+
+import numpy as np
+
+from .array_store import load_arrays, save_arrays
+from ..inference.state_grid import as_state_grid
+from ..inference.utils import inverse_variance_vector
+
+LOG = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+
+def state_grid_hash(state_mask):
+    """A hash of the shape and the pixels of a state mask"""
+    mask = np.asarray(state_mask, dtype=bool)
+    digest = hashlib.sha1(repr(mask.shape).encode("ascii"))
+    digest.update(np.packbits(mask).tobytes())
+    return digest.hexdigest()
+
+
+def _file_signature(fname):
+    """The name, modification time and size of a product file. GDAL
+    subdatasets (e.g. `NETCDF:"file.nc":layer`) are traced back to the file
+    they are in."""
+    path = fname
+    if not os.path.exists(path) and '"' in fname:
+        path = fname.split('"')[1]
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_mtime, stat.st_size]
+
+
+def _band_data_type(module, name, fields):
+    """The namedtuple class of the band data, or an equivalent one if it
+    can't be imported"""
+    try:
+        band_type = getattr(__import__(module, fromlist=[name]), name)
+        if tuple(band_type._fields) == tuple(fields):
+            return band_type
+    except (ImportError, AttributeError):
+        pass
+    return namedtuple(str(name), [str(field) for field in fields])
+
+
+class CachedObservations(object):
+    """Caches the preprocessed band data of `observations` in
+    `cache_folder`. The first time a band of a date is asked for, it's read
+    from the wrapped observations and stored; after that (in this or later
+    runs) it's loaded from the cache.
+
+    The band data are stored compressed to the state pixels: image fields
+    (and image metadata, e.g. the incidence angle) are put back on the grid
+    on load, with zeros (or `False`) outside the state mask, and the
+    uncertainty is returned as the vector of inverse variances of the state
+    pixels. Scalar metadata are stored as they are. Emulators aren't stored,
+    but taken from the wrapped observations' `get_band_emulator(timestep,
+    band)`, which mustn't need to read the products. Bands with fields that
+    can't be stored are read directly every time.
+
+    The wrapped observations should have a `get_band_files(timestep, band)`
+    method, with the files each band is read from. Without it, the cache
+    can't tell if the products change, and entries are only keyed on the
+    date, band and state mask.
+
+    Any other attribute is taken from the wrapped observations.
+
+    Parameters
+    -----------
+    observations: object
+        The observations to cache
+    cache_folder: str
+        Folder where the cache lives. It's created if needed
+    state_mask: array
+        The state mask (or `StateGrid`, or a GDAL-readable raster of it). If
+        `None`, the `state_mask` of the observations is used
+    """
+    def __init__(self, observations, cache_folder, state_mask=None):
+        self.observations = observations
+        self.cache_folder = cache_folder
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        if state_mask is None:
+            state_mask = getattr(observations, "state_mask", None)
+        if state_mask is None:
+            raise ValueError("The observation cache needs a state mask")
+        if isinstance(state_mask, basestring):
+            g = gdal.Open(state_mask)
+            if g is None:
+                raise IOError("Can't open the state mask {}".format(
+                    state_mask))
+            state_mask = g.ReadAsArray()
+        self.state_grid = as_state_grid(state_mask)
+        self._grid_hash = state_grid_hash(self.state_grid)
+        self.n_hits = 0
+        self.n_misses = 0
+        if not hasattr(observations, "get_band_files"):
+            LOG.warning("The observations don't say which files they read, "
+                        "so cached bands won't be refreshed if they change")
+
+    def _entry_folder(self, timestep, band):
+        """The folder of the cache entry of `band` on `timestep`"""
+        if hasattr(self.observations, "get_band_files"):
+            files = [_file_signature(fname) for fname in
+                     self.observations.get_band_files(timestep, band)]
+        else:
+            files = []
+        key = repr([CACHE_VERSION, type(self.observations).__name__,
+                    str(timestep), band, files, self._grid_hash])
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        if isinstance(timestep, datetime.datetime):
+            prefix = timestep.strftime("%Y%m%dT%H%M%S")
+        else:
+            prefix = str(timestep)
+        return os.path.join(self.cache_folder, "{}_b{}_{}".format(
+            prefix, band, digest[:20]))
+
+    def get_band_data(self, timestep, band, window=None):
+        """Returns the band data of `band` on `timestep`, from the cache if
+        possible (on the state grid, or on a `window` of it)"""
+        folder = self._entry_folder(timestep, band)
+        if os.path.isdir(folder):
+            data = self._load(folder, timestep, band)
+            self.n_hits += 1
+        else:
+            self.n_misses += 1
+            data = self.observations.get_band_data(timestep, band)
+            if data is not None:
+                self._store(folder, data)
+        if data is None or window is None:
+            return data
+        return self._crop(data, window)
+
+    def get_date_data(self, timestep, window=None):
+        """Returns the band data of all the bands of `timestep`. If any band
+        isn't cached and the wrapped observations read whole dates, the
+        date is read at once, and the bands that weren't cached are stored
+        (the others are still loaded from the cache)."""
+        n_bands = self.observations.bands_per_observation[timestep]
+        folders = [self._entry_folder(timestep, band)
+                   for band in xrange(n_bands)]
+        cached = [os.path.isdir(folder) for folder in folders]
+        if hasattr(self.observations, "get_date_data") and not all(cached):
+            date_data = list(self.observations.get_date_data(timestep))
+            for band, folder in enumerate(folders):
+                if cached[band]:
+                    date_data[band] = self._load(folder, timestep, band)
+                    self.n_hits += 1
+                else:
+                    self.n_misses += 1
+                    if date_data[band] is not None:
+                        self._store(folder, date_data[band])
+        else:
+            date_data = [self.get_band_data(timestep, band)
+                         for band in xrange(n_bands)]
+        if window is None:
+            return date_data
+        return [data if data is None else self._crop(data, window)
+                for data in date_data]
+
+    def _store(self, folder, data):
+        """Stores `data` in `folder`, compressed to the state pixels. Bands
+        that can't be stored are left out of the cache."""
+        arrays = {}
+        fields = {}
+        for field, value in zip(data._fields, data):
+            if field == "uncertainty" and value is not None:
+                arrays[field] = inverse_variance_vector(value,
+                                                        self.state_grid)
+                fields[field] = "array"
+            elif field == "metadata" and isinstance(value, dict):
+                metadata = {}
+                for key, item in value.items():
+                    kind = self._pack(item, "metadata." + key, arrays)
+                    if kind is None:
+                        LOG.debug("Can't cache metadata %s", key)
+                        return
+                    metadata[key] = kind
+                fields[field] = {"metadata": metadata}
+            elif field == "emulator" and \
+                    hasattr(self.observations, "get_band_emulator"):
+                fields[field] = "emulator"
+            else:
+                kind = self._pack(value, field, arrays)
+                if kind is None:
+                    LOG.debug("Can't cache the %s of the band data", field)
+                    return
+                fields[field] = kind
+        attributes = {"type": [type(data).__module__, type(data).__name__],
+                      "order": list(data._fields), "fields": fields}
+        try:
+            save_arrays(folder, arrays, attributes)
+        except (IOError, OSError) as error:
+            # Another process may have just written the same entry
+            LOG.warning("Couldn't cache %s: %s", folder, error)
+
+    def _pack(self, value, name, arrays):
+        """Adds `value` to `arrays` (as `name`) if it's an array, and returns
+        how it's stored: "grid" (compressed to the state pixels), "array",
+        `["value", value]` for scalars, or `None` if it can't be stored"""
+        if value is None:
+            return ["value", None]
+        if isinstance(value, (bool, int, long, float, basestring)):
+            return ["value", value]
+        if isinstance(value, np.generic):
+            return ["value", value.item()]
+        if isinstance(value, np.ndarray):
+            if value.shape[-2:] == self.state_grid.shape:
+                arrays[name] = self.state_grid.gather(value)
+                return "grid"
+            arrays[name] = value
+            return "array"
+        return None
+
+    def _unpack(self, kind, name, arrays):
+        if kind == "grid":
+            return self.state_grid.scatter(arrays[name])
+        if kind == "array":
+            return arrays[name]
+        return kind[1]
+
+    def _load(self, folder, timestep, band):
+        arrays, attributes = load_arrays(folder)
+        values = {}
+        for field, kind in attributes["fields"].items():
+            if kind == "emulator":
+                values[field] = self.observations.get_band_emulator(
+                    timestep, band)
+            elif isinstance(kind, dict):
+                values[field] = dict(
+                    (str(key), self._unpack(item, "metadata." + key,
+                                            arrays))
+                    for key, item in kind["metadata"].items())
+            else:
+                values[field] = self._unpack(kind, field, arrays)
+        band_type = _band_data_type(attributes["type"][0],
+                                    attributes["type"][1],
+                                    attributes["order"])
+        return band_type(*[values[field] for field in attributes["order"]])
+
+    def _crop(self, data, window):
+        """The band data of a `window` of the state grid"""
+        window_pixels = self.state_grid.crop(window)
+
+        def crop(value):
+            if isinstance(value, np.ndarray) and \
+                    value.shape[-2:] == self.state_grid.shape:
+                return value[(Ellipsis,) + tuple(window)]
+            return value
+        values = {}
+        for field, value in zip(data._fields, data):
+            if field == "uncertainty" and value is not None:
+                image = self.state_grid.scatter(
+                    inverse_variance_vector(value, self.state_grid))
+                values[field] = window_pixels.gather(image[window])
+            elif field == "metadata" and isinstance(value, dict):
+                values[field] = dict((key, crop(item))
+                                     for key, item in value.items())
+            else:
+                values[field] = crop(value)
+        return data._replace(**values)
+
+    def __getattr__(self, name):
+        if name in ["observations", "state_grid"]:
+            # Not set yet (e.g. while unpickling)
+            raise AttributeError(name)
+        return getattr(self.observations, name)
@@ -39,7 +39,6 @@ MCD43A1/2 -> See BRDF_descriptors!
 
 """
 
-import cPickle
 import datetime
 import glob
 import os
@@ -56,6 +55,11 @@ from BRDF_descriptors import RetrieveBRDFDescriptors
 import scipy.sparse as sp
 from scipy.ndimage import zoom
 
+from .emulators import load_emulator_file
+from ..inference.state_grid import as_state_grid
+from ..inference.utils import marginal_uncertainty, inverse_variance
+from ..pipeline import BackgroundWorker
+
 os.environ['HDF5_DISABLE_VERSION_CHECK'] = '1'
 
 __author__ = "J Gomez-Dans"
@@ -212,7 +216,7 @@ class SynergyKernels(object):
 class BHRObservations(RetrieveBRDFDescriptors):
     def __init__(self, emulator, tile, mcd43a1_dir,
                  start_time, ulx=0, uly=0, dx=2400, dy=2400, end_time=None,
-                 mcd43a2_dir=None):
+                 mcd43a2_dir=None, state_mask=None):
         """The class needs to locate the data granules. We assume that
         these are available somewhere in the filesystem and that we can
         index them by location (MODIS tile name e.g. "h19v10") and
@@ -221,7 +225,9 @@ class BHRObservations(RetrieveBRDFDescriptors):
         in the same folder. We also need a starting date (either a
         datetime object, or a string in "%Y-%m-%d" or "%Y%j" format. If
         the end time is not specified, it will be set to the date of the
-        latest granule found."""
+        latest granule found. If the boolean `state_mask` of the cropped
+        grid is given, the uncertainties are only returned for its pixels
+        (otherwise, as an image of inverse variances)."""
 
         # Call the constructor first
         # Python2
@@ -251,6 +257,7 @@ class BHRObservations(RetrieveBRDFDescriptors):
         self.uly = uly
         self.dx = dx
         self.dy = dy
+        self.state_mask = state_mask
 
     def define_output(self):
         reference_fname = self.a1_granules[self.dates[0]]
@@ -267,8 +274,15 @@ class BHRObservations(RetrieveBRDFDescriptors):
     def _get_emulator(self, emulator):
         if not os.path.exists(emulator):
             raise IOError("The emulator {} doesn't exist!".format(emulator))
-        # Assuming emulator is in an pickle file...
-        self.emulator = cPickle.load(open(emulator, 'rb'))
+        # Either a pickle file or an array format folder
+        self.emulator = load_emulator_file(emulator)
+
+    def get_band_files(self, the_date, band_no):
+        """The MCD43A1 and A2 granules a band is read from"""
+        return [self.a1_granules[the_date], self.a2_granules[the_date]]
+
+    def get_band_emulator(self, the_date, band_no):
+        return self.emulator
 
     def get_band_data(self, the_date, band_no):
 
@@ -289,13 +303,9 @@ class BHRObservations(RetrieveBRDFDescriptors):
 
         R_mat[qa_level == 0] = np.maximum(2.5e-3, bhr[qa_level == 0] * 0.05)
         R_mat[qa_level == 1] = np.maximum(2.5e-3, bhr[qa_level == 1] * 0.07)
-        R_mat[np.logical_not(mask)] = 0.
-        N = mask.ravel().shape[0]
-        R_mat_sp = sp.lil_matrix((N, N))
-        R_mat_sp.setdiag(1./(R_mat.ravel())**2)
-        R_mat_sp = R_mat_sp.tocsr()
+        R_mat = inverse_variance(R_mat, mask, self.state_mask)
 
-        bhr_data = BHR_data(bhr, mask, R_mat_sp, None, self.emulator)
+        bhr_data = BHR_data(bhr, mask, R_mat, None, self.emulator)
         return bhr_data
 
     
@@ -316,7 +326,7 @@ class BHRObservationsTest(object):
     
     def get_band_data(self, the_date, band_no):
         bhr = self.dates[the_date][band_no]
-        mask = np.array(1, dtype=np.bool)
+        mask = np.array(1, dtype=bool)
         R_mat = 1./(np.maximum(2.5e-3, bhr * 0.05))**2
         
     
@@ -324,48 +334,194 @@ class BHRObservationsTest(object):
 
 class KafkaOutput(object):
     """A very simple class to output the state."""
+    creation_options = ['COMPRESS=DEFLATE', 'BIGTIFF=YES', 'PREDICTOR=1',
+                        'TILED=YES']
+
     def __init__(self, parameter_list, geotransform, projection, folder,
-                 fmt="GTiff"):
+                 fmt="GTiff", exact_uncertainty=False):
         """The inference engine works on tiles, so we get the tilewidth
         (we assume the tiles are square), the GDAL-friendly geotransform
         and projection, as well as the destination directory and the
-        format (as a string that GDAL can understand)."""
+        format (as a string that GDAL can understand). With
+        `exact_uncertainty`, the reported uncertainties are the exact
+        marginal standard deviations (see `marginal_uncertainty`), rather
+        than the inverse square root of the diagonal of the Hessian."""
         self.geotransform = geotransform
         self.projection = projection
         self.folder = folder
         self.fmt = fmt
         self.parameter_list = parameter_list
+        self.exact_uncertainty = exact_uncertainty
+
+    def _uncertainty(self, P_analysis_inv, n_params):
+        """Per-parameter standard deviations, in state vector order"""
+        if self.exact_uncertainty:
+            return marginal_uncertainty(P_analysis_inv, n_params)
+        return 1./np.sqrt(P_analysis_inv.diagonal())
+
+    def _open_raster(self, fname, shape, n_bands, create):
+        """Creates a `shape` raster for the whole grid, or opens an existing
+        one to update it"""
+        if not create:
+            dst_ds = gdal.Open(fname, gdal.GA_Update)
+            if dst_ds is None:
+                raise IOError("Can't update {}".format(fname))
+            return dst_ds
+        drv = gdal.GetDriverByName(self.fmt)
+        dst_ds = drv.Create(fname, shape[1], shape[0], n_bands,
+                            gdal.GDT_Float32, self.creation_options)
+        dst_ds.SetProjection(self.projection)
+        dst_ds.SetGeoTransform(self.geotransform)
+        return dst_ds
 
     def dump_data(self, timestep, x_analysis, P_analysis, P_analysis_inv,
                   state_mask, n_params):
-        drv = gdal.GetDriverByName(self.fmt)
-        for ii, param in enumerate(self.parameter_list):
-            fname = os.path.join(self.folder, "%s_%s.tif" %
-                                 (param, timestep.strftime("A%Y%j")))
-            dst_ds = drv.Create(fname, state_mask.shape[1],
-                                state_mask.shape[0], 1,
-                                gdal.GDT_Float32, ['COMPRESS=DEFLATE',
-                                                   'BIGTIFF=YES',
-                                                   'PREDICTOR=1', 'TILED=YES'])
+        state_grid = as_state_grid(state_mask)
+        self.dump_window(timestep, None, x_analysis, P_analysis,
+                         P_analysis_inv, state_grid, n_params, create=True)
+
+    def dump_window(self, timestep, window, x_analysis, P_analysis,
+                    P_analysis_inv, state_mask, n_params, create=False):
+        """Writes the analysis of the state pixels in `window` (a tuple of
+        row and column slices, or `None` for the whole grid) of the grid of
+        `state_mask`. With `create`, the files of `timestep` are created for
+        the whole grid first; otherwise, they are updated. `TiledKalman`
+        uses this to write each chunk as soon as it's done."""
+        state_grid = as_state_grid(state_mask)
+        window_grid = state_grid if window is None else \
+            state_grid.crop(window)
+        offset = (0, 0) if window is None else \
+            (window[1].start, window[0].start)
+        unc = self._uncertainty(P_analysis_inv, n_params)
+        for values, suffix in [(x_analysis, ""), (unc, "_unc")]:
+            for ii, param in enumerate(self.parameter_list):
+                fname = os.path.join(self.folder, "%s_%s%s.tif" % (
+                    param, timestep.strftime("A%Y%j"), suffix))
+                dst_ds = self._open_raster(fname, state_grid.shape, 1,
+                                           create)
+                A = window_grid.scatter(
+                    window_grid.parameter(values, n_params, ii),
+                    dtype=np.float32)
+                dst_ds.GetRasterBand(1).WriteArray(A, *offset)
+                dst_ds = None
+
+
+class KafkaMultibandOutput(KafkaOutput):
+    """Writes one multi-band GeoTIFF per timestep with the analysis means
+    (`<prefix>_A%Y%j.tif`) and one with the uncertainties
+    (`<prefix>_A%Y%j_unc.tif`), one band per parameter, named after it.
+    Compression is DEFLATE with the floating point predictor, using all the
+    cores. With `cog=True`, Cloud Optimized GeoTIFFs are written (needs
+    GDAL >= 3.1).
+
+    `dump_data` only extracts the means and the uncertainties from the
+    analysis, and hands them to a background thread that does the writing
+    (with at most `max_queue` timesteps waiting), so the filter doesn't wait
+    for the compression. Call `flush` to wait for the files to be written,
+    or `close` to also stop the thread (`LinearKalman.run` does so at the
+    end, and so does leaving a `with` block). A closed output can still be
+    written to, which starts a new thread."""
+    creation_options = ['COMPRESS=DEFLATE', 'PREDICTOR=3', 'TILED=YES',
+                        'BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+    cog_options = ['COMPRESS=DEFLATE', 'PREDICTOR=YES', 'BIGTIFF=IF_SAFER',
+                   'NUM_THREADS=ALL_CPUS']
+
+    def __init__(self, parameter_list, geotransform, projection, folder,
+                 prefix="kafka", cog=False, max_queue=2,
+                 exact_uncertainty=False):
+        super(KafkaMultibandOutput, self).__init__(
+            parameter_list, geotransform, projection, folder,
+            exact_uncertainty=exact_uncertainty)
+        if cog and gdal.GetDriverByName("COG") is None:
+            raise ValueError("Cloud Optimized GeoTIFFs need GDAL >= 3.1")
+        self.prefix = prefix
+        self.cog = cog
+        self.max_queue = max_queue
+        self._writer = None
+
+    def dump_data(self, timestep, x_analysis, P_analysis, P_analysis_inv,
+                  state_mask, n_params):
+        self.dump_window(timestep, None, x_analysis, P_analysis,
+                         P_analysis_inv, state_mask, n_params, create=True)
+
+    def dump_window(self, timestep, window, x_analysis, P_analysis,
+                    P_analysis_inv, state_mask, n_params, create=False):
+        """Queues the analysis of the state pixels in `window` for writing
+        (see `KafkaOutput.dump_window`). Cloud Optimized GeoTIFFs can't be
+        updated, so they can only be written for the whole grid."""
+        if self.cog and window is not None:
+            raise ValueError("Cloud Optimized GeoTIFFs can't be written " +
+                             "one window at a time")
+        mean = x_analysis.reshape((-1, n_params)).astype(np.float32)
+        unc = self._uncertainty(P_analysis_inv, n_params).reshape(
+            (-1, n_params))
+        if self._writer is None:
+            self._writer = BackgroundWorker(self._write_timestep,
+                                            max_queue=self.max_queue,
+                                            name="geotiff")
+        self._writer.submit(timestep, mean, unc.astype(np.float32),
+                            state_mask, window, create)
+
+    def flush(self):
+        """Waits for all the queued timesteps to be written"""
+        if self._writer is not None:
+            self._writer.flush()
+
+    def close(self):
+        """Waits for all the queued timesteps to be written, and stops the
+        writer thread"""
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_timestep(self, timestep, mean, unc, state_mask, window=None,
+                        create=True):
+        fname = os.path.join(self.folder, "%s_%s" % (
+            self.prefix, timestep.strftime("A%Y%j")))
+        self._write_stack(fname + ".tif", mean, state_mask, window, create)
+        self._write_stack(fname + "_unc.tif", unc, state_mask, window,
+                          create)
+
+    def _write_stack(self, fname, values, state_mask, window=None,
+                     create=True):
+        """Writes the per-pixel `values` (one column per parameter) of the
+        state pixels in `window` as a multi-band raster, one band at a
+        time"""
+        state_grid = as_state_grid(state_mask)
+        window_grid = state_grid if window is None else \
+            state_grid.crop(window)
+        offset = (0, 0) if window is None else \
+            (window[1].start, window[0].start)
+        n_bands = values.shape[1]
+        if self.cog:
+            ny, nx = state_grid.shape
+            dst_ds = gdal.GetDriverByName("MEM").Create(
+                "", nx, ny, n_bands, gdal.GDT_Float32)
             dst_ds.SetProjection(self.projection)
             dst_ds.SetGeoTransform(self.geotransform)
-            A = np.zeros(state_mask.shape, dtype=np.float32)
-            A[state_mask] = x_analysis[ii::n_params]
-            dst_ds.GetRasterBand(1).WriteArray(A)
+        else:
+            dst_ds = self._open_raster(fname, state_grid.shape, n_bands,
+                                       create)
+        A = np.zeros(window_grid.shape, dtype=np.float32)
         for ii, param in enumerate(self.parameter_list):
-            fname = os.path.join(self.folder, "%s_%s_unc.tif" %
-                                 (param, timestep.strftime("A%Y%j")))
-            dst_ds = drv.Create(fname, state_mask.shape[1],
-                                state_mask.shape[0], 1,
-                                gdal.GDT_Float32, ['COMPRESS=DEFLATE',
-                                                   'BIGTIFF=YES',
-                                                   'PREDICTOR=1', 'TILED=YES'])
-            dst_ds.SetProjection(self.projection)
-            dst_ds.SetGeoTransform(self.geotransform)
-            A = np.zeros(state_mask.shape, dtype=np.float32)
-            A[state_mask] = 1./np.sqrt(P_analysis_inv.diagonal()[ii::n_params])
-            dst_ds.GetRasterBand(1).WriteArray(A)
-
+            np.put(A, window_grid.flat_index, values[:, ii])
+            band = dst_ds.GetRasterBand(ii + 1)
+            if create:
+                band.SetDescription(param)
+            band.WriteArray(A, *offset)
+        if self.cog:
+            cog_ds = gdal.GetDriverByName("COG").CreateCopy(
+                fname, dst_ds, options=self.cog_options)
+            cog_ds = None
+        else:
+            dst_ds.FlushCache()
+        dst_ds = None
 
 
 if __name__ == "__main__":
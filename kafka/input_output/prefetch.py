@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+A wrapper around observations objects that reads the bands of the next
+dates in background threads, while the current date is being solved.
+"""
+import logging
+import threading
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 needs the `futures` backport
+    ThreadPoolExecutor = None
+
+from ..inference.utils import iterate_time_grid
+from ..pipeline import ThreadedMap
+
+LOG = logging.getLogger(__name__)
+
+
+class PrefetchingObservations(object):
+    """Prefetches the band data of `observations`. Once the time grid is
+    known (either given here, or by `LinearKalman.run` calling
+    `set_time_grid`), the dates with observations are put in the order in
+    which the filter will visit them. Every time the filter moves on to a
+    new date, the bands of that date and of the next `n_dates` dates are
+    queued for reading in a pool of `n_threads` threads. Bands of dates the
+    filter has already moved past are dropped, so at most `n_dates + 1`
+    dates are held in memory. Bands that weren't prefetched (e.g. if there's
+    no time grid) are read directly. If the wrapped observations can read
+    all the bands of a date at once (with a `get_date_data` method), whole
+    dates are prefetched instead, for `get_date_data`.
+
+    Any other attribute (`dates`, `bands_per_observation`, ...) is taken from
+    the wrapped observations. The wrapped `get_band_data` must be safe to call
+    from several threads."""
+    def __init__(self, observations, time_grid=None, n_dates=1, n_threads=2):
+        self.observations = observations
+        self.n_dates = n_dates
+        self.n_threads = n_threads
+        self.n_prefetched = 0
+        self.n_direct = 0
+        self._schedule = []
+        self._position = {}
+        self._current = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        if ThreadPoolExecutor is None:
+            LOG.warning("concurrent.futures not available, not prefetching")
+        if time_grid is not None:
+            self.set_time_grid(time_grid)
+
+    def set_time_grid(self, time_grid):
+        """Sets the order in which dates will be requested, and starts
+        reading the first ones"""
+        schedule = []
+        for timestep, locate_times, is_first in iterate_time_grid(
+                time_grid, self.observations.dates):
+            schedule.extend(locate_times)
+        with self._lock:
+            self._pending.clear()
+            self._current = None
+            self._schedule = schedule
+            self._position = dict((date, i) for i, date in
+                                  enumerate(schedule))
+        if len(schedule) > 0:
+            self._prefetch_from(0)
+
+    def _read(self, timestep, band):
+        return self.observations.get_band_data(timestep, band)
+
+    def _read_date(self, timestep):
+        return self.observations.get_date_data(timestep)
+
+    @property
+    def _by_date(self):
+        return hasattr(self.observations, "get_date_data")
+
+    def _prefetch_from(self, position):
+        """Queues the bands of the dates from `position` up to `n_dates`
+        after it, and drops anything before `position`"""
+        if ThreadPoolExecutor is None:
+            return
+        with self._lock:
+            self._current = position
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.n_threads)
+            wanted = self._schedule[position:(position + self.n_dates + 1)]
+            for key in list(self._pending.keys()):
+                if key[0] not in wanted:
+                    self._pending.pop(key).cancel()
+            for date in wanted:
+                if self._by_date:
+                    if (date, None) not in self._pending:
+                        self._pending[(date, None)] = self._executor.submit(
+                            self._read_date, date)
+                    continue
+                for band in xrange(
+                        self.observations.bands_per_observation[date]):
+                    if (date, band) not in self._pending:
+                        self._pending[(date, band)] = self._executor.submit(
+                            self._read, date, band)
+
+    @property
+    def n_pending(self):
+        """Number of bands (or dates) queued or read but not requested yet"""
+        return len(self._pending)
+
+    def _move_to(self, timestep):
+        position = self._position.get(timestep)
+        if position is not None and position != self._current:
+            # Moving on to a new date
+            self._prefetch_from(position)
+
+    def get_band_data(self, timestep, band):
+        self._move_to(timestep)
+        with self._lock:
+            future = self._pending.pop((timestep, band), None)
+        if future is None:
+            self.n_direct += 1
+            return self._read(timestep, band)
+        self.n_prefetched += 1
+        return future.result()
+
+    def get_date_data(self, timestep):
+        """Returns the data of all the bands of `timestep`, in band order"""
+        if not self._by_date:
+            return [self.get_band_data(timestep, band) for band in
+                    xrange(self.observations.bands_per_observation[timestep])]
+        self._move_to(timestep)
+        with self._lock:
+            future = self._pending.pop((timestep, None), None)
+        if future is None:
+            self.n_direct += 1
+            return self._read_date(timestep)
+        self.n_prefetched += 1
+        return future.result()
+
+    def close(self):
+        """Stops the reading threads"""
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def __getattr__(self, name):
+        if name == "observations":
+            # Not set yet (e.g. while unpickling)
+            raise AttributeError(name)
+        return getattr(self.observations, name)
+
+
+class ParallelBandObservations(object):
+    """Reads all the bands of a date at the same time, in a pool of
+    `n_threads` threads, for readers that read one band at a time (e.g.
+    `BHRObservations`). Whatever preprocessing the wrapped `get_band_data`
+    does (scaling, masking, uncertainties) is done in the threads too.
+    `get_date_data` returns the bands in band order, so
+    `LinearKalman.assimilate_multiple_bands` picks it up.
+
+    Any other attribute is taken from the wrapped observations, whose
+    `get_band_data` must be safe to call from several threads."""
+    def __init__(self, observations, n_threads=4):
+        self.observations = observations
+        self._band_reader = ThreadedMap(n_threads)
+
+    def get_band_data(self, timestep, band, **kwargs):
+        return self.observations.get_band_data(timestep, band, **kwargs)
+
+    def get_date_data(self, timestep, **kwargs):
+        """Returns the data of all the bands of `timestep`, in band order.
+        Keyword arguments (e.g. `window`) go to `get_band_data`."""
+        return self._band_reader.map(
+            lambda band: self.observations.get_band_data(timestep, band,
+                                                         **kwargs),
+            xrange(self.observations.bands_per_observation[timestep]))
+
+    def close(self):
+        """Stops the reading threads"""
+        self._band_reader.close()
+
+    def __getattr__(self, name):
+        if name in ["observations", "_band_reader"]:
+            # Not set yet (e.g. while unpickling)
+            raise AttributeError(name)
+        return getattr(self.observations, name)
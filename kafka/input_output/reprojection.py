@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""Reprojection of observations onto the state grid. Products on the same
+grid (e.g. all the bands and dates of a Sentinel-2 tile) are mapped onto the
+state grid once, and every later read is a windowed read plus a gather."""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+from collections import namedtuple, OrderedDict
+
+import gdal
+
+import numpy as np
+
+import osr
+
+from ..inference.state_grid import as_state_grid
+
+LOG = logging.getLogger(__name__)
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017 J Gomez-Dans"
+__version__ = "1.0 (09.03.2017)"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+# The source pixel of each state grid pixel: `index` into the flattened
+# `(row, col, n_rows, n_cols)` read `window` of the source, for the `valid`
+# pixels (those that fall inside the source)
+PixelMapping = namedtuple("PixelMapping", "index valid window")
+
+
+def reproject_image(source_img, target_img, dstSRSs=None, window=None):
+    """Reprojects/Warps an image to fit exactly another image.
+    Additionally, you can set the destination SRS if you want
+    to or if it isn't defined in the source image. If `window` (a tuple of
+    row and column slices) is given, only that window of the target image
+    is produced."""
+    g = gdal.Open(target_img)
+    geo_t = g.GetGeoTransform()
+    x_size, y_size = g.RasterXSize, g.RasterYSize
+    x0, y0 = geo_t[0], geo_t[3]
+    if window is not None:
+        rows, cols = window
+        x0 = geo_t[0] + cols.start * geo_t[1]
+        y0 = geo_t[3] + rows.start * geo_t[5]
+        x_size, y_size = cols.stop - cols.start, rows.stop - rows.start
+    xmin = min(x0, x0 + x_size * geo_t[1])
+    xmax = max(x0, x0 + x_size * geo_t[1])
+    ymin = min(y0, y0 + y_size * geo_t[5])
+    ymax = max(y0, y0 + y_size * geo_t[5])
+    xRes, yRes = abs(geo_t[1]), abs(geo_t[5])
+    if dstSRSs is None:
+        dstSRS = osr.SpatialReference()
+        raster_wkt = g.GetProjection()
+        dstSRS.ImportFromWkt(raster_wkt)
+    else:
+        dstSRS = dstSRSs
+    g = gdal.Warp('', source_img, format='MEM',
+                  outputBounds=[xmin, ymin, xmax, ymax], xRes=xRes, yRes=yRes,
+                  dstSRS=dstSRS)
+    if g is None:
+        raise ValueError("Something failed with GDAL!")
+    return g
+
+
+def invert_geotransform(geotransform):
+    """Inverse of a GDAL geotransform, which maps georeferenced coordinates
+    to (fractional) pixel and line coordinates"""
+    a0, a1, a2, b0, b1, b2 = geotransform
+    det = a1*b2 - a2*b1
+    if det == 0:
+        raise ValueError("The geotransform {} can't be inverted".format(
+            geotransform))
+    return [(a2*b0 - a0*b2)/det, b2/det, -a2/det,
+            (a0*b1 - a1*b0)/det, -b1/det, a1/det]
+
+
+def pixel_mapping(geotransform, window, source_geotransform, source_shape,
+                  transform=None):
+    """Works out the nearest source pixel of every pixel in a window of the
+    state grid, as GDAL's nearest neighbour warp would (pixel centres are
+    mapped onto the source grid).
+
+    Parameters
+    -----------
+    geotransform: list
+        The GDAL geotransform of the state grid
+    window: tuple
+        The window of the state grid, as a tuple of row and column slices
+    source_geotransform: list
+        The GDAL geotransform of the source grid
+    source_shape: tuple
+        The `(rows, cols)` shape of the source grid
+    transform: callable
+        Optional function that takes arrays of state grid `x` and `y`
+        coordinates, and returns them in the source projection. If `None`,
+        both grids are in the same projection.
+
+    Returns
+    --------
+    A `PixelMapping`, with arrays of the shape of the window.
+    """
+    rows, cols = window
+    r = np.arange(rows.start, rows.stop) + 0.5
+    c = np.arange(cols.start, cols.stop) + 0.5
+    x = geotransform[0] + c[None, :]*geotransform[1] + \
+        r[:, None]*geotransform[2]
+    y = geotransform[3] + c[None, :]*geotransform[4] + \
+        r[:, None]*geotransform[5]
+    if transform is not None:
+        x, y = transform(x, y)
+    inverse = invert_geotransform(source_geotransform)
+    source_col = np.floor(inverse[0] + x*inverse[1] + y*inverse[2])
+    source_row = np.floor(inverse[3] + x*inverse[4] + y*inverse[5])
+    valid = ((source_row >= 0) & (source_row < source_shape[0]) &
+             (source_col >= 0) & (source_col < source_shape[1]))
+    if not valid.any():
+        return PixelMapping(np.zeros(valid.shape, dtype=np.int32), valid,
+                            (0, 0, 0, 0))
+    row0, row1 = source_row[valid].min(), source_row[valid].max() + 1
+    col0, col1 = source_col[valid].min(), source_col[valid].max() + 1
+    read_window = (int(row0), int(col0), int(row1 - row0), int(col1 - col0))
+    index = np.where(valid, (source_row - row0)*read_window[3] +
+                     source_col - col0, 0)
+    dtype = np.int32 if read_window[2]*read_window[3] < 2**31 else np.int64
+    return PixelMapping(index.astype(dtype), valid, read_window)
+
+
+def _coordinate_transform(target_wkt, source_wkt, block_size=65536):
+    """A `(x, y) -> (x, y)` function from the state grid projection to the
+    source projection, or `None` if they are the same (or the source has
+    no projection, in which case it's assumed to be on the state grid
+    projection). Points are transformed `block_size` at a time."""
+    if not source_wkt or not target_wkt:
+        return None
+    target_srs = osr.SpatialReference()
+    target_srs.ImportFromWkt(target_wkt)
+    source_srs = osr.SpatialReference()
+    source_srs.ImportFromWkt(source_wkt)
+    if target_srs.IsSame(source_srs):
+        return None
+    for srs in [target_srs, source_srs]:
+        if hasattr(srs, "SetAxisMappingStrategy"):
+            # GDAL >= 3 would use the authority axis order otherwise
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    ct = osr.CoordinateTransformation(target_srs, source_srs)
+
+    def transform(x, y):
+        # In blocks, so that only a block's worth of points is ever held
+        # as a list of tuples
+        shape = x.shape
+        x, y = x.ravel(), y.ravel()
+        x_out = np.empty(x.shape)
+        y_out = np.empty(y.shape)
+        for start in xrange(0, x.size, block_size):
+            block = slice(start, start + block_size)
+            points = np.array(ct.TransformPoints(
+                np.c_[x[block], y[block]].tolist()))
+            x_out[block] = points[:, 0]
+            y_out[block] = points[:, 1]
+        return x_out.reshape(shape), y_out.reshape(shape)
+    return transform
+
+
+def gdal_array_dtype(gdal_type):
+    """The numpy dtype of a GDAL data type"""
+    try:
+        from gdal_array import GDALTypeCodeToNumericTypeCode
+    except ImportError:
+        try:
+            from osgeo.gdal_array import GDALTypeCodeToNumericTypeCode
+        except ImportError:
+            return np.float32
+    return np.dtype(GDALTypeCodeToNumericTypeCode(gdal_type) or np.float32)
+
+
+class ReprojectionCache(object):
+    """Reads observations onto the state grid of `target_img` (usually the
+    state mask file). Only the bounding box of the state pixels is read and
+    resampled (see `StateGrid.window`). The nearest-neighbour mapping from
+    a source grid to the state grid is worked out the first time a product
+    on that grid is read, and reused for every band and date on the same
+    grid: reading a product is then a windowed `ReadAsArray` of just the
+    source pixels that are needed, and a gather. Up to `max_grids` source
+    grids are remembered. `read` can be called from several threads.
+
+    Parameters
+    -----------
+    target_img: str
+        A GDAL-readable raster on the state grid
+    state_mask: array
+        The state mask (or `StateGrid`). If `None`, it's read from
+        `target_img`
+    max_grids: int
+        Number of source grid mappings that are kept
+    """
+    def __init__(self, target_img, state_mask=None, max_grids=8):
+        g = gdal.Open(target_img)
+        if g is None:
+            raise IOError("Can't open the state grid {}".format(target_img))
+        self.geotransform = g.GetGeoTransform()
+        self.projection = g.GetProjection()
+        self.shape = (g.RasterYSize, g.RasterXSize)
+        if state_mask is None:
+            state_mask = g.ReadAsArray()
+        self.state_grid = as_state_grid(state_mask)
+        if self.state_grid.shape != self.shape:
+            raise ValueError("The state mask doesn't match the state grid")
+        self.max_grids = max_grids
+        self._mappings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _grid_key(self, g):
+        return (g.GetProjection(), tuple(g.GetGeoTransform()),
+                g.RasterYSize, g.RasterXSize)
+
+    def mapping(self, g):
+        """The `PixelMapping` of the bounding box of the state pixels, for
+        the grid of the GDAL dataset `g`"""
+        key = self._grid_key(g)
+        with self._lock:
+            if key in self._mappings:
+                # Most recently used goes last
+                self._mappings[key] = self._mappings.pop(key)
+                return self._mappings[key]
+            LOG.info("Mapping a new source grid onto the state grid")
+            transform = _coordinate_transform(self.projection, key[0])
+            mapping = pixel_mapping(self.geotransform,
+                                    self.state_grid.window, key[1], key[2:],
+                                    transform=transform)
+            self._mappings[key] = mapping
+            while len(self._mappings) > self.max_grids:
+                self._mappings.popitem(last=False)
+            return mapping
+
+    def read(self, source_img, window=None, band=1):
+        """Returns `band` of the raster `source_img` on the state grid (or on
+        a `window` of it, given as a tuple of row and column slices). Pixels
+        outside the bounding box of the state pixels, or outside the source,
+        are zero (as with `reproject_image`)."""
+        g = gdal.Open(source_img)
+        if g is None:
+            raise IOError("Can't open {}".format(source_img))
+        mapping = self.mapping(g)
+        if window is None:
+            window = (slice(0, self.shape[0]), slice(0, self.shape[1]))
+        box = self.state_grid.window
+        # The part of the bounding box inside the requested window
+        rows = slice(max(window[0].start, box[0].start),
+                     min(window[0].stop, box[0].stop))
+        cols = slice(max(window[1].start, box[1].start),
+                     min(window[1].stop, box[1].stop))
+        source_band = g.GetRasterBand(band)
+        dtype = gdal_array_dtype(source_band.DataType)
+        out = np.zeros((window[0].stop - window[0].start,
+                        window[1].stop - window[1].start), dtype=dtype)
+        if rows.start >= rows.stop or cols.start >= cols.stop:
+            return out
+        in_box = (slice(rows.start - box[0].start, rows.stop - box[0].start),
+                  slice(cols.start - box[1].start, cols.stop - box[1].start))
+        index = mapping.index[in_box]
+        valid = mapping.valid[in_box]
+        if not valid.any():
+            return out
+        # Only read the source pixels this window needs
+        row0, col0, n_rows, n_cols = mapping.window
+        source_row, source_col = np.divmod(index[valid], n_cols)
+        row1, col1 = source_row.min(), source_col.min()
+        n_rows = int(source_row.max() - row1 + 1)
+        n_cols = int(source_col.max() - col1 + 1)
+        data = source_band.ReadAsArray(int(col0 + col1), int(row0 + row1),
+                                       n_cols, n_rows)
+        values = np.zeros(index.shape, dtype=data.dtype)
+        values[valid] = np.take(data.ravel(), (source_row - row1)*n_cols +
+                                source_col - col1)
+        in_window = (slice(rows.start - window[0].start,
+                           rows.stop - window[0].start),
+                     slice(cols.start - window[1].start,
+                           cols.stop - window[1].start))
+        out[in_window] = values
+        return out
+
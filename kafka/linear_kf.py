@@ -21,12 +21,15 @@ implementation basically performs a very fast update of the filter."""
 # along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import sys
 from collections import namedtuple
 
 import numpy as np
 
 import scipy.sparse as sp
 
+import six
+
 # from scipy.spatial.distance import squareform, pdist
 
 # from utils import  matrix_squeeze, spsolve2, reconstruct_array
@@ -38,7 +41,12 @@ from inference import create_nonlinear_observation_operator
 from inference import iterate_time_grid
 from inference import propagate_information_filter_LAI # eg
 from inference import hessian_correction
+from inference import BlockDiagonalPrecision
+from inference import pixel_cost, get_strategy
+from inference import as_state_grid
 from inference.kf_tools import propagate_and_blend_prior
+from input_output.prefetch import PrefetchingObservations
+from pipeline import PipelineStats, OutputWriter, close_output
 
 # Set up logging
 
@@ -56,6 +64,50 @@ Previous_State = namedtuple("Previous_State",
                             "timestamp x_vect cov_m icov_mv")
 
 
+class PixelIterations(object):
+    """Keeps track of the iterations of `LinearKalman.do_all_bands`: which
+    pixels are still `active`, and how many iterations each pixel took.
+    `n_iter` is the number of the current iteration."""
+    def __init__(self, n_pixels, n_params, per_pixel=False,
+                 convergence_tolerance=1e-3, min_iterations=2):
+        self.n_params = n_params
+        self.per_pixel = per_pixel
+        self.convergence_tolerance = convergence_tolerance
+        self.min_iterations = min_iterations
+        self.n_iter = 1
+        self.active = np.ones(n_pixels, dtype=bool)
+        self.n_iterations = np.zeros(n_pixels, dtype=np.int32)
+
+    def count(self):
+        """Counts an iteration of the active pixels"""
+        self.n_iterations[self.active] += 1
+
+    def iterate_all(self):
+        """Goes back to iterating the whole state until it converges"""
+        self.per_pixel = False
+        self.active[:] = True
+
+    def converged(self, x, x_prev):
+        """Updates the active pixels after an iteration from `x_prev` to
+        `x`, and returns whether the iterations are done"""
+        tolerance = self.convergence_tolerance
+        if not self.per_pixel:
+            convergence_norm = np.linalg.norm(x - x_prev)/float(len(x))
+            LOG.info("Iteration # {:d}, convergence norm: {:g}".format(
+                self.n_iter, convergence_norm))
+            return convergence_norm < tolerance and \
+                self.n_iter >= self.min_iterations
+        change = np.sqrt(((x - x_prev)**2).reshape(
+            (-1, self.n_params)).sum(axis=1))
+        converged = change < tolerance
+        if self.n_iter >= self.min_iterations:
+            self.active &= ~converged
+        LOG.info("Iteration # {:d}, max change: {:g}, {:d} active "
+                 "pixels".format(self.n_iter, change.max(),
+                                 self.active.sum()))
+        return not self.active.any()
+
+
 class LinearKalman (object):
     """The main Kalman filter class operating in raster data sets. Note that the
     goal of this class is not to consider complex, time evolving models, but
@@ -63,14 +115,33 @@ class LinearKalman (object):
     def __init__(self, observations, output, state_mask,
                  create_observation_operator, parameters_list,
                  state_propagation=propagate_information_filter_LAI,
-                 linear=True, diagnostics=True, prior=None):
+                 linear=True, diagnostics=True, prior=None,
+                 solver_mode="splu", emulator_cache=None,
+                 per_pixel_convergence=False,
+                 iteration_strategy="gauss-newton", solver_context=None,
+                 compact_solve=False, emulation_options=None):
         """The class creator takes (i) an observations object, (ii) an output
         writer object, (iii) the state mask (a boolean 2D array indicating which
         pixels are used in the inference), and additionally, (iv) a state
         propagation scheme (defaults to `propagate_information_filter`),
         whether a linear model is used or not, the number of parameters in
         the state vector, whether diagnostics are being reported, and the
-        number of bands per observation.
+        number of bands per observation. `solver_mode` selects how the
+        linearised problem is solved: `"splu"` factorises the global sparse
+        Hessian, `"block"` solves all the per-pixel blocks in one batched call.
+        An `EmulatorCache` can be given in `emulator_cache`, to reuse emulator
+        runs across iterations, bands and dates, and a `SolverContext` in
+        `solver_context`, to reuse the sparsity structure of the sparse
+        solves across iterations and dates. With `compact_solve`, pixels
+        without any valid observation in a date are left out of its solves,
+        and keep their forecast (see `variational_kalman_multiband`). With
+        `per_pixel_convergence`, the iterations of `do_all_bands` stop per
+        pixel, rather than for the whole state at once. `iteration_strategy`
+        selects what is done with the solution of each linearised problem
+        (see `run`). `emulation_options` (e.g. `dict(tol=1e-3)`, the maximum
+        error of the clustered emulation) are passed on to `run_emulator`
+        by the emulator based observation operators, which take them as
+        their `emulation_options` argument.
         """
         self.parameters_list = parameters_list # A list of parameter names
                                      # Required by prior
@@ -80,7 +151,10 @@ class LinearKalman (object):
         self.output = output
         self.diagnostics = diagnostics
         self.state_mask = state_mask
-        self.n_state_elems = self.state_mask.sum()
+        # The state pixel indices, shared by the operators, solvers and
+        # writers
+        self.state_grid = as_state_grid(state_mask)
+        self.n_state_elems = self.state_grid.n_pixels
         self._state_propagator = state_propagation
         self._advance = propagate_and_blend_prior
         self.prior = prior
@@ -88,8 +162,33 @@ class LinearKalman (object):
         # specific functions. All priors need a dictionary with ['function'] key.
         # Other keys are optional
         self._create_observation_operator = create_observation_operator
+        self.solver_mode = solver_mode
+        self.solver_context = solver_context
+        self.compact_solve = compact_solve
+        self.emulator_cache = emulator_cache
+        self.emulation_options = emulation_options
+        self.per_pixel_convergence = per_pixel_convergence
+        self.iteration_strategy = get_strategy(iteration_strategy)
+        # Number of pixels per number of iterations, for each date
+        self.iteration_histograms = {}
+        # Time spent in each stage, see `run`
+        self.stats = PipelineStats()
         LOG.info("Starting KaFKA run!!!")
 
+    def _operator_options(self):
+        """Extra arguments for the observation operator builder. Builders
+        that don't emulate (e.g. the SAR one) don't take any, so they are
+        only passed when set."""
+        if self.emulation_options is None:
+            return {}
+        return {"emulation_options": self.emulation_options}
+
+    def _get_emulator(self, emulator):
+        """Puts the emulator cache (if any) in front of `emulator`"""
+        if self.emulator_cache is None:
+            return emulator
+        return self.emulator_cache.wrap(emulator)
+
     def advance(self, x_analysis, P_analysis, P_analysis_inverse,
                 trajectory_model, trajectory_uncertainty):
         LOG.info("Calling state propagator...")
@@ -97,7 +196,8 @@ class LinearKalman (object):
             self._advance(x_analysis, P_analysis, P_analysis_inverse,
                           trajectory_model, trajectory_uncertainty,
                           prior=self.prior, date=self.current_timestep,
-                          state_propagator=self._state_propagator)
+                          state_propagator=self._state_propagator,
+                          solver_context=self.solver_context)
         return x_forecast, P_forecast, P_forecast_inverse
 
     def _set_plot_view(self, diag_string, timestep, obs):
@@ -164,13 +264,78 @@ class LinearKalman (object):
     def run(self, time_grid, x_forecast, P_forecast, P_forecast_inverse,
             diag_str="diagnostics",
             band=None, approx_diagonal=True, refine_diag=True,
-            iter_obs_op=False, is_robust=False, dates=None):
+            iter_obs_op=False, is_robust=False, dates=None,
+            pipeline=False, max_queue=2, iteration_strategy=None):
         """Runs a complete assimilation run. Requires a temporal grid (where
         we store the timesteps where the inferences will be done, and starting
         values for the state and covariance (or inverse covariance) matrices.
 
         The time_grid ought to be a list with the time steps given in the same
-        form as self.observation_times"""
+        form as self.observation_times
+
+        With `pipeline=True`, the stages run concurrently: the observations
+        for the next dates are read in background threads (see
+        `PrefetchingObservations`), while the current date is linearised and
+        solved, and the results are written by a background thread (see
+        `OutputWriter`), with at most `max_queue` dates waiting in each
+        queue. The time spent in each stage and the queue depths are
+        accumulated in `self.stats` in either mode, and logged at the end.
+
+        `iteration_strategy` (if given) replaces the strategy set in
+        `__init__` to iterate the nonlinear observation operators of each
+        date. It's either a strategy object from `inference.strategies`, or
+        the name of one: `"gauss-newton"` (the default) takes every
+        Gauss-Newton step as is, `"levenberg-marquardt"` damps the step of
+        each pixel and adapts the damping to whether the cost of the pixel
+        goes down, and `"line-search"` backtracks along the Gauss-Newton
+        step of the pixels where the cost goes up."""
+        if iteration_strategy is not None:
+            self.iteration_strategy = get_strategy(iteration_strategy)
+        observations, output = self.observations, self.output
+        if pipeline:
+            if not isinstance(observations, PrefetchingObservations):
+                self.observations = PrefetchingObservations(
+                    observations, n_dates=max_queue)
+            self.output = OutputWriter(output, max_queue=max_queue,
+                                       stats=self.stats)
+        try:
+            self._run(time_grid, x_forecast, P_forecast, P_forecast_inverse,
+                      approx_diagonal=approx_diagonal,
+                      refine_diag=refine_diag, iter_obs_op=iter_obs_op,
+                      is_robust=is_robust, diag_str=diag_str)
+        except:
+            # Errors from closing the stages (e.g. a failed write) are only
+            # logged, so they don't hide the error that stopped the run
+            error = sys.exc_info()
+            try:
+                self._close_stages(observations, output)
+            except Exception:
+                LOG.exception("Error closing the pipeline of a failed run")
+            six.reraise(*error)
+        self._close_stages(observations, output)
+        close_output(self.output, self.stats)
+        self.stats.log()
+
+    def _close_stages(self, observations, output):
+        """Puts back the `observations` and `output` that `run` wrapped in
+        pipeline stages, and stops the stages."""
+        prefetcher, writer = self.observations, self.output
+        self.observations, self.output = observations, output
+        try:
+            if prefetcher is not observations:
+                prefetcher.close()
+        finally:
+            if writer is not output:
+                # Waits for the last timesteps to be written
+                writer.close()
+
+    def _run(self, time_grid, x_forecast, P_forecast, P_forecast_inverse,
+             approx_diagonal=True, refine_diag=True, iter_obs_op=False,
+             is_robust=False, diag_str="diagnostics"):
+        """The time loop of `run`"""
+        if hasattr(self.observations, "set_time_grid"):
+            # Let prefetching observations know what's coming
+            self.observations.set_time_grid(time_grid)
         for timestep, locate_times, is_first in iterate_time_grid(
             time_grid, self.observations.dates):
 
@@ -178,9 +343,10 @@ class LinearKalman (object):
 
             if not is_first:
                 LOG.info("Advancing state, %s" % timestep.strftime("%Y-%m-%d"))
-                x_forecast, P_forecast, P_forecast_inverse = self.advance(
-                    x_analysis, P_analysis, P_analysis_inverse,
-                    self.trajectory_model, self.trajectory_uncertainty)
+                with self.stats.timer("forecast"):
+                    x_forecast, P_forecast, P_forecast_inverse = self.advance(
+                        x_analysis, P_analysis, P_analysis_inverse,
+                        self.trajectory_model, self.trajectory_uncertainty)
 
             is_first = False
             if len(locate_times) == 0:
@@ -201,8 +367,16 @@ class LinearKalman (object):
                                      iter_obs_op=iter_obs_op,
                                      is_robust=is_robust, diag_str=diag_str)
             LOG.info("Dumping results to disk")
-            self.output.dump_data(timestep, x_analysis, P_analysis,
-                                  P_analysis_inverse, self.state_mask, self.n_params)
+            if isinstance(self.output, OutputWriter):
+                # Queued for the writer thread, which does its own timing
+                self.output.dump_data(timestep, x_analysis, P_analysis,
+                                      P_analysis_inverse, self.state_grid,
+                                      self.n_params)
+            else:
+                with self.stats.timer("write"):
+                    self.output.dump_data(timestep, x_analysis, P_analysis,
+                                          P_analysis_inverse, self.state_grid,
+                                          self.n_params)
 
     def assimilate_multiple_bands(self, locate_times, x_forecast, P_forecast,
                    P_forecast_inverse,
@@ -215,9 +389,19 @@ class LinearKalman (object):
             LOG.info("Assimilating %s..." % step.strftime("%Y-%m-%d"))
             current_data = []
             # Reads all bands into one list
-            for band in range(self.observations.bands_per_observation[step]):
-                current_data.append(self.observations.get_band_data(step, 
-                                                                    band))
+            n_pending = getattr(self.observations, "n_pending", None)
+            if n_pending is not None:
+                self.stats.record_depth("read_queue", n_pending)
+            with self.stats.timer("read"):
+                if hasattr(self.observations, "get_date_data"):
+                    # Readers that read all the bands of a date at once
+                    current_data = list(
+                        self.observations.get_date_data(step))
+                else:
+                    for band in range(
+                            self.observations.bands_per_observation[step]):
+                        current_data.append(self.observations.get_band_data(
+                            step, band))
             x_analysis, P_analysis, P_analysis_inverse, innovations = \
                 self.do_all_bands(step, current_data, x_forecast, P_forecast,
                                   P_forecast_inverse)
@@ -237,73 +421,86 @@ class LinearKalman (object):
     def do_all_bands(self, timestep, current_data, x_forecast, P_forecast,
                         P_forecast_inverse, convergence_tolerance=1e-3,
                         min_iterations=2):
-        not_converged = True
+        """Assimilates all the bands in `current_data` together, iterating
+        the linearisation of the observation operators until convergence.
+
+        By default, the whole state is iterated until the normalised norm of
+        the change of the whole state vector between iterations is below
+        `convergence_tolerance` (after at least `min_iterations`). With
+        per-pixel convergence (see `__init__`), a pixel is frozen once the
+        l2 norm of the change of its parameters is below the tolerance, and
+        only the pixels that are still active are relinearised and solved
+        in the next iterations. The number of iterations each pixel took is
+        logged, and stored as a histogram in
+        `self.iteration_histograms[timestep]`.
+
+        Each iteration solves the problem linearised around the current
+        point, and `self.iteration_strategy` decides which point to
+        linearise around next (and may damp the linearised problem), using
+        the cost of each pixel at the current point. Once the iterations
+        stop, pixels whose last step didn't lower their cost are put back
+        at the best point the strategy found for them."""
+        strategy = self.iteration_strategy
+        strategy.reset(x_forecast, self.n_params)
+        per_pixel = self.per_pixel_convergence and all(
+            np.shape(data.mask) == self.state_grid.shape
+            for data in current_data)
+        iterations = PixelIterations(
+            self.n_state_elems, self.n_params, per_pixel=per_pixel,
+            convergence_tolerance=convergence_tolerance,
+            min_iterations=min_iterations)
         # Linearisation point is set to x_forecast for first iteration
         x_prev = x_forecast*1.
-        n_iter = 1
-        n_bands = len(current_data)
-        while not_converged:
-            Y = []
-            MASK = []
-            UNC = []
-            META = []
-            H_matrix = []
-            for band, data in enumerate(current_data):
-                # Create H0 and H_matrix around x_prev
-                # Also extract single band information from nice package
-                # this allows us to use the same interface as current
-                # Deferring processing to a new solver method in solvers.py
-                
-                H_matrix_= self._create_observation_operator(self.n_params,
-                                                         data.emulator,
-                                                         data.metadata,
-                                                         data.mask,
-                                                         self.state_mask,
-                                                         x_prev,
-                                                         band)
-                H_matrix.append(H_matrix_)
-                Y.append(data.observations)
-                MASK.append(data.mask)
-                UNC.append(data.uncertainty)
-                META.append(data.metadata)
-            # Now call the solver 
-            x_analysis, P_analysis, P_analysis_inverse, \
-                innovations, fwd_modelled = self.solver_multiband(
-                    Y, MASK, H_matrix, x_prev, x_forecast,
-                    P_forecast, P_forecast_inverse, UNC,
-                    META)
-            
-
-            # Test convergence. We calculate the l2 norm of the difference
-            # between the state at the previous iteration and the current one
-            # There might be better tests, but this is quite straightforward
-            #passer_mask = data.mask[self.state_mask]
-            #maska = np.concatenate([passer_mask.ravel()
-            #                        for i in range(self.n_params)])
-            #convergence_norm = np.linalg.norm(x_analysis[maska] -
-            #                                  x_prev[maska])/float(maska.sum())
-            convergence_norm = np.linalg.norm(x_analysis - x_prev)/float(len(x_analysis))
-            LOG.info(
-                "Band {:d}, Iteration # {:d}, convergence norm: {:g}".format(
-                    band, n_iter, convergence_norm))
-            if (convergence_norm < convergence_tolerance) and (
-                    n_iter >= min_iterations):
-                # Converged!
-                not_converged = False
-            elif n_iter > 25:
+        x_analysis = P_analysis_inverse = innovations = None
+        while True:
+            Y, MASK, UNC, META, H_matrix = self._linearise_bands(
+                current_data, x_prev, iterations)
+            if strategy.needs_cost:
+                strategy = self._evaluate_strategy(
+                    strategy, Y, MASK, UNC, H_matrix, x_prev, x_forecast,
+                    P_forecast_inverse, iterations.active)
+            damping, x_anchor = strategy.damping()
+            # Now call the solver
+            with self.stats.timer("solve"):
+                x_new, P_analysis, P_new_inverse, \
+                    innovations_new, fwd_modelled = self.solver_multiband(
+                        Y, MASK, H_matrix, x_prev, x_forecast,
+                        P_forecast, P_forecast_inverse, UNC,
+                        META, damping=damping, x_anchor=x_anchor)
+            iterations.count()
+            if iterations.per_pixel and not iterations.active.all():
+                try:
+                    x_new, P_new_inverse, innovations_new = \
+                        self._merge_frozen(iterations.active, x_new,
+                                           x_analysis, P_new_inverse,
+                                           P_analysis_inverse,
+                                           innovations_new, innovations)
+                except ValueError:
+                    LOG.warning("The Hessian couples pixels, iterating " +
+                                "the whole state")
+                    iterations.iterate_all()
+            x_analysis = strategy.next_point(x_prev, x_new,
+                                             iterations.active)
+            P_analysis_inverse = P_new_inverse
+            innovations = innovations_new
+            if iterations.converged(x_analysis, x_prev):
+                break
+            if iterations.n_iter > 25:
                 # Too many iterations
                 LOG.warning("Bailing out after 25 iterations!!!!!!")
-                not_converged = False
-
+                break
             x_prev = x_analysis*1.
-            n_iter += 1
-            
+            iterations.n_iter += 1
+        # Pixels whose last step was rejected go back to their best point
+        x_analysis = strategy.final_point(x_analysis)
+        self._log_iterations(timestep, iterations.n_iterations)
+
         # Once we have converged...
         # Correct hessian for higher order terms
         # TODO THIS WILL NOT WORK AS IT IS!!!
         #P_correction = hessian_correction(data.emulator, x_analysis,
         #                                  data.uncertainty, innovations,
-        #                                  data.mask, self.state_mask, band,
+        #                                  data.mask, self.state_grid, band,
         #                                  self.n_params)
         #P_analysis_inverse = P_analysis_inverse - P_correction
 
@@ -311,6 +508,87 @@ class LinearKalman (object):
         
         return x_analysis, P_analysis, P_analysis_inverse, innovations
                 
+    def _linearise_bands(self, current_data, x, iterations):
+        """Linearises the observation operators of all the bands around
+        `x`. With per-pixel convergence, only the pixels that are still
+        active in `iterations` are linearised (frozen pixels are masked
+        out, so they're neither emulated nor solved for). Returns the
+        per-band observations, masks, uncertainties, metadata and
+        observation operators, as the solver takes them."""
+        if iterations.per_pixel:
+            active_grid = self.state_grid.scatter(iterations.active,
+                                                  fill=False)
+        Y = []
+        MASK = []
+        UNC = []
+        META = []
+        H_matrix = []
+        for band, data in enumerate(current_data):
+            mask = data.mask & active_grid if iterations.per_pixel \
+                else data.mask
+            with self.stats.timer("linearise"):
+                H_matrix_ = self._create_observation_operator(
+                    self.n_params, self._get_emulator(data.emulator),
+                    data.metadata, mask, self.state_grid, x, band,
+                    **self._operator_options())
+            H_matrix.append(H_matrix_)
+            Y.append(data.observations)
+            MASK.append(mask)
+            UNC.append(data.uncertainty)
+            META.append(data.metadata)
+        return Y, MASK, UNC, META, H_matrix
+
+    def _evaluate_strategy(self, strategy, Y, MASK, UNC, H_matrix, x,
+                           x_forecast, P_forecast_inverse, active):
+        """Gives `strategy` the cost of each pixel at `x`, and returns it.
+        The cost can only be worked out per pixel if the forecast precision
+        is block-diagonal per pixel; if it isn't, plain Gauss-Newton is
+        returned instead."""
+        try:
+            cost = pixel_cost(Y, MASK, self.state_grid, UNC, H_matrix,
+                              self.n_params, x, x_forecast,
+                              P_forecast_inverse)
+        except ValueError:
+            LOG.warning("The forecast precision couples pixels, " +
+                        "using Gauss-Newton iterations")
+            strategy = get_strategy("gauss-newton")
+            strategy.reset(x_forecast, self.n_params)
+        else:
+            strategy.evaluate(x, cost, active)
+        return strategy
+
+    def _log_iterations(self, timestep, n_iterations):
+        """Logs (and stores in `self.iteration_histograms`) the number of
+        pixels per number of iterations"""
+        histogram = np.bincount(n_iterations)
+        self.iteration_histograms[timestep] = histogram
+        LOG.info("Iterations per pixel: " + ", ".join(
+            "{:d}: {:d}".format(i, n) for i, n in enumerate(histogram)
+            if n > 0))
+        if self.emulator_cache is not None:
+            LOG.info("Emulator cache: {hits:d} hits, {misses:d} misses, "
+                     "{entries:d} entries".format(
+                         **self.emulator_cache.stats()))
+
+    def _merge_frozen(self, active, x_analysis, x_frozen, P_analysis_inverse,
+                      P_frozen_inverse, innovations, innovations_frozen):
+        """Takes the state, precision blocks and innovations of the pixels
+        that aren't `active` from the previous iteration. Raises
+        `ValueError` if the precision matrices aren't block-diagonal per
+        pixel."""
+        frozen = ~active
+        x_analysis = x_analysis.copy()
+        x_analysis.reshape((-1, self.n_params))[frozen] = \
+            x_frozen.reshape((-1, self.n_params))[frozen]
+        P_analysis_inverse = BlockDiagonalPrecision.from_sparse(
+            P_analysis_inverse, self.n_params).copy()
+        P_analysis_inverse.blocks[frozen] = BlockDiagonalPrecision.from_sparse(
+            P_frozen_inverse, self.n_params).blocks[frozen]
+        n_bands = len(innovations) // len(active)
+        innovations = np.where(np.tile(active, n_bands), innovations,
+                               innovations_frozen)
+        return x_analysis, P_analysis_inverse, innovations
+
     def assimilate(self, locate_times, x_forecast, P_forecast,
                    P_forecast_inverse,
                    approx_diagonal=True, refine_diag=False,
@@ -360,15 +638,12 @@ class LinearKalman (object):
         # Linearisation point is set to x_forecast for first iteration
         x_prev = x_forecast*1.
         n_iter = 1
+        emulator = self._get_emulator(data.emulator)
         while not_converged:
             # Create H matrix
-            H_matrix = self._create_observation_operator(self.n_params,
-                                                         data.emulator,
-                                                         data.metadata,
-                                                         data.mask,
-                                                         self.state_mask,
-                                                         x_prev,
-                                                         band)
+            H_matrix = self._create_observation_operator(
+                self.n_params, emulator, data.metadata, data.mask,
+                self.state_grid, x_prev, band, **self._operator_options())
             x_analysis, P_analysis, P_analysis_inverse, \
                 innovations, fwd_modelled = self.solver(
                     data.observations, data.mask, H_matrix, x_forecast,
@@ -378,7 +653,7 @@ class LinearKalman (object):
             # Test convergence. We calculate the l2 norm of the difference
             # between the state at the previous iteration and the current one
             # There might be better tests, but this is quite straightforward
-            passer_mask = data.mask[self.state_mask]
+            passer_mask = self.state_grid.gather(data.mask)
             maska = np.concatenate([passer_mask.ravel()
                                     for i in range(self.n_params)])
             convergence_norm = np.linalg.norm(x_analysis[maska] -
@@ -400,13 +675,12 @@ class LinearKalman (object):
         # Correct hessian for higher order terms
         P_correction = hessian_correction(data.emulator, x_analysis,
                                           data.uncertainty, innovations,
-                                          data.mask, self.state_mask, band,
+                                          data.mask, self.state_grid, band,
                                           self.n_params)
         P_analysis_inverse = P_analysis_inverse - P_correction
         # P_analysis_inverse = UPDATE HESSIAN WITH HIGHER ORDER CONTRIBUTION
         import matplotlib.pyplot as plt
-        M = self.state_mask*1.
-        M[self.state_mask] = x_analysis[6::7]
+        M = self.state_grid.scatter(x_analysis[6::7], dtype=np.float64)
         plt.figure()
         plt.imshow(M[650:730, 1180:1280], interpolation="nearest", vmin=0.1, vmax=0.5)
         plt.title("Band: %d, Date:"%band + timestep.strftime("%Y-%m-%d"))
@@ -419,23 +693,28 @@ class LinearKalman (object):
         x_analysis, P_analysis, P_analysis_inv, \
             innovations_prime, fwd_modelled = \
             variational_kalman(
-                observations, mask, self.state_mask, R_mat, H_matrix,
+                observations, mask, self.state_grid, R_mat, H_matrix,
                 self.n_params,
-                x_forecast, P_forecast, P_forecast_inv, the_metadata)
+                x_forecast, P_forecast, P_forecast_inv, the_metadata,
+                solver_mode=self.solver_mode, compact=self.compact_solve)
 
         return x_analysis, P_analysis, P_analysis_inv, \
             innovations_prime, fwd_modelled
 
 
     def solver_multiband(self, observations, mask, H_matrix, x0, x_forecast, P_forecast,
-               P_forecast_inv, R_mat, the_metadata):
+               P_forecast_inv, R_mat, the_metadata, damping=None,
+               x_anchor=None):
 
         x_analysis, P_analysis, P_analysis_inv, \
             innovations_prime, fwd_modelled = \
             variational_kalman_multiband(
-                observations, mask, self.state_mask, R_mat, H_matrix,
+                observations, mask, self.state_grid, R_mat, H_matrix,
                 self.n_params, x0,
-                x_forecast, P_forecast, P_forecast_inv, the_metadata)
+                x_forecast, P_forecast, P_forecast_inv, the_metadata,
+                solver_mode=self.solver_mode, compact=self.compact_solve,
+                damping=damping, x_anchor=x_anchor,
+                context=self.solver_context)
 
         return x_analysis, P_analysis, P_analysis_inv, \
             innovations_prime, fwd_modelled
@@ -8,9 +8,11 @@ import numpy as np
 
 import scipy.sparse as sp
 
+from ..inference.utils import gather_state_pixels, create_pixel_jacobian
+
 LOG = logging.getLogger(__name__)
 
-def sar_observation_operator(x, theta, polarisation):
+def sar_observation_operator(x, theta, polarisation, dtype=None):
 
     """
     For the sar_observation_operator a simple Water Cloud Model (WCM) is used
@@ -33,28 +35,25 @@ def sar_observation_operator(x, theta, polarisation):
 
     Input
     -----
-    polarisation: considered polarisation as string
     x: 2D array where every row is the set of parameters for one pixel
+    theta: incidence angle in degrees, either a scalar or one per pixel
+    polarisation: considered polarisation as string
+    dtype: if given (e.g. np.float32), the calculations are done in this
+        precision. Otherwise, the precision of x is used.
 
     Output
     ------
     sigma_0: predicted backscatter for each individual parameter set
     grad: gradient for each individual parameter set and each parameter determined by 2D input array x. The gradient should thus have the same size and shape as x
-    sigma_veg: predicted volume component of sigma_0
-    sigma_surf: predicted surface component of sigma_0
-    tau: predicted two-way attenuation through the canopy
     """
 
     # x 2D array where every row is the set of parameters for one pixel
     x = np.atleast_2d(x)
+    if dtype is not None:
+        x = x.astype(dtype, copy=False)
 
-    # conversion of incidence angle to radiant
-    # the incidence angle itself should probably implemented in x)
-    # TODO needs to come from the data
-    theta = np.deg2rad(theta)
-
-    # Simpler definition of cosine of theta
-    mu = np.cos(theta)
+    # Cosine of the incidence angle, which is given in degrees
+    mu = np.cos(np.deg2rad(np.asarray(theta, dtype=x.dtype)))
 
     # the model parameters (A, B, C, D, E) for different polarisations
     parameters = {'VV': [0.0846, 0.0615, -14.8465, 15.907, 1.],
@@ -66,32 +65,56 @@ def sar_observation_operator(x, theta, polarisation):
     except KeyError:
         raise ValueError('Only VV and VH polarisations available!')
 
+    V = x[:, 0]
+    SM = x[:, 1]
+    # V**E and its derivative. With E=0, the derivative vanishes (and we
+    # avoid 0*V**-1 for bare soil pixels)
+    if E == 0:
+        V_E = np.ones_like(V)
+        dV_E = np.zeros_like(V)
+    else:
+        V_E = V**E
+        dV_E = E*V**(E - 1.)
+
     # Calculate Model
-    tau = np.exp(-2. * B / mu * x[:, 0])
-    sigma_veg = A * (x[:, 0] ** E) * mu * (1. - tau)
-    sigma_surf = 10. ** ((C + D * x[:, 1]) / 10.)
+    tau = np.exp(-2.*B*V/mu)
+    sigma_veg = A*V_E*mu*(1. - tau)
+    sigma_surf = 10.**((C + D*SM)/10.)
 
-    sigma_0 = sigma_veg + tau * sigma_surf
-    #pdb.set_trace()
+    sigma_0 = sigma_veg + tau*sigma_surf
 
     # Calculate Gradient (grad has same dimension as x)
-    grad = x*0
-    n_elems = x.shape[0]
-    for i in range(n_elems):
-        tau_value = np.exp(-2. * B / mu[i] * x[i, 0])
-        grad[i, 0] = A * E * mu[i] * (x[i, 0] ** (E - 1.)) * (1. - tau_value) + \
-            2. * A * B * (x[i, 0] ** E) * tau_value - (
-            (2. ** (1/10. * (C + D * x[i, 1]) + 1.)) *
-            (5. ** (1/10. * (C + D * x[i, 1])) * B * tau_value)
-            ) / mu[i]
-        grad[i, 1] = D * np.log(10.) * tau_value * 10. ** (
-            1./10. * (C + D * x[i, 1]) - 1.)
+    grad = np.zeros_like(x)
+    grad[:, 0] = A*mu*dV_E*(1. - tau) + 2.*A*B*V_E*tau - \
+        2.*B*tau*sigma_surf/mu
+    grad[:, 1] = D*np.log(10.)/10.*tau*sigma_surf
 
     # returned values are linear scaled not dB!!!
-    # return sigma_0, grad, sigma_veg, sigma_surf, tau
     return sigma_0, grad
 
 
+def get_incidence_angle(metadata, mask, state_mask, pixels,
+                        default_angle=23.):
+    """Returns the incidence angle (in degrees) for the observed state
+    pixels. `metadata['incidence_angle']` can be a scalar, an array with one
+    angle per observed state pixel, or a 2D array on the same grid as
+    `mask`. If there's no incidence angle in the metadata, `default_angle`
+    is used."""
+    try:
+        angle = metadata['incidence_angle']
+    except (KeyError, TypeError):
+        LOG.warning("No incidence angle in the metadata, using {}".format(
+            default_angle))
+        return np.ones(len(pixels))*default_angle
+    angle = np.asarray(angle)
+    if angle.ndim == 0 or angle.shape == pixels.shape:
+        return np.broadcast_to(angle, pixels.shape)
+    if angle.shape == mask.shape:
+        return angle[state_mask][pixels]
+    raise ValueError("Incidence angle has shape {}, and the mask {}".format(
+        angle.shape, mask.shape))
+
+
 def create_sar_observation_operator(n_params, forward_model, metadata,
                                     mask, state_mask,  x_forecast, band):
     """Creates the SAR observation operator using the Water Cloud SAR forward
@@ -103,8 +126,9 @@ def create_sar_observation_operator(n_params, forward_model, metadata,
         Number of parameters in the state vector per pixel
     forward_model: function
         The function to call the forward model. Defined above
-    metadata: list
-        Not used
+    metadata: dict
+        The observation metadata. The incidence angle is taken from
+        `metadata['incidence_angle']` (see `get_incidence_angle`)
     mask: array
         A 2D mask with the observational valid pixels
     state_mask: array
@@ -120,10 +144,7 @@ def create_sar_observation_operator(n_params, forward_model, metadata,
     H0, dH
     """
     LOG.info("Creating the ObsOp for band %d" % band)
-    n_times = x_forecast.shape[0] / n_params
-    # good_obs = mask.sum()
-    H_matrix = sp.lil_matrix((n_times, n_params * n_times),
-                             dtype=np.float32)
+    n_times = x_forecast.shape[0] // n_params
     H0 = np.zeros(n_times, dtype=np.float32)
 
     # So the model has spectral components.
@@ -133,30 +154,20 @@ def create_sar_observation_operator(n_params, forward_model, metadata,
     elif band == 1:
         # VH
         polarisation = "VH"
-    # This loop can be JIT'ed
-    x0 = np.zeros((n_times, n_params))
-    theta = np.zeros((n_times))
-    for i, m in enumerate(mask[state_mask].flatten()):
-        if m:
-            x0[i, :] = x_forecast[(n_params * i): (n_params*(i+1))]
-            theta[i] = 23.#metadata['incidence_angle']
+    pixels = np.flatnonzero(mask[state_mask])
+    x0 = gather_state_pixels(x_forecast, n_params, pixels)
+    theta = get_incidence_angle(metadata, mask, state_mask, pixels)
     LOG.info("Running SAR forward model")
     # Calls the run_emulator method that only does different vectors
     # It might be here that we do some sort of clustering
 
-    H0_, dH = forward_model(x0[mask[state_mask]], theta, polarisation)
+    H0_, dH = forward_model(x0, theta, polarisation)
 
     LOG.info("Storing emulators in H matrix")
-    # This loop can be JIT'ed too
-    n = 0
-    
-    for i, m in enumerate(mask[state_mask].flatten()):
-        if m:
-            H_matrix[i, (n_params * i): (n_params*(i+1))] = dH[n]
-            H0[i] = H0_[n]
-            n += 1
+    H0[pixels] = H0_
+    H_matrix = create_pixel_jacobian(dH, pixels, n_times, n_params)
     LOG.info("\tDone!")
-    return (H0, H_matrix.tocsr())
+    return (H0, H_matrix)
 
     # # Calculate Gradient without conversion of sigma_soil from dB to linear
     # grad = x*0
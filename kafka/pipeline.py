@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""Helpers for running the filter as a pipeline of stages (reading,
+linearising, solving and writing), with per-stage timers and queue depth
+counters to find out which stage is the bottleneck."""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import six
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 needs the `futures` backport
+    ThreadPoolExecutor = None
+
+LOG = logging.getLogger(__name__)
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017 J Gomez-Dans"
+__version__ = "1.0 (09.03.2017)"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+
+class PipelineStats(object):
+    """Accumulates the time spent in each stage and the depth of each
+    queue. Safe to use from several threads."""
+    def __init__(self):
+        self.times = OrderedDict()
+        self.calls = OrderedDict()
+        self.depths = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage):
+        """Times the enclosed block as part of `stage`"""
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - t0)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.times[stage] = self.times.get(stage, 0.) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def record_depth(self, queue_name, depth):
+        """Records a sample of the depth of a queue"""
+        with self._lock:
+            n, total, max_depth = self.depths.get(queue_name, (0, 0, 0))
+            self.depths[queue_name] = (n + 1, total + depth,
+                                       max(max_depth, depth))
+
+    def summary(self):
+        """Returns a printable summary of the counters"""
+        with self._lock:
+            lines = ["{:>12s}: {:9.3f} s in {:d} calls".format(
+                     stage, self.times[stage], self.calls[stage])
+                     for stage in self.times]
+            lines += ["{:>12s}: mean depth {:.2f}, max {:d}".format(
+                      name, total/float(n), max_depth)
+                      for name, (n, total, max_depth) in self.depths.items()]
+        return "\n".join(lines)
+
+    def log(self):
+        for line in self.summary().split("\n"):
+            LOG.info(line)
+
+
+class BackgroundWorker(object):
+    """Calls `function` in a background thread for each set of arguments
+    given to `submit`, in order. At most `max_queue` calls are waiting;
+    beyond that, `submit` blocks. The arguments must not be modified after
+    they are submitted. Errors raised by `function` are raised again by the
+    next `submit` or by `close`. The time spent in `function` is recorded
+    in `stats` as stage `name`, and the time `submit` spends waiting for
+    room in the queue as `<name>_wait`."""
+    def __init__(self, function, max_queue=2, stats=None, name="work"):
+        self.function = function
+        self.name = name
+        self.stats = stats if stats is not None else PipelineStats()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self._thread = threading.Thread(target=self._work,
+                                        name="kafka-" + name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self._error is None:
+                    with self.stats.timer(self.name):
+                        self.function(*item)
+            except Exception:
+                self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            six.reraise(*error)
+
+    def submit(self, *args):
+        self._raise_error()
+        self.stats.record_depth(self.name + "_queue", self._queue.qsize())
+        with self.stats.timer(self.name + "_wait"):
+            self._queue.put(args)
+
+    def flush(self):
+        """Waits for all the submitted calls to be done"""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Waits for all the submitted calls to be done, and stops the
+        thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+
+class OutputWriter(BackgroundWorker):
+    """Calls `output.dump_data` in a background thread, so that writing a
+    timestep overlaps with the assimilation of the next one. At most
+    `max_queue` timesteps are waiting to be written; beyond that, `dump_data`
+    blocks. The arrays passed to `dump_data` must not be modified afterwards.
+    Errors raised by the output are raised again by the next `dump_data` or
+    by `close`."""
+    def __init__(self, output, max_queue=2, stats=None):
+        self.output = output
+        super(OutputWriter, self).__init__(output.dump_data,
+                                           max_queue=max_queue, stats=stats,
+                                           name="write")
+
+    def dump_data(self, *args):
+        self.submit(*args)
+
+
+def close_output(output, stats=None):
+    """Waits for an output that writes asynchronously to be done (timed in
+    `stats` as stage `write_flush`), and stops its threads. Outputs with a
+    `close` method are closed, and those with only a `flush` method are
+    flushed."""
+    stats = stats if stats is not None else PipelineStats()
+    with stats.timer("write_flush"):
+        if hasattr(output, "close"):
+            output.close()
+        elif hasattr(output, "flush"):
+            output.flush()
+
+
+class ThreadedMap(object):
+    """Maps a function over a sequence in a pool of `n_threads` threads,
+    returning the results in order. Meant for I/O bound work such as
+    reading and decoding rasters, as GDAL releases the GIL while it does
+    that. The pool is started on first use (and started again in processes
+    forked after that, which don't inherit its threads). With a single
+    thread, or without `concurrent.futures`, the function is mapped in the
+    calling thread."""
+    def __init__(self, n_threads=4):
+        self.n_threads = n_threads
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.n_threads)
+                self._pid = os.getpid()
+            return self._executor
+
+    def map(self, function, items):
+        items = list(items)
+        if self.n_threads < 2 or len(items) < 2 or ThreadPoolExecutor is None:
+            return [function(item) for item in items]
+        return list(self._get_executor().map(function, items))
+
+    def close(self):
+        """Stops the threads"""
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __getstate__(self):
+        # Threads and locks can't be pickled
+        return {"n_threads": self.n_threads}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
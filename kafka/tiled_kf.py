@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+"""Spatial tiling for `LinearKalman`. Pixels are independent (block-diagonal
+priors, per-pixel observation operators and an identity trajectory model),
+so the state mask can be split into rectangular chunks that are run through
+the usual time loop separately, in a pool of worker processes. The analysis
+of each chunk is written to the output as soon as it's done."""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy as np
+
+import scipy.sparse as sp
+
+from inference import BlockDiagonalPrecision, as_state_grid
+from linear_kf import LinearKalman
+from pipeline import close_output
+
+LOG = logging.getLogger(__name__)
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017 J Gomez-Dans"
+__version__ = "1.0 (09.03.2017)"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+Chunk = namedtuple("Chunk", "window state_mask pixels")
+
+# The tiled run and the results queue of a worker process, set by
+# `_init_worker` when the worker starts
+_WORKER = None
+
+
+def define_chunks(state_mask, chunk_size=256):
+    """Splits the bounding box of `state_mask` into windows of at most
+    `chunk_size` (an integer, or a `(rows, cols)` tuple) pixels, and returns
+    a list of `Chunk`s for the windows that have some state pixels. Each
+    chunk has its window (a tuple of row and column slices), its part of the
+    state mask, and the indices of its pixels in the full state vector."""
+    if np.isscalar(chunk_size):
+        chunk_size = (chunk_size, chunk_size)
+    state_grid = as_state_grid(state_mask)
+    if state_grid.n_pixels == 0:
+        return []
+    pixel_index = state_grid.scatter(np.arange(state_grid.n_pixels),
+                                     fill=-1, dtype=np.int64)
+    rows, cols = state_grid.window
+    chunks = []
+    for row0 in xrange(rows.start, rows.stop, chunk_size[0]):
+        for col0 in xrange(cols.start, cols.stop, chunk_size[1]):
+            window = (slice(row0, min(row0 + chunk_size[0], rows.stop)),
+                      slice(col0, min(col0 + chunk_size[1], cols.stop)))
+            chunk_mask = state_grid.mask[window]
+            if chunk_mask.any():
+                chunks.append(Chunk(window, chunk_mask,
+                                    pixel_index[window][chunk_mask]))
+    return chunks
+
+
+def gather_pixels(x, pixels, n_params):
+    """Selects the parameters of `pixels` from a pixel-major state vector"""
+    return x.reshape((-1, n_params))[pixels].ravel()
+
+
+def gather_precision(matrix, pixels, n_params):
+    """Selects the blocks of `pixels` from a block-diagonal (inverse)
+    covariance matrix"""
+    if matrix is None:
+        return None
+    if not isinstance(matrix, BlockDiagonalPrecision):
+        matrix = BlockDiagonalPrecision.from_sparse(matrix, n_params,
+                                                    dtype=matrix.dtype)
+    return matrix.take(pixels)
+
+
+def crop_band_data(data, window, shape, pixels=None):
+    """Crops the rasters of a band data tuple (as returned by the readers'
+    `get_band_data`) to `window`. `shape` is the shape of the full grid.
+    Uncertainty vectors over the state pixels are cropped to the state
+    `pixels` of the window. Sparse uncertainty matrices are assumed
+    diagonal."""
+    n_pixels = shape[0]*shape[1]
+    uncertainty = data.uncertainty
+    if sp.issparse(uncertainty) and uncertainty.shape[0] == n_pixels:
+        diagonal = uncertainty.diagonal().reshape(shape)[window]
+        uncertainty = sp.diags(diagonal.ravel(), format="csr")
+    elif isinstance(uncertainty, np.ndarray) and uncertainty.shape == shape:
+        uncertainty = uncertainty[window]
+    elif isinstance(uncertainty, np.ndarray) and uncertainty.ndim == 1 and \
+            pixels is not None:
+        uncertainty = uncertainty[pixels]
+    metadata = data.metadata
+    if isinstance(metadata, dict):
+        metadata = dict((key, value[window] if isinstance(
+                         value, np.ndarray) and value.shape == shape
+                         else value) for key, value in metadata.items())
+    return data._replace(observations=data.observations[window],
+                         mask=data.mask[window],
+                         uncertainty=uncertainty, metadata=metadata)
+
+
+class WindowedObservations(object):
+    """Restricts an observations object to a window of its grid. Readers
+    that can read a window directly advertise it with a `supports_window`
+    attribute, and are called with a `window` keyword. For the rest, the
+    full band is read and cropped. Any other attribute (e.g. `dates`) is
+    taken from the wrapped object. `pixels` are the indices of the state
+    pixels of the window in the full state vector."""
+    def __init__(self, observations, window, shape, pixels=None):
+        self.observations = observations
+        self.window = window
+        self.shape = shape
+        self.pixels = pixels
+
+    def get_band_data(self, timestep, band):
+        if getattr(self.observations, "supports_window", False):
+            return self.observations.get_band_data(timestep, band,
+                                                   window=self.window)
+        data = self.observations.get_band_data(timestep, band)
+        return crop_band_data(data, self.window, self.shape, self.pixels)
+
+    def get_date_data(self, timestep):
+        """All the bands of `timestep`, read at once if the wrapped object
+        has a `get_date_data` method, or one band at a time otherwise"""
+        if not hasattr(self.observations, "get_date_data"):
+            return [self.get_band_data(timestep, band) for band in
+                    xrange(self.observations.bands_per_observation[timestep])]
+        if getattr(self.observations, "supports_window", False):
+            return self.observations.get_date_data(timestep,
+                                                   window=self.window)
+        return [crop_band_data(data, self.window, self.shape, self.pixels)
+                for data in self.observations.get_date_data(timestep)]
+
+    def __getattr__(self, name):
+        if name in ["observations", "window", "shape", "pixels"]:
+            raise AttributeError(name)
+        return getattr(self.observations, name)
+
+
+class WindowedPrior(object):
+    """Restricts a prior object to some pixels of the state"""
+    def __init__(self, prior, pixels, n_params):
+        self.prior = prior
+        self.pixels = pixels
+        self.n_params = n_params
+
+    def process_prior(self, time, inv_cov=True):
+        mean, cov = self.prior.process_prior(time, inv_cov=inv_cov)
+        return (gather_pixels(mean, self.pixels, self.n_params),
+                gather_precision(cov, self.pixels, self.n_params))
+
+
+class ChunkOutput(object):
+    """Hands the analysis of chunk `i_chunk` to `send`, as an `(i_chunk,
+    timestep, x, P, P_inverse)` tuple, as soon as each timestep is done"""
+    def __init__(self, i_chunk, send):
+        self.i_chunk = i_chunk
+        self.send = send
+
+    def dump_data(self, timestep, x_analysis, P_analysis, P_analysis_inv,
+                  state_mask, n_params):
+        self.send((self.i_chunk, timestep, x_analysis,
+                   gather_precision(P_analysis, slice(None), n_params),
+                   gather_precision(P_analysis_inv, slice(None), n_params)))
+
+
+def _init_worker(run, results):
+    """Worker initialiser: keeps the tiled `run` and the `results` queue
+    the worker's chunks are sent to"""
+    global _WORKER
+    _WORKER = (run, results)
+
+
+def _run_chunk(i_chunk):
+    """Worker entry point: runs chunk `i_chunk` of the worker's tiled run,
+    and sends its analyses back to the parent through the results queue"""
+    run, results = _WORKER
+    run.run_chunk(i_chunk, results.put)
+    # Tells the parent that the chunk is done
+    results.put((i_chunk, None, None, None, None))
+    return i_chunk
+
+
+class TiledKalman(object):
+    """Runs `LinearKalman` on rectangular chunks of the state mask, using a
+    pool of `n_workers` processes (all the cores by default). The arguments
+    are the same as for `LinearKalman`, plus the `chunk_size` (see
+    `define_chunks`). Any other keyword arguments are passed to each chunk's
+    `LinearKalman`.
+
+    Each worker process is given the filter (without its output) when it
+    starts. With the `fork` start method it's inherited from the parent;
+    with `spawn` or `forkserver`, the observations, prior and observation
+    operator need to be picklable. Each worker builds a `LinearKalman` for
+    its chunk, reads the observations for its window only (see
+    `WindowedObservations`) and runs the complete time loop, sending the
+    analysis of each timestep back to the parent (through a queue of at most
+    `max_queue` timesteps) as soon as it's done. The parent does all the
+    writing. If the output has a `dump_window` method (as `KafkaOutput`
+    does), each chunk's window is written straight away, so the parent only
+    ever holds the analysis of one chunk and timestep. Other outputs get the
+    usual `dump_data` calls: the chunks of a timestep are stitched together
+    in files in `scratch_dir` (the system's temporary directory by default),
+    so that timesteps that are waiting for chunks aren't kept in memory.
+    A timestep is written (and its files removed) once all the chunks have
+    got to it. With `n_workers=1`, chunks are run one after the other in this
+    process.
+    """
+    def __init__(self, observations, output, state_mask,
+                 create_observation_operator, parameters_list,
+                 chunk_size=256, n_workers=None, max_queue=None,
+                 scratch_dir=None, **kwargs):
+        self.observations = observations
+        self.output = output
+        self.state_mask = state_mask
+        self.state_grid = as_state_grid(state_mask)
+        self.parameters_list = parameters_list
+        self.n_params = len(parameters_list)
+        self.n_state_elems = self.state_grid.n_pixels
+        self._create_observation_operator = create_observation_operator
+        self.prior = kwargs.pop("prior", None)
+        self.kf_kwargs = kwargs
+        self.chunks = define_chunks(self.state_grid, chunk_size=chunk_size)
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.max_queue = max_queue or 2*self.n_workers
+        self.scratch_dir = scratch_dir
+        self.has_trajectory_model = False
+        self.trajectory_uncertainty = None
+        LOG.info("Split the state mask in {:d} chunks".format(
+            len(self.chunks)))
+
+    def __getstate__(self):
+        # Workers don't write, the output stays in the parent
+        state = self.__dict__.copy()
+        for name in ["output", "_written", "_stitched", "_scratch",
+                     "_scratch_names"]:
+            state.pop(name, None)
+        return state
+
+    def set_trajectory_model(self):
+        """Identity trajectory model, set on each chunk's filter (see
+        `LinearKalman.set_trajectory_model`)"""
+        self.has_trajectory_model = True
+
+    def set_trajectory_uncertainty(self, Q):
+        """Main diagonal of the model uncertainty covariance matrix, for the
+        full state vector (see `LinearKalman.set_trajectory_uncertainty`)"""
+        self.trajectory_uncertainty = np.asarray(Q)
+
+    def _chunk_filter(self, i_chunk, send):
+        """Creates the `LinearKalman` for a chunk"""
+        chunk = self.chunks[i_chunk]
+        prior = None
+        if self.prior is not None:
+            prior = WindowedPrior(self.prior, chunk.pixels, self.n_params)
+        kf = LinearKalman(
+            WindowedObservations(self.observations, chunk.window,
+                                 self.state_grid.shape, chunk.pixels),
+            ChunkOutput(i_chunk, send), chunk.state_mask,
+            self._create_observation_operator, self.parameters_list,
+            prior=prior, **self.kf_kwargs)
+        if self.has_trajectory_model:
+            kf.set_trajectory_model()
+        if self.trajectory_uncertainty is not None:
+            kf.set_trajectory_uncertainty(gather_pixels(
+                self.trajectory_uncertainty, chunk.pixels, self.n_params))
+        return kf
+
+    def run_chunk(self, i_chunk, send):
+        """Runs the time loop for chunk `i_chunk`. The analysis of each
+        timestep is passed to `send` as an `(i_chunk, timestep, x, P,
+        P_inverse)` tuple."""
+        chunk = self.chunks[i_chunk]
+        LOG.info("Running chunk {:d} ({:d} pixels)".format(
+            i_chunk, len(chunk.pixels)))
+        kf = self._chunk_filter(i_chunk, send)
+        x_forecast, P_forecast, P_forecast_inverse = self._initial_state
+        kf.run(self._time_grid,
+               gather_pixels(x_forecast, chunk.pixels, self.n_params),
+               gather_precision(P_forecast, chunk.pixels, self.n_params),
+               gather_precision(P_forecast_inverse, chunk.pixels,
+                                self.n_params),
+               **self._run_kwargs)
+
+    def _run_chunks(self, receive):
+        """Runs all the chunks, calling `receive` with each `(i_chunk,
+        timestep, x, P, P_inverse)` analysis as it arrives"""
+        if self.n_workers == 1:
+            for i_chunk in xrange(len(self.chunks)):
+                self.run_chunk(i_chunk, receive)
+                LOG.info("Chunk {:d} done".format(i_chunk))
+            return
+        # Handed to the workers as they start, so that it's inherited (or
+        # pickled) with the process, as multiprocessing queues must be
+        results = multiprocessing.Queue(maxsize=self.max_queue)
+        pool = multiprocessing.Pool(self.n_workers, _init_worker,
+                                    (self, results))
+        finished = False
+        try:
+            chunk_results = [pool.apply_async(_run_chunk, (i_chunk,))
+                             for i_chunk in xrange(len(self.chunks))]
+            n_done = 0
+            while n_done < len(self.chunks):
+                try:
+                    message = results.get(timeout=1.)
+                except queue.Empty:
+                    # Raises the errors of failed chunks
+                    for chunk_result in chunk_results:
+                        if chunk_result.ready():
+                            chunk_result.get()
+                    continue
+                if message[1] is None:
+                    LOG.info("Chunk {:d} done".format(message[0]))
+                    n_done += 1
+                else:
+                    receive(message)
+            finished = True
+        finally:
+            if finished:
+                pool.close()
+            else:
+                # Workers can't finish while they wait for room in the queue
+                pool.terminate()
+            pool.join()
+
+    def _write_window(self, message):
+        """Writes the analysis of a chunk straight to the output"""
+        i_chunk, timestep, x_analysis, P_analysis, P_analysis_inv = message
+        create = timestep not in self._written
+        self._written.add(timestep)
+        self.output.dump_window(timestep, self.chunks[i_chunk].window,
+                                x_analysis, P_analysis, P_analysis_inv,
+                                self.state_grid, self.n_params,
+                                create=create)
+
+    def _scratch_array(self, shape, dtype):
+        """A zero-filled array, kept in a new file of the scratch directory"""
+        filename = os.path.join(self._scratch, "{:d}.npy".format(
+            next(self._scratch_names)))
+        return np.lib.format.open_memmap(filename, mode="w+", dtype=dtype,
+                                         shape=shape)
+
+    def _stitch(self, message):
+        """Stitches the analysis of a chunk into the full state of its
+        timestep (in the scratch directory), and writes the timestep once
+        all the chunks are in"""
+        i_chunk, timestep, x_analysis, P_analysis, P_analysis_inv = message
+        pixels = self.chunks[i_chunk].pixels
+        if timestep not in self._stitched:
+            self._stitched[timestep] = [
+                self._scratch_array((self.n_state_elems*self.n_params,),
+                                    x_analysis.dtype), None, None, 0]
+        state = self._stitched[timestep]
+        state[0].reshape((-1, self.n_params))[pixels] = \
+            x_analysis.reshape((-1, self.n_params))
+        for i, matrix in [(1, P_analysis), (2, P_analysis_inv)]:
+            if matrix is None:
+                continue
+            if state[i] is None:
+                state[i] = self._scratch_array(
+                    (self.n_state_elems, self.n_params, self.n_params),
+                    matrix.dtype)
+            state[i][pixels] = matrix.blocks
+        state[3] += 1
+        if state[3] < len(self.chunks):
+            return
+        del self._stitched[timestep]
+        # Only the timestep that is written is read into memory
+        filenames = [array.filename for array in state[:3]
+                     if array is not None]
+        x_analysis, P_analysis, P_analysis_inv = [
+            None if array is None else np.array(array)
+            for array in state[:3]]
+        del state[:]
+        for filename in filenames:
+            os.remove(filename)
+        if P_analysis is not None:
+            P_analysis = BlockDiagonalPrecision(P_analysis)
+        if P_analysis_inv is not None:
+            P_analysis_inv = BlockDiagonalPrecision(P_analysis_inv)
+        self.output.dump_data(timestep, x_analysis, P_analysis,
+                              P_analysis_inv, self.state_grid, self.n_params)
+
+    def run(self, time_grid, x_forecast, P_forecast, P_forecast_inverse,
+            **kwargs):
+        """Runs a complete assimilation run, see `LinearKalman.run`. The
+        starting state is given for the full state mask."""
+        self._time_grid = time_grid
+        self._initial_state = (x_forecast,
+                               gather_precision(P_forecast, slice(None),
+                                                self.n_params),
+                               gather_precision(P_forecast_inverse,
+                                                slice(None), self.n_params))
+        self._run_kwargs = kwargs
+        self._written = set()
+        self._stitched = {}
+        if hasattr(self.output, "dump_window"):
+            self._run_chunks(self._write_window)
+        else:
+            self._scratch = tempfile.mkdtemp(prefix="kafka_chunks_",
+                                             dir=self.scratch_dir)
+            self._scratch_names = itertools.count()
+            try:
+                self._run_chunks(self._stitch)
+            finally:
+                self._stitched = {}
+                shutil.rmtree(self._scratch, ignore_errors=True)
+        close_output(self.output)
@@ -27,39 +27,15 @@ except ImportError:
 
 import kafka
 from kafka.input_output import Sentinel2Observations, KafkaOutput
+from kafka.input_output import reproject_image
 from kafka import LinearKalman
-from kafka.inference import block_diag
+from kafka.inference import BlockDiagonalPrecision
 from kafka.inference import propagate_information_filter_LAI
 from kafka.inference import no_propagation
 from kafka.inference import create_prosail_observation_operator
 
 
 
-# Probably should be imported from somewhere else, but I can't see
-# where from ATM... No biggy
-
-def reproject_image(source_img, target_img, dstSRSs=None):
-    """Reprojects/Warps an image to fit exactly another image.
-    Additionally, you can set the destination SRS if you want
-    to or if it isn't defined in the source image."""
-    g = gdal.Open(target_img)
-    geo_t = g.GetGeoTransform()
-    x_size, y_size = g.RasterXSize, g.RasterYSize
-    xmin = min(geo_t[0], geo_t[0] + x_size * geo_t[1])
-    xmax = max(geo_t[0], geo_t[0] + x_size * geo_t[1])
-    ymin = min(geo_t[3], geo_t[3] + y_size * geo_t[5])
-    ymax = max(geo_t[3], geo_t[3] + y_size * geo_t[5])
-    xRes, yRes = abs(geo_t[1]), abs(geo_t[5])
-    if dstSRSs is None:
-        dstSRS = osr.SpatialReference()
-        raster_wkt = g.GetProjection()
-        dstSRS.ImportFromWkt(raster_wkt)
-    else:
-        dstSRS = dstSRSs
-    g = gdal.Warp('', source_img, format='MEM',
-                  outputBounds=[xmin, ymin, xmax, ymax], xRes=xRes, yRes=yRes,
-                  dstSRS=dstSRS)
-    return g
 
 
 
@@ -127,14 +103,13 @@ class SAILPrior(object):
         # Presumably, self._inference_prior has some method to retrieve 
         # a bunch of files for a given date...
         n_pixels = self.state_mask.sum()
-        x0 = np.array([self.mean for i in xrange(n_pixels)]).flatten()
+        x0 = np.tile(self.mean, n_pixels)
         if inv_cov:
-            inv_covar_list = [self.inv_covar for m in xrange(n_pixels)]
-            inv_covar = block_diag(inv_covar_list, dtype=np.float32)
+            inv_covar = BlockDiagonalPrecision.from_block(self.inv_covar,
+                                                          n_pixels)
             return x0, inv_covar
         else:
-            covar_list = [self.covar for m in xrange(n_pixels)]
-            covar = block_diag(covar_list, dtype=np.float32)
+            covar = BlockDiagonalPrecision.from_block(self.covar, n_pixels)
             return x0, covar
         
         
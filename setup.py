@@ -6,6 +6,8 @@ requirements = [
     'pytest',
     'numpy',
     'scipy',
+    'six',
+    'futures; python_version < "3"',
     'gdal',
     # 'BRDF_descriptors', # Not available for automatic installation
     'matplotlib'
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""Fixtures shared by the filter and solver tests: fake observations,
+outputs and priors, a small end-to-end filter run, and a small linear
+problem for the solvers."""
+import datetime
+import os
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+import scipy.sparse as sp
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from kafka.inference import BlockDiagonalPrecision, tip_prior, \
+    create_nonlinear_observation_operator
+from kafka.inference.utils import block_diag, inverse_variance
+
+BandData = namedtuple("BandData",
+                      "observations mask uncertainty metadata emulator")
+PARAMETERS = ["w_vis", "x_vis", "a_vis", "w_nir", "x_nir", "a_nir", "TeLAI"]
+
+
+class TanhEmulator(object):
+    def __init__(self, w):
+        self.w = w
+
+    def predict(self, x, do_unc=False, do_deriv=True):
+        t = np.tanh(x.dot(self.w))
+        return t, (1 - t**2)[:, None]*self.w[None, :]
+
+
+class FakeObservations(object):
+    def __init__(self, shape, dates, state_mask=None):
+        rs = np.random.RandomState(0)
+        emulator = TanhEmulator(np.array([0.3, -0.2, 0.5, 0.1]))
+        self.dates = dates
+        self.bands_per_observation = dict((d, 2) for d in dates)
+        self.data = {}
+        for d in dates:
+            for band in range(2):
+                mask = rs.rand(*shape) > 0.3
+                if state_mask is None:
+                    r = np.where(mask, 1./0.02**2, 0.).ravel()
+                    r = sp.diags(r, format="csr")
+                else:
+                    r = inverse_variance(np.full(shape, 0.02), mask,
+                                         state_mask)
+                self.data[d, band] = BandData(rs.rand(*shape)*0.5, mask, r,
+                                              None, emulator)
+
+    def get_band_data(self, timestep, band):
+        return self.data[timestep, band]
+
+
+class FakeDateObservations(FakeObservations):
+    def get_date_data(self, timestep):
+        return [self.data[timestep, band] for band in range(2)]
+
+
+class FailingObservations(FakeObservations):
+    def get_band_data(self, timestep, band):
+        raise IOError("Corrupt file")
+
+
+class MemoryOutput(object):
+    """Keeps the analysis mean and precision diagonal of each timestep, and
+    the order they are written in"""
+    def __init__(self):
+        self.output = {}
+        self.timesteps = []
+
+    def dump_data(self, timestep, x_analysis, P_analysis, P_analysis_inv,
+                  state_mask, n_params):
+        self.timesteps.append(timestep)
+        self.output[timestep] = (x_analysis, P_analysis_inv.diagonal())
+
+
+class FailingOutput(MemoryOutput):
+    """Fails to write the second timestep"""
+    def dump_data(self, timestep, *args):
+        if len(self.timesteps) == 1:
+            raise IOError("Disk full")
+        super(FailingOutput, self).dump_data(timestep, *args)
+
+
+class WindowOutput(MemoryOutput):
+    """Assembles the chunks written with `dump_window`"""
+    def __init__(self):
+        super(WindowOutput, self).__init__()
+        self.calls = []
+
+    def dump_window(self, timestep, window, x_analysis, P_analysis,
+                    P_analysis_inv, state_mask, n_params, create=False):
+        self.calls.append((timestep, create))
+        n = state_mask.shape[0]*state_mask.shape[1]
+        if create:
+            self.output[timestep] = (np.zeros(n*n_params), np.zeros(
+                n*n_params))
+        index = np.arange(n).reshape(state_mask.shape)
+        index = index[window][np.asarray(state_mask)[window]]
+        for values, image in zip([x_analysis, P_analysis_inv.diagonal()],
+                                 self.output[timestep]):
+            image.reshape((-1, n_params))[index] = values.reshape(
+                (-1, n_params))
+
+
+class TipPrior(object):
+    def __init__(self, state_mask):
+        self.state_mask = state_mask
+
+    def process_prior(self, time, inv_cov=True):
+        mean, _, inv_cov = tip_prior()
+        n_pixels = self.state_mask.sum()
+        return np.tile(mean, n_pixels), \
+            BlockDiagonalPrecision.from_block(inv_cov, n_pixels)
+
+
+def kf_state_mask():
+    """The state mask of `run_kf`"""
+    state_mask = np.zeros((12, 15), dtype=bool)
+    state_mask[2:-2, 3:-3] = True
+    state_mask[5, 5] = False
+    return state_mask
+
+
+def run_kf(kf_class, compact=False, observations_class=FakeObservations,
+           output_class=MemoryOutput, run_options=None, return_output=False,
+           **kwargs):
+    """Runs a `kf_class` filter (made with the extra `kwargs`) over four
+    dates of fake observations, passing `run_options` to its `run`. Returns
+    the analyses written, or the output if `return_output` is set or it
+    isn't a `MemoryOutput`."""
+    state_mask = kf_state_mask()
+    start = datetime.datetime(2017, 1, 1)
+    dates = [start + datetime.timedelta(days=i) for i in range(0, 20, 5)]
+    output = output_class()
+    prior = TipPrior(state_mask)
+    observations = observations_class(state_mask.shape, dates,
+                                      state_mask if compact else None)
+    kwargs.setdefault("solver_mode", "block")
+    kf = kf_class(observations, output,
+                  state_mask, create_nonlinear_observation_operator,
+                  PARAMETERS, state_propagation=None, prior=prior,
+                  linear=False, **kwargs)
+    x_forecast, P_forecast_inv = prior.process_prior(None)
+    kf.set_trajectory_model()
+    kf.set_trajectory_uncertainty(np.zeros_like(x_forecast))
+    time_grid = [start + datetime.timedelta(days=i) for i in range(0, 24, 8)]
+    kf.run(time_grid, x_forecast, None, P_forecast_inv,
+           **(run_options or {}))
+    if return_output or output_class is not MemoryOutput:
+        return output
+    return output.output
+
+
+def linear_problem(n_bands=2, cloud=0.3):
+    """A small random problem with a per-pixel observation operator and the
+    TIP prior. A fraction `cloud` of the pixels are masked in each band."""
+    np.random.seed(42)
+    state_mask = np.zeros((5, 6), dtype=bool)
+    state_mask[1:4, 1:5] = True
+    n_pixels = state_mask.sum()
+    x_prior, c_prior, c_inv_prior = tip_prior()
+    n_params = len(x_prior)
+    x_forecast = np.tile(x_prior, n_pixels)
+    P_forecast_inv = block_diag([c_inv_prior]*n_pixels, dtype=np.float32)
+    observations = []
+    masks = []
+    uncertainties = []
+    H_matrix = []
+    for band in range(n_bands):
+        mask = np.random.rand(*state_mask.shape) > cloud
+        unc = np.where(mask, 0.05, 0.).ravel()
+        R_mat = sp.lil_matrix((unc.shape[0], unc.shape[0]))
+        with np.errstate(divide="ignore"):
+            R_mat.setdiag(1./unc**2)
+        jac = np.random.randn(n_pixels, n_params)
+        jac[np.logical_not(mask[state_mask])] = 0.
+        H = sp.lil_matrix((n_pixels, n_pixels*n_params))
+        for i in range(n_pixels):
+            H[i, (i*n_params):((i + 1)*n_params)] = jac[i]
+        observations.append(np.random.rand(*state_mask.shape))
+        masks.append(mask)
+        uncertainties.append(R_mat.tocsr())
+        H_matrix.append((np.zeros(n_pixels), H.tocsr()))
+    return (observations, masks, state_mask, uncertainties, H_matrix,
+            n_params, x_forecast, P_forecast_inv)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import os
+import sys
+
+import numpy as np
+
+import scipy.sparse as sp
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from kafka.inference.block_diagonal import BlockDiagonalPrecision
+from kafka.inference.kf_tools import blend_prior, tip_prior
+from kafka.inference.utils import marginal_uncertainty
+
+
+def _random_precision(n_pixels=5, n_params=3):
+    np.random.seed(1)
+    blocks = np.random.randn(n_pixels, n_params, n_params)
+    blocks = np.einsum("nij,nkj->nik", blocks, blocks) + \
+        n_params*np.eye(n_params)
+    return BlockDiagonalPrecision(blocks)
+
+
+def test_block_diagonal_matches_dense():
+    P_inv = _random_precision()
+    dense = P_inv.toarray()
+    x = np.random.randn(dense.shape[0])
+    assert np.allclose(P_inv.dot(x), dense.dot(x))
+    assert np.allclose(P_inv.diagonal(), dense.diagonal())
+    assert np.allclose(P_inv.solve(x), np.linalg.solve(dense, x))
+    assert np.allclose(P_inv.inverse().toarray(), np.linalg.inv(dense))
+    assert sp.isspmatrix_bsr(P_inv.tobsr())
+
+
+def test_block_diagonal_arithmetic():
+    P_inv = _random_precision()
+    dense = P_inv.toarray()
+    assert isinstance(P_inv + P_inv, BlockDiagonalPrecision)
+    assert isinstance(P_inv*1., BlockDiagonalPrecision)
+    assert np.allclose((P_inv + P_inv).toarray(), 2*dense)
+    # Mixing with scipy sparse matrices gives a sparse matrix back
+    Q = sp.eye(dense.shape[0], format="csr")
+    assert np.allclose((Q + P_inv).toarray(), dense + np.eye(dense.shape[0]))
+    assert np.allclose((P_inv - Q).toarray(), dense - np.eye(dense.shape[0]))
+
+
+def test_block_diagonal_from_sparse():
+    P_inv = _random_precision()
+    P_inv_2 = BlockDiagonalPrecision.from_sparse(P_inv.tocsr(), 3)
+    assert np.allclose(P_inv.blocks, P_inv_2.blocks)
+
+
+def test_blend_prior_block_diagonal():
+    x_prior, c_prior, c_inv_prior = tip_prior()
+    n_pixels = 4
+    prior_mean = np.tile(x_prior, n_pixels)
+    prior_cov_inverse = BlockDiagonalPrecision.from_block(c_inv_prior,
+                                                          n_pixels)
+    x_forecast = prior_mean*1.1
+    x_combined, combined_cov_inv = blend_prior(
+        prior_mean, prior_cov_inverse, x_forecast, prior_cov_inverse)
+    assert isinstance(combined_cov_inv, BlockDiagonalPrecision)
+    assert np.allclose(x_combined, 0.5*(prior_mean + x_forecast), rtol=1e-4)
+
+
+def test_marginal_uncertainty():
+    P_inv = _random_precision(n_pixels=7)
+    dense_cov = np.linalg.inv(P_inv.toarray())
+    expected = np.sqrt(dense_cov.diagonal())
+    std, cov = marginal_uncertainty(P_inv, 3, full_covariance=True,
+                                    chunk_size=3)
+    assert np.allclose(std, expected, rtol=1e-5)
+    assert np.allclose(cov.toarray(), dense_cov, rtol=1e-4, atol=1e-6)
+    assert np.allclose(marginal_uncertainty(P_inv.tocsr(), 3), expected,
+                       rtol=1e-5)
+    # A singular block only spoils its own pixel
+    P_inv.blocks[2] = 0.
+    std, cov = marginal_uncertainty(P_inv, 3, full_covariance=True,
+                                    chunk_size=3)
+    assert np.all(np.isnan(std[6:9]))
+    assert np.all(np.isnan(cov.blocks[2]))
+    others = np.ones(21, dtype=bool)
+    others[6:9] = False
+    assert np.allclose(std[others], expected[others], rtol=1e-5)
+    assert np.allclose(cov.toarray()[others][:, others],
+                       dense_cov[others][:, others], rtol=1e-4, atol=1e-6)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+from scipy.spatial.distance import cdist
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from kafka.inference.emulator_cache import EmulatorCache
+from kafka.input_output.emulators import ArrayGaussianProcess, \
+    load_array_emulator, save_array_emulator, EmulatorRegistry
+
+
+class ReferenceGP(object):
+    """The prediction code of `gp_emulator.GaussianProcess`"""
+    def __init__(self, n_train=50, n_dims=3):
+        self.inputs = np.random.rand(n_train, n_dims)
+        self.theta = np.random.randn(n_dims + 2)*0.1
+        self.D = n_dims
+        self.invQt = np.random.randn(n_train)
+        Q = np.random.randn(n_train, n_train)
+        self.invQ = Q.dot(Q.T)*1e-3
+
+    def predict(self, testing, do_deriv=True, do_unc=True):
+        (nn, D) = testing.shape
+        expX = np.exp(self.theta)
+        a = cdist(np.sqrt(expX[:(self.D)])*self.inputs,
+                  np.sqrt(expX[:(self.D)])*testing, 'sqeuclidean')
+        a = expX[self.D]*np.exp(-0.5*a)
+        b = expX[self.D]
+        mu = np.dot(a.T, self.invQt)
+        var = b - np.sum(a*np.dot(self.invQ, a), axis=0)
+        deriv = np.zeros((nn, self.D))
+        for d in range(self.D):
+            aa = self.inputs[:, d].flatten()[None, :] - \
+                testing[:, d].flatten()[:, None]
+            c = a*aa.T
+            deriv[:, d] = expX[d]*np.dot(c.T, self.invQt)
+        if do_unc:
+            return mu, var, deriv
+        return mu, deriv
+
+
+def test_array_emulator_matches_gp():
+    np.random.seed(42)
+    gp = ReferenceGP()
+    x = np.random.rand(20, 3)
+    folder = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(folder, "emulator.emu")
+        save_array_emulator({"band_1": gp}, fname)
+        emulator = load_array_emulator(fname)["band_1"]
+        assert isinstance(emulator, ArrayGaussianProcess)
+        assert isinstance(emulator.inputs, np.memmap)
+        for result, expected in zip(emulator.predict(x),
+                                    gp.predict(x)):
+            assert np.allclose(result, expected)
+        H, dH = emulator.predict(x, do_unc=False)
+        assert np.allclose(H, gp.predict(x, do_unc=False)[0])
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_registry_prefers_array_emulators():
+    folder = tempfile.mkdtemp()
+    try:
+        for ext in [".pkl", ".emu"]:
+            open(os.path.join(folder, "prosail_10_20_30" + ext), 'w').close()
+        open(os.path.join(folder, "prosail_0_20_30.pkl"), 'w').close()
+        registry = EmulatorRegistry(folder, loader=lambda fname: fname)
+        assert len(registry.files) == 2
+        assert registry.find(20, 0, 10, 30).endswith("prosail_10_20_30.emu")
+    finally:
+        shutil.rmtree(folder)
+
+
+def _emulator_folder(sizes):
+    """A folder with empty-ish emulator files of the given sizes, one per
+    view zenith angle"""
+    folder = tempfile.mkdtemp()
+    for vza, size in enumerate(sizes):
+        with open(os.path.join(folder, "prosail_{:d}_20_30.pkl".format(vza)),
+                  'w') as fp:
+            fp.write("x"*size)
+    return folder
+
+
+def test_registry_loads_once_per_geometry():
+    folder = _emulator_folder([10, 10])
+    try:
+        registry = EmulatorRegistry(folder, loader=lambda fname: [fname])
+        # The ten bands of a date share one emulator file, and one load
+        emulators = [registry.get_emulator(20, 0, 1, 30) for band in range(10)]
+        assert registry.n_loads == 1
+        assert all(emulator is emulators[0] for emulator in emulators)
+        registry.get_emulator(20, 0, 0, 30)
+        assert registry.n_loads == 2
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_registry_eviction():
+    folder = _emulator_folder([10, 10, 10, 25])
+    try:
+        registry = EmulatorRegistry(folder, max_loaded=2,
+                                    loader=lambda fname: [fname])
+        files = registry.files
+        for fname in [files[0], files[1], files[0], files[2]]:
+            registry.get(fname)
+        # Least recently used goes first
+        assert list(registry._loaded.keys()) == [files[0], files[2]]
+        registry.get(files[0])
+        assert registry.n_loads == 3
+        # Evicted by size
+        registry = EmulatorRegistry(folder, max_loaded=10, max_bytes=30,
+                                    loader=lambda fname: [fname])
+        for fname in files[:3]:
+            registry.get(fname)
+        assert list(registry._loaded.keys()) == files[:3]
+        registry.get(files[3])
+        assert list(registry._loaded.keys()) == [files[3]]
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_registry_concurrent_loads():
+    folder = _emulator_folder([10, 10])
+    started = threading.Event()
+    release = threading.Event()
+    loads = []
+
+    def slow_loader(fname):
+        loads.append(fname)
+        if fname.endswith("prosail_1_20_30.pkl"):
+            started.set()
+            release.wait()
+        return [fname]
+
+    try:
+        registry = EmulatorRegistry(folder, loader=slow_loader)
+        fast, slow = registry.files
+        registry.get(fast)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            registry.get(slow))) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        started.wait()
+        # Cached emulators are served while another one is loading
+        cached = threading.Thread(target=registry.get, args=(fast,))
+        cached.start()
+        cached.join(10)
+        assert not cached.is_alive()
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert loads == [fast, slow]
+        assert len(results) == 4
+        assert all(result is results[0] for result in results)
+    finally:
+        release.set()
+        shutil.rmtree(folder)
+
+
+def test_registry_cache_keys():
+    folder = _emulator_folder([10, 10])
+    try:
+        np.random.seed(42)
+        registry = EmulatorRegistry(
+            folder, max_loaded=1,
+            loader=lambda fname: {"band_1": ReferenceGP(), "band_2": [fname]})
+        first, second = registry.files
+        emulator = registry.get(first)
+        assert emulator["band_1"].cache_key == (first, "band_1")
+        cache = EmulatorCache()
+        x = np.random.rand(5, 3)
+        H, dH = cache.wrap(emulator["band_1"]).predict(x)
+        # A reloaded emulator is a new object, but its entries are still
+        # in the cache
+        registry.get(second)
+        reloaded = registry.get(first)["band_1"]
+        assert reloaded is not emulator["band_1"]
+        H_cached, dH_cached = cache.wrap(reloaded).predict(x)
+        assert registry.n_loads == 3
+        assert cache.hits == 5 and cache.misses == 5
+        assert np.all(H_cached == H)
+    finally:
+        shutil.rmtree(folder)
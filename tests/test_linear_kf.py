@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+import logging
+import os
+import sys
+import threading
+
+import numpy as np
+
+import pytest
+
+import scipy.sparse as sp
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+sys.path.insert(0, myPath)
+
+from kafka.inference import SolverContext, pixel_cost, utils
+from kafka.linear_kf import LinearKalman, PixelIterations
+from kafka.tiled_kf import TiledKalman
+from kf_helpers import FailingOutput, FakeObservations, MemoryOutput, \
+    TanhEmulator, run_kf
+
+
+class RecordingKalman(LinearKalman):
+    """Keeps a reference to the filter, to look at its diagnostics"""
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingKalman, self).__init__(*args, **kwargs)
+        RecordingKalman.instances.append(self)
+
+
+class ClosingOutput(MemoryOutput):
+    """Records whether it's been closed, and whether anything was written
+    after that"""
+    def __init__(self):
+        super(ClosingOutput, self).__init__()
+        self.closed = False
+
+    def dump_data(self, *args):
+        assert not self.closed
+        super(ClosingOutput, self).dump_data(*args)
+
+    def close(self):
+        self.closed = True
+
+
+def test_global_convergence():
+    # By default, all the pixels take the same number of iterations
+    result = run_kf(RecordingKalman)
+    kf = RecordingKalman.instances[-1]
+    assert not kf.per_pixel_convergence
+    assert len(kf.iteration_histograms) == 4
+    for histogram in kf.iteration_histograms.values():
+        assert np.count_nonzero(histogram) == 1
+        assert histogram[-1] == kf.n_state_elems
+        assert len(histogram) > 2
+    expected = run_kf(LinearKalman, per_pixel_convergence=False)
+    for timestep in expected:
+        assert np.all(result[timestep][0] == expected[timestep][0])
+
+
+class ClearObservations(FakeObservations):
+    """Observations of every pixel in every band"""
+    def __init__(self, shape, dates, state_mask=None):
+        super(ClearObservations, self).__init__(shape, dates, state_mask)
+        for key, data in self.data.items():
+            mask = np.ones(shape, dtype=bool)
+            self.data[key] = data._replace(
+                mask=mask, uncertainty=sp.diags(np.full(mask.size,
+                                                        1./0.02**2)))
+
+
+class CountingKalman(RecordingKalman):
+    """Counts the pixels that are linearised"""
+    def __init__(self, *args, **kwargs):
+        super(CountingKalman, self).__init__(*args, **kwargs)
+        self.n_linearised = 0
+        create_observation_operator = self._create_observation_operator
+
+        def counting_operator(n_params, emulator, metadata, mask,
+                              state_mask, x, band):
+            self.n_linearised += self.state_grid.gather(mask).sum()
+            return create_observation_operator(
+                n_params, emulator, metadata, mask, state_mask, x, band)
+        self._create_observation_operator = counting_operator
+
+
+def test_solver_context():
+    # The sparse solves only go through a context if one is given
+    expected = run_kf(RecordingKalman, solver_mode="splu")
+    assert RecordingKalman.instances[-1].solver_context is None
+    context = SolverContext(use_cholmod=False)
+    result = run_kf(LinearKalman, solver_mode="splu", solver_context=context)
+    assert context.n_factorisations > 0
+    for timestep in expected:
+        for field in range(2):
+            assert np.allclose(result[timestep][field],
+                               expected[timestep][field], rtol=1e-4,
+                               atol=1e-4)
+
+
+def test_compact_solve():
+    # Leaving the unobserved pixels out of the solves doesn't change the
+    # analysis
+    for solver_mode in ["splu", "block"]:
+        expected = run_kf(LinearKalman, solver_mode=solver_mode)
+        result = run_kf(LinearKalman, solver_mode=solver_mode,
+                        compact_solve=True)
+        for timestep in expected:
+            for field in range(2):
+                assert np.allclose(result[timestep][field],
+                                   expected[timestep][field], rtol=1e-4,
+                                   atol=1e-4)
+
+
+def test_per_pixel_convergence():
+    run_kf(CountingKalman, observations_class=ClearObservations,
+           per_pixel_convergence=True)
+    kf = CountingKalman.instances[-1]
+    n_pixels = kf.n_state_elems
+    assert len(kf.iteration_histograms) == 4
+    n_iterations = 0
+    for histogram in kf.iteration_histograms.values():
+        assert histogram.sum() == n_pixels
+        # Nobody stops before the minimum number of iterations, and not
+        # everybody stops at once
+        assert histogram[:2].sum() == 0
+        assert np.count_nonzero(histogram) > 1
+        n_iterations += (np.arange(len(histogram))*histogram).sum()
+    # Frozen pixels aren't linearised again
+    assert kf.n_linearised == 2*n_iterations
+
+
+def test_frozen_pixels():
+    # Each pixel stops (and keeps its analysis) as if it was on its own
+    expected = run_kf(LinearKalman, per_pixel_convergence=True)
+    result = run_kf(TiledKalman, chunk_size=1, n_workers=1,
+                    per_pixel_convergence=True)
+    for timestep in expected:
+        for field in range(2):
+            assert np.all(result[timestep][field] ==
+                          expected[timestep][field])
+
+class CostKalman(RecordingKalman):
+    """Records, for each date, the cost of each pixel at the analysis and
+    the lowest cost the iteration strategy was given"""
+    def __init__(self, *args, **kwargs):
+        super(CostKalman, self).__init__(*args, **kwargs)
+        self.costs = []
+
+    def _evaluate_strategy(self, strategy, Y, MASK, UNC, H_matrix, x,
+                           x_forecast, P_forecast_inverse, active):
+        cost = pixel_cost(Y, MASK, self.state_grid, UNC, H_matrix,
+                          self.n_params, x, x_forecast, P_forecast_inverse)
+        self.cost_seen[active] = np.minimum(self.cost_seen, cost)[active]
+        return super(CostKalman, self)._evaluate_strategy(
+            strategy, Y, MASK, UNC, H_matrix, x, x_forecast,
+            P_forecast_inverse, active)
+
+    def do_all_bands(self, timestep, current_data, x_forecast, P_forecast,
+                     P_forecast_inverse, **kwargs):
+        self.cost_seen = np.full(self.n_state_elems, np.inf)
+        result = super(CostKalman, self).do_all_bands(
+            timestep, current_data, x_forecast, P_forecast,
+            P_forecast_inverse, **kwargs)
+        iterations = PixelIterations(self.n_state_elems, self.n_params)
+        Y, MASK, UNC, META, H_matrix = self._linearise_bands(
+            current_data, result[0], iterations)
+        cost = pixel_cost(Y, MASK, self.state_grid, UNC, H_matrix,
+                          self.n_params, result[0], x_forecast,
+                          P_forecast_inverse)
+        self.costs.append((cost, self.cost_seen))
+        return result
+
+
+def test_iteration_strategies():
+    # Where Gauss-Newton behaves, the strategies take its steps (bar the
+    # last ones, if rounding makes them look worse)
+    expected = run_kf(LinearKalman)
+    for strategy in ["levenberg-marquardt", "line-search"]:
+        result = run_kf(RecordingKalman, iteration_strategy=strategy)
+        kf = RecordingKalman.instances[-1]
+        assert kf.iteration_strategy.name == strategy
+        for timestep in expected:
+            for field in range(2):
+                assert np.allclose(result[timestep][field],
+                                   expected[timestep][field],
+                                   rtol=1e-6, atol=1e-4)
+    # Where it doesn't, no analysis is worse than the best point found (up
+    # to rounding)
+    for strategy in ["levenberg-marquardt", "line-search"]:
+        run_kf(CostKalman, observations_class=SteepObservations,
+               iteration_strategy=strategy)
+        for cost, cost_seen in CostKalman.instances[-1].costs:
+            assert np.all(cost <= cost_seen + 1e-9)
+
+
+class SteepObservations(FakeObservations):
+    """Zero observations of a steep emulator, where Gauss-Newton steps
+    overshoot"""
+    def __init__(self, shape, dates, state_mask=None):
+        super(SteepObservations, self).__init__(shape, dates, state_mask)
+        emulator = TanhEmulator(15.*np.array([0.3, -0.2, 0.5, 0.1]))
+        for key, data in self.data.items():
+            self.data[key] = data._replace(
+                observations=np.zeros_like(data.observations),
+                emulator=emulator)
+
+
+def test_strategies_stop_overshooting():
+    max_iterations = {}
+    for strategy in ["gauss-newton", "levenberg-marquardt", "line-search"]:
+        run_kf(RecordingKalman, observations_class=SteepObservations,
+               iteration_strategy=strategy, per_pixel_convergence=True)
+        histograms = RecordingKalman.instances[-1].iteration_histograms
+        max_iterations[strategy] = max(
+            len(histogram) - 1 for histogram in histograms.values())
+    # Gauss-Newton bails out on some pixels, the others converge
+    assert max_iterations["gauss-newton"] == 26
+    assert max_iterations["levenberg-marquardt"] < 26
+    assert max_iterations["line-search"] < 10
+
+
+def test_pipeline_matches_serial():
+    serial = run_kf(LinearKalman, return_output=True)
+    pipelined = run_kf(LinearKalman, return_output=True,
+                       run_options=dict(pipeline=True, max_queue=1))
+    assert serial.timesteps == sorted(serial.output)
+    assert pipelined.timesteps == serial.timesteps
+    for timestep in serial.output:
+        for field in range(2):
+            assert np.all(pipelined.output[timestep][field] ==
+                          serial.output[timestep][field])
+
+
+def test_pipeline_writer_errors():
+    # The error of the writer thread reaches the caller, with the traceback
+    # of the output
+    with pytest.raises(IOError) as error:
+        run_kf(LinearKalman, output_class=FailingOutput,
+               run_options=dict(pipeline=True, max_queue=1))
+    assert error.traceback[-1].name == "dump_data"
+
+
+class BrokenDiskOutput(MemoryOutput):
+    """Fails to write anything, and lets the filter know when it has"""
+    def __init__(self):
+        super(BrokenDiskOutput, self).__init__()
+        self.failed = threading.Event()
+
+    def dump_data(self, *args):
+        self.failed.set()
+        raise IOError("Disk full")
+
+
+class FailingForecastKalman(LinearKalman):
+    """Fails to advance the state, once the first write has failed"""
+    def advance(self, *args):
+        self.output.output.failed.wait(10)
+        raise ValueError("Bad trajectory model")
+
+
+def test_pipeline_keeps_run_errors(caplog):
+    # The error that stopped the run is the one raised, and the error of
+    # the writer thread is logged
+    with pytest.raises(ValueError):
+        run_kf(FailingForecastKalman, output_class=BrokenDiskOutput,
+               run_options=dict(pipeline=True))
+    errors = [record for record in caplog.records
+              if record.levelno == logging.ERROR]
+    assert len(errors) == 1
+    assert "Disk full" in errors[0].exc_text
+
+
+def test_emulation_options(monkeypatch):
+    # The options reach the emulator runs of the observation operator
+    calls = []
+    run_emulator = utils.run_emulator
+
+    def recording_run_emulator(gp, x, **kwargs):
+        calls.append(kwargs)
+        return run_emulator(gp, x, **kwargs)
+
+    monkeypatch.setattr(utils, "run_emulator", recording_run_emulator)
+    exact = run_kf(LinearKalman)
+    assert calls and all(kwargs == {} for kwargs in calls)
+    calls[:] = []
+    options = dict(max_unique=10, lut_size=4, tol=1e-8)
+    bounded = run_kf(LinearKalman, emulation_options=options)
+    assert calls and all(kwargs == options for kwargs in calls)
+    for timestep in exact:
+        assert np.allclose(bounded[timestep][0], exact[timestep][0],
+                           rtol=1e-4, atol=1e-4)
+
+
+def test_run_closes_output():
+    for pipeline in [False, True]:
+        output = run_kf(LinearKalman, output_class=ClosingOutput,
+                        run_options=dict(pipeline=pipeline))
+        assert output.closed
+        assert len(output.timesteps) == 2
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+import datetime
+import os
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from kafka.input_output.observation_cache import CachedObservations
+from kafka.inference.utils import inverse_variance
+
+BandData = namedtuple("BandData",
+                      "observations uncertainty mask metadata emulator")
+
+
+class FileObservations(object):
+    """Two bands a date, each read from its own file"""
+    supports_window = True
+
+    def __init__(self, folder, dates, state_mask):
+        self.folder = folder
+        self.dates = dates
+        self.state_mask = state_mask
+        self.bands_per_observation = dict((date, 2) for date in dates)
+        self.reads = []
+        for date in dates:
+            for band in range(2):
+                with open(self._fname(date, band), 'w') as fp:
+                    fp.write("data")
+
+    def _fname(self, date, band):
+        return os.path.join(self.folder, "{:%Y%m%d}_{:d}.tif".format(date,
+                                                                   band))
+
+    def get_band_files(self, timestep, band):
+        return [self._fname(timestep, band)]
+
+    def get_band_emulator(self, timestep, band):
+        return "emulator_{:d}".format(band)
+
+    def get_band_data(self, timestep, band, window=None):
+        self.reads.append((timestep, band))
+        rng = np.random.RandomState(timestep.day*10 + band)
+        rho = rng.rand(*self.state_mask.shape).astype(np.float32)
+        mask = rho > 0.2
+        metadata = {"sza": 30. + band, "incidence_angle": rho*90.}
+        return BandData(rho, inverse_variance(rho*0.05, mask, self.state_mask),
+                        mask, metadata, self.get_band_emulator(timestep,
+                                                               band))
+
+
+class DateFileObservations(FileObservations):
+    """Reads both bands of a date at once"""
+    def get_date_data(self, timestep):
+        return [self.get_band_data(timestep, band) for band in range(2)]
+
+
+def _state_mask():
+    state_mask = np.zeros((9, 12), dtype=bool)
+    state_mask[2:7, 3:10] = True
+    state_mask[4, 5] = False
+    return state_mask
+
+
+def test_cached_band_data(tmpdir):
+    state_mask = _state_mask()
+    dates = [datetime.datetime(2017, 7, day) for day in [1, 11]]
+    observations = FileObservations(str(tmpdir), dates, state_mask)
+    cache_folder = str(tmpdir.join("cache"))
+    expected = [CachedObservations(observations, cache_folder).get_date_data(
+        date) for date in dates]
+    assert len(observations.reads) == 4
+    # A new run doesn't read anything
+    observations.reads = []
+    cached = CachedObservations(observations, cache_folder)
+    for date, date_data in zip(dates, expected):
+        for band, data in enumerate(date_data):
+            result = cached.get_band_data(date, band)
+            assert type(result) is BandData
+            assert np.all(result.observations[state_mask] ==
+                          data.observations[state_mask])
+            assert np.all(result.observations[~state_mask] == 0)
+            assert np.all(result.mask == (data.mask & state_mask))
+            assert np.all(result.uncertainty == data.uncertainty)
+            assert result.metadata["sza"] == data.metadata["sza"]
+            assert np.allclose(result.metadata["incidence_angle"][state_mask],
+                               data.metadata["incidence_angle"][state_mask])
+            assert result.emulator == data.emulator
+    assert observations.reads == []
+    assert cached.n_hits == 4
+    # Windows of the cached band data
+    window = (slice(3, 8), slice(0, 6))
+    data = expected[0][1]
+    result = cached.get_band_data(dates[0], 1, window=window)
+    assert result.observations.shape == (5, 6)
+    assert np.all(result.uncertainty ==
+                  inverse_variance(data.observations[window]*0.05,
+                                   data.mask[window], state_mask[window]))
+
+
+def test_cache_invalidation(tmpdir):
+    state_mask = _state_mask()
+    date = datetime.datetime(2017, 7, 1)
+    observations = FileObservations(str(tmpdir), [date], state_mask)
+    cache_folder = str(tmpdir.join("cache"))
+    CachedObservations(observations, cache_folder).get_band_data(date, 0)
+    CachedObservations(observations, cache_folder).get_band_data(date, 0)
+    assert len(observations.reads) == 1
+    # Changed products are read again
+    fname = observations.get_band_files(date, 0)[0]
+    stat = os.stat(fname)
+    os.utime(fname, (stat.st_atime, stat.st_mtime + 10))
+    CachedObservations(observations, cache_folder).get_band_data(date, 0)
+    assert len(observations.reads) == 2
+    # And so are they on a different state grid
+    state_mask[0, 0] = True
+    CachedObservations(observations, cache_folder,
+                       state_mask=state_mask).get_band_data(date, 0)
+    assert len(observations.reads) == 3
+
+
+def test_cached_date_data(tmpdir):
+    state_mask = _state_mask()
+    date = datetime.datetime(2017, 7, 1)
+    observations = DateFileObservations(str(tmpdir), [date], state_mask)
+    cached = CachedObservations(observations, str(tmpdir.join("cache")))
+    cached.get_band_data(date, 0)
+    # The date is read at once, but only the band that wasn't cached is a
+    # miss
+    date_data = cached.get_date_data(date)
+    assert len(date_data) == 2
+    assert observations.reads == [(date, 0), (date, 0), (date, 1)]
+    assert (cached.n_hits, cached.n_misses) == (1, 2)
+    assert cached.get_date_data(date)[1].uncertainty.ndim == 1
+    assert (cached.n_hits, cached.n_misses) == (3, 2)
+    assert len(observations.reads) == 3
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+import datetime
+import os
+import sys
+
+import numpy as np
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+import kafka.input_output.observations as observations
+from kafka.inference import BlockDiagonalPrecision
+
+
+class MemoryBand(object):
+    def __init__(self, nx, ny):
+        self.description = None
+        self.data = np.zeros((ny, nx), dtype=np.float32)
+
+    def SetDescription(self, description):
+        self.description = description
+
+    def WriteArray(self, data, xoff=0, yoff=0):
+        self.data[yoff:yoff + data.shape[0],
+                  xoff:xoff + data.shape[1]] = data
+
+
+class MemoryDataset(object):
+    def __init__(self, nx, ny, n_bands):
+        self.bands = [MemoryBand(nx, ny) for i in range(n_bands)]
+
+    def SetProjection(self, projection):
+        pass
+
+    def SetGeoTransform(self, geotransform):
+        pass
+
+    def GetRasterBand(self, band):
+        return self.bands[band - 1]
+
+    def FlushCache(self):
+        pass
+
+
+class MemoryDriver(object):
+    def __init__(self):
+        self.files = {}
+
+    def Create(self, fname, nx, ny, n_bands, data_type, options=None):
+        self.files[fname] = MemoryDataset(nx, ny, n_bands)
+        return self.files[fname]
+
+
+def _memory_driver(monkeypatch):
+    driver = MemoryDriver()
+    monkeypatch.setattr(observations.gdal, "GetDriverByName",
+                        lambda name: driver, raising=False)
+    monkeypatch.setattr(observations.gdal, "Open",
+                        lambda fname, mode=0: driver.files.get(fname),
+                        raising=False)
+    monkeypatch.setattr(observations.gdal, "GA_Update", 1, raising=False)
+    return driver
+
+
+def test_multiband_output(monkeypatch):
+    driver = _memory_driver(monkeypatch)
+    state_mask = np.zeros((3, 4), dtype=bool)
+    state_mask[1:, 1:] = True
+    n_pixels = state_mask.sum()
+    x = np.arange(2*n_pixels, dtype=np.float64)
+    P_inv = BlockDiagonalPrecision.from_block(np.diag([4., 16.]), n_pixels)
+    output = observations.KafkaMultibandOutput(["lai", "sm"], None, None,
+                                               "/tmp", prefix="test")
+    output.dump_data(datetime.datetime(2017, 1, 1), x, None, P_inv,
+                     state_mask, 2)
+    output.flush()
+    mean = driver.files["/tmp/test_A2017001.tif"].bands
+    unc = driver.files["/tmp/test_A2017001_unc.tif"].bands
+    assert [band.description for band in mean] == ["lai", "sm"]
+    assert np.all(mean[1].data[state_mask] == x[1::2])
+    assert np.all(mean[1].data[~state_mask] == 0)
+    assert np.allclose(unc[0].data[state_mask], 0.5)
+    assert np.allclose(unc[1].data[state_mask], 0.25)
+
+
+def test_exact_uncertainty(monkeypatch):
+    driver = _memory_driver(monkeypatch)
+    state_mask = np.ones((2, 2), dtype=bool)
+    # Correlated parameters, so the marginal standard deviations differ from
+    # the inverse square root of the diagonal
+    block = np.array([[4., 3.], [3., 16.]])
+    P_inv = BlockDiagonalPrecision.from_block(block, 4)
+    x = np.zeros(8)
+    expected = np.sqrt(np.linalg.inv(block).diagonal())
+    for prefix, exact in [("exact", True), ("approx", False)]:
+        output = observations.KafkaMultibandOutput(
+            ["lai", "sm"], None, None, "/tmp", prefix=prefix,
+            exact_uncertainty=exact)
+        output.dump_data(datetime.datetime(2017, 1, 1), x, None, P_inv,
+                         state_mask, 2)
+        output.close()
+    unc = driver.files["/tmp/exact_A2017001_unc.tif"].bands
+    for band, std in zip(unc, expected):
+        assert np.allclose(band.data, std, rtol=1e-6)
+    unc = driver.files["/tmp/approx_A2017001_unc.tif"].bands
+    for band, diagonal in zip(unc, block.diagonal()):
+        assert np.allclose(band.data, 1./np.sqrt(diagonal), rtol=1e-6)
+
+
+def test_windowed_output(monkeypatch):
+    driver = _memory_driver(monkeypatch)
+    state_mask = np.zeros((5, 6), dtype=bool)
+    state_mask[1:, 1:5] = True
+    state_mask[2, 2] = False
+    n_pixels = state_mask.sum()
+    x = np.arange(2*n_pixels, dtype=np.float64)
+    P_inv = BlockDiagonalPrecision.from_block(np.diag([4., 16.]), n_pixels)
+    timestep = datetime.datetime(2017, 1, 1)
+    windows = [(slice(0, 3), slice(0, 6)), (slice(3, 5), slice(0, 6))]
+    pixel_index = np.zeros(state_mask.shape, dtype=np.int64)
+    pixel_index[state_mask] = np.arange(n_pixels)
+    multiband = observations.KafkaMultibandOutput(["lai", "sm"], None, None,
+                                                  "/tmp", prefix="window")
+    single = observations.KafkaOutput(["lai", "sm"], None, None, "/tmp")
+    for output in [multiband, single]:
+        for i, window in enumerate(windows):
+            pixels = pixel_index[window][state_mask[window]]
+            x_window = x.reshape((-1, 2))[pixels].ravel()
+            output.dump_window(timestep, window, x_window, None,
+                               P_inv.take(pixels), state_mask, 2,
+                               create=i == 0)
+    multiband.flush()
+    # The same files as writing the whole grid at once
+    lai = driver.files["/tmp/window_A2017001.tif"].bands[0].data
+    assert np.all(lai[state_mask] == x[::2])
+    assert np.all(lai[~state_mask] == 0)
+    sm = driver.files["/tmp/sm_A2017001.tif"].bands[0].data
+    assert np.all(sm[state_mask] == x[1::2])
+    unc = driver.files["/tmp/sm_A2017001_unc.tif"].bands[0].data
+    assert np.allclose(unc[state_mask], 0.25)
+
+
+def test_multiband_output_close(monkeypatch):
+    driver = _memory_driver(monkeypatch)
+    state_mask = np.ones((2, 3), dtype=bool)
+    x = np.arange(12, dtype=np.float64)
+    P_inv = BlockDiagonalPrecision.from_block(np.diag([4., 16.]), 6)
+    with observations.KafkaMultibandOutput(["lai", "sm"], None, None, "/tmp",
+                                           prefix="close") as output:
+        output.dump_data(datetime.datetime(2017, 1, 1), x, None, P_inv,
+                         state_mask, 2)
+        writer = output._writer
+    # Leaving the block writes the queued timesteps and stops the thread
+    assert not writer._thread.is_alive()
+    assert output._writer is None
+    assert "/tmp/close_A2017001.tif" in driver.files
+    # Writing again starts a new thread, which `close` stops
+    output.dump_data(datetime.datetime(2017, 1, 2), x, None, P_inv,
+                     state_mask, 2)
+    writer = output._writer
+    output.close()
+    assert not writer._thread.is_alive()
+    lai = driver.files["/tmp/close_A2017002.tif"].bands[0].data
+    assert np.all(lai[state_mask] == x[::2])
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+import os
+import sys
+import threading
+
+import pytest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from kafka.pipeline import OutputWriter, PipelineStats, ThreadedMap
+
+
+class ListOutput(object):
+    def __init__(self, fail_at=None):
+        self.written = []
+        self.fail_at = fail_at
+
+    def dump_data(self, timestep, *args):
+        if timestep == self.fail_at:
+            raise IOError("Disk full")
+        self.written.append(timestep)
+
+
+def test_output_writer_keeps_order():
+    stats = PipelineStats()
+    output = ListOutput()
+    writer = OutputWriter(output, max_queue=2, stats=stats)
+    for timestep in range(10):
+        writer.dump_data(timestep, None)
+    writer.close()
+    assert output.written == range(10)
+    assert stats.calls["write"] == 10
+    assert stats.depths["write_queue"][2] <= 2
+
+
+def test_output_writer_raises_errors():
+    writer = OutputWriter(ListOutput(fail_at=3))
+    with pytest.raises(IOError):
+        for timestep in range(10):
+            writer.dump_data(timestep, None)
+        writer.close()
+
+
+def test_threaded_map_keeps_order():
+    # Each item waits for the next one to be done, so they finish in
+    # reverse order
+    done = [threading.Event() for x in range(6)]
+    done[5].set()
+
+    def reverse_square(x):
+        assert done[x + 1].wait(10.)
+        done[x].set()
+        return x*x
+    mapper = ThreadedMap(n_threads=5)
+    assert mapper.map(reverse_square, range(5)) == [0, 1, 4, 9, 16]
+    mapper.close()
+    # A single thread runs in the caller
+    assert ThreadedMap(n_threads=1).map(lambda x: x*x, range(3)) == [0, 1, 4]
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+import datetime
+import os
+import sys
+import threading
+import time
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from kafka.input_output.prefetch import PrefetchingObservations
+from kafka.input_output.prefetch import ParallelBandObservations
+
+
+class RecordingObservations(object):
+    """Records the bands read, and the threads they are read in"""
+    def __init__(self, dates):
+        self.dates = dates
+        self.bands_per_observation = dict((d, 2) for d in dates)
+        self.reads = []
+        self.threads = set()
+        self._read_done = threading.Condition()
+
+    def _record(self, key):
+        with self._read_done:
+            self.reads.append(key)
+            self.threads.add(threading.current_thread().name)
+            self._read_done.notify_all()
+
+    def get_band_data(self, timestep, band):
+        self._record((timestep, band))
+        return (timestep, band)
+
+    def wait_for_read(self, key, timeout=10.):
+        """Waits until `key` has been read, and returns whether it was"""
+        deadline = time.time() + timeout
+        with self._read_done:
+            while key not in self.reads and time.time() < deadline:
+                self._read_done.wait(deadline - time.time())
+            return key in self.reads
+
+
+def test_prefetching_observations():
+    start = datetime.datetime(2017, 1, 1)
+    dates = [start + datetime.timedelta(days=i) for i in range(6)]
+    time_grid = [start + datetime.timedelta(days=i) for i in range(0, 8, 2)]
+    observations = RecordingObservations(dates)
+    prefetched = PrefetchingObservations(observations, time_grid=time_grid)
+    assert prefetched.bands_per_observation is \
+        observations.bands_per_observation
+    for date, next_date in zip(dates, dates[1:] + [None]):
+        for band in range(2):
+            assert prefetched.get_band_data(date, band) == (date, band)
+        if next_date is not None:
+            # While we "solve", the next date is read without asking
+            assert observations.wait_for_read((next_date, 1))
+    prefetched.close()
+    assert prefetched.n_prefetched == 12
+    assert prefetched.n_direct == 0
+    assert sorted(observations.reads) == sorted(
+        (date, band) for date in dates for band in range(2))
+    assert threading.current_thread().name not in observations.threads
+
+
+class DateObservations(RecordingObservations):
+    def get_date_data(self, timestep):
+        self._record(timestep)
+        return [(timestep, band) for band in range(2)]
+
+
+def test_prefetching_whole_dates():
+    start = datetime.datetime(2017, 1, 1)
+    dates = [start + datetime.timedelta(days=i) for i in range(6)]
+    time_grid = [start + datetime.timedelta(days=i) for i in range(0, 8, 2)]
+    observations = DateObservations(dates)
+    prefetched = PrefetchingObservations(observations, time_grid=time_grid)
+    for date in dates:
+        assert prefetched.get_date_data(date) == [(date, 0), (date, 1)]
+    prefetched.close()
+    assert prefetched.n_prefetched == len(dates)
+    assert prefetched.n_direct == 0
+    assert sorted(observations.reads) == dates
+    # Readers without `get_date_data` are prefetched by band
+    prefetched = PrefetchingObservations(RecordingObservations(dates),
+                                         time_grid=time_grid)
+    assert prefetched.get_date_data(dates[0]) == [(dates[0], 0),
+                                                  (dates[0], 1)]
+    prefetched.close()
+
+
+class BarrierObservations(RecordingObservations):
+    """Each read waits (for up to `timeout` seconds) until `n_bands` reads
+    are going on at the same time, and records whether they were"""
+    def __init__(self, dates, n_bands, timeout=10.):
+        super(BarrierObservations, self).__init__(dates)
+        for date in dates:
+            self.bands_per_observation[date] = n_bands
+        self.n_bands = n_bands
+        self.timeout = timeout
+        self.overlapped = []
+        self._n_reading = 0
+        self._lock = threading.Lock()
+        self._all_reading = threading.Event()
+
+    def get_band_data(self, timestep, band):
+        with self._lock:
+            self._n_reading += 1
+            if self._n_reading == self.n_bands:
+                self._all_reading.set()
+        self.overlapped.append(self._all_reading.wait(self.timeout))
+        return super(BarrierObservations, self).get_band_data(timestep, band)
+
+
+def test_parallel_band_reads():
+    start = datetime.datetime(2017, 1, 1)
+    observations = BarrierObservations([start], 8)
+    parallel = ParallelBandObservations(observations, n_threads=8)
+    assert parallel.dates is observations.dates
+    data = parallel.get_date_data(start)
+    parallel.close()
+    # Bands come back in order, and were all read at the same time
+    assert data == [(start, band) for band in range(8)]
+    assert observations.overlapped == [True]*8
+    assert len(observations.threads) == 8
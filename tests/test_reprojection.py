@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+import os
+import sys
+
+import numpy as np
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+import kafka.input_output.reprojection as reprojection
+
+
+class ArrayBand(object):
+    DataType = 6
+
+    def __init__(self, data):
+        self.data = data
+        self.reads = []
+
+    def ReadAsArray(self, xoff=0, yoff=0, xsize=None, ysize=None):
+        self.reads.append((xoff, yoff, xsize, ysize))
+        return self.data[yoff:yoff + ysize, xoff:xoff + xsize]
+
+
+class ArrayDataset(object):
+    def __init__(self, data, geotransform):
+        self.band = ArrayBand(data)
+        self.geotransform = geotransform
+        self.RasterYSize, self.RasterXSize = data.shape
+
+    def GetGeoTransform(self):
+        return self.geotransform
+
+    def GetProjection(self):
+        return ""
+
+    def GetRasterBand(self, band):
+        return self.band
+
+    def ReadAsArray(self):
+        return self.band.data
+
+
+def _datasets():
+    # A 20 m state grid, and a 10 m source grid that covers part of it
+    state_mask = np.zeros((12, 15), dtype=np.uint8)
+    state_mask[3:8, 4:10] = 1
+    target = ArrayDataset(state_mask, [1000., 20., 0., 5000., 0., -20.])
+    source = ArrayDataset(np.arange(40*40, dtype=np.float32).reshape(40, 40),
+                          [1090., 10., 0., 4970., 0., -10.])
+    return {"mask.tif": target, "source.tif": source}
+
+
+def test_nearest_neighbour_mapping(monkeypatch):
+    datasets = _datasets()
+    monkeypatch.setattr(reprojection.gdal, "Open", datasets.get,
+                        raising=False)
+    cache = reprojection.ReprojectionCache("mask.tif")
+    state_mask = datasets["mask.tif"].band.data.astype(bool)
+    result = cache.read("source.tif")
+    # Nearest source pixel of each state pixel centre
+    rows, cols = np.nonzero(state_mask)
+    x = 1000. + (cols + 0.5)*20.
+    y = 5000. - (rows + 0.5)*20.
+    source_col = np.floor((x - 1090.)/10.).astype(int)
+    source_row = np.floor((4970. - y)/10.).astype(int)
+    inside = (source_col >= 0) & (source_row >= 0)
+    source = datasets["source.tif"].band.data
+    expected = np.where(inside, source[source_row.clip(0),
+                                       source_col.clip(0)], 0.)
+    assert np.all(result[state_mask] == expected)
+    # Only the bounding box of the state pixels is filled and read
+    assert np.all(result[~state_mask] == 0)
+    xoff, yoff, xsize, ysize = datasets["source.tif"].band.reads[0]
+    assert xsize*ysize < 10*12
+    # The mapping is reused, and windows match the full read
+    window = (slice(2, 6), slice(5, 12))
+    assert np.all(cache.read("source.tif", window=window) == result[window])
+    assert len(cache._mappings) == 1
+    # ... and only read the source pixels under the window: the state
+    # pixels in rows 3:6 and columns 5:10 map onto source rows 2*r - 2 and
+    # columns 2*c - 8
+    xoff, yoff, xsize, ysize = datasets["source.tif"].band.reads[-1]
+    assert (xoff, yoff, xsize, ysize) == (2, 4, 9, 5)
+
+
+class ShiftTransformation(object):
+    def __init__(self, target_srs, source_srs):
+        self.calls = []
+
+    def TransformPoints(self, points):
+        self.calls.append(len(points))
+        return [(x + 100., y - 50., 0.) for x, y in points]
+
+
+class FakeSpatialReference(object):
+    def ImportFromWkt(self, wkt):
+        self.wkt = wkt
+
+    def IsSame(self, other):
+        return self.wkt == other.wkt
+
+
+def test_coordinate_transform_blocks(monkeypatch):
+    transformations = []
+
+    def transformation(target_srs, source_srs):
+        transformations.append(ShiftTransformation(target_srs, source_srs))
+        return transformations[-1]
+    monkeypatch.setattr(reprojection.osr, "SpatialReference",
+                        FakeSpatialReference, raising=False)
+    monkeypatch.setattr(reprojection.osr, "CoordinateTransformation",
+                        transformation, raising=False)
+    assert reprojection._coordinate_transform("A", "A") is None
+    transform = reprojection._coordinate_transform("A", "B", block_size=7)
+    x, y = np.meshgrid(np.arange(5.), np.arange(4.))
+    x_out, y_out = transform(x, y)
+    assert x_out.shape == x.shape and y_out.shape == y.shape
+    assert np.all(x_out == x + 100.) and np.all(y_out == y - 50.)
+    assert transformations[0].calls == [7, 7, 6]
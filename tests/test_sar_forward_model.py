@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+import os
+import sys
+
+import numpy as np
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from kafka.observation_operators.sar_forward_model import \
+    sar_observation_operator, create_sar_observation_operator
+
+
+def _wcm_gradient_loop(x, theta, polarisation):
+    """The original per-pixel WCM gradient"""
+    parameters = {'VV': [0.0846, 0.0615, -14.8465, 15.907, 1.],
+                  'VH': [0.0795, 0.1464, -14.8332, 15.907, 0.]}
+    A, B, C, D, E = parameters[polarisation]
+    mu = np.cos(np.deg2rad(theta))
+    grad = x*0
+    for i in range(x.shape[0]):
+        tau_value = np.exp(-2. * B / mu[i] * x[i, 0])
+        grad[i, 0] = A * E * mu[i] * (x[i, 0] ** (E - 1.)) * (1. - tau_value) + \
+            2. * A * B * (x[i, 0] ** E) * tau_value - (
+            (2. ** (1/10. * (C + D * x[i, 1]) + 1.)) *
+            (5. ** (1/10. * (C + D * x[i, 1])) * B * tau_value)
+            ) / mu[i]
+        grad[i, 1] = D * np.log(10.) * tau_value * 10. ** (
+            1./10. * (C + D * x[i, 1]) - 1.)
+    return grad
+
+
+def test_wcm_gradient():
+    np.random.seed(42)
+    x = np.c_[np.random.rand(100)*5 + 0.1, np.random.rand(100)*0.4]
+    theta = np.random.rand(100)*20. + 25.
+    for polarisation in ["VV", "VH"]:
+        sigma_0, grad = sar_observation_operator(x, theta, polarisation)
+        assert np.allclose(grad, _wcm_gradient_loop(x, theta, polarisation))
+        # Check against finite differences
+        for i in range(2):
+            dx = np.zeros_like(x)
+            dx[:, i] = 1e-6
+            sigma_0_dx, _ = sar_observation_operator(x + dx, theta,
+                                                     polarisation)
+            assert np.allclose((sigma_0_dx - sigma_0)/1e-6, grad[:, i],
+                               rtol=1e-4, atol=1e-6)
+        sigma_0_32, grad_32 = sar_observation_operator(x, theta, polarisation,
+                                                       dtype=np.float32)
+        assert grad_32.dtype == np.float32
+        assert np.allclose(grad_32, grad, rtol=1e-4)
+
+
+def test_sar_operator_uses_incidence_angle():
+    state_mask = np.ones((4, 5), dtype=bool)
+    state_mask[0, :] = False
+    mask = np.ones((4, 5), dtype=bool)
+    mask[1, 2] = False
+    angle = np.arange(20, dtype=np.float64).reshape((4, 5)) + 25.
+    x_forecast = np.tile([1., 0.2], state_mask.sum())
+    H0, H = create_sar_observation_operator(
+        2, sar_observation_operator, {'incidence_angle': angle}, mask,
+        state_mask, x_forecast, 0)
+    pixels = np.flatnonzero(mask[state_mask])
+    expected, _ = sar_observation_operator(
+        np.tile([1., 0.2], (len(pixels), 1)), angle[state_mask][pixels], "VV")
+    assert np.allclose(H0[pixels], expected)
+    assert H0[np.flatnonzero(~mask[state_mask])] == 0
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+import os
+import sys
+
+import numpy as np
+
+import pytest
+
+import scipy.sparse as sp
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+sys.path.insert(0, myPath)
+
+from kafka.inference.block_diagonal import BlockDiagonalPrecision
+from kafka.inference.solver_context import SolverContext
+from kafka.inference import solvers
+from kafka.inference.solvers import variational_kalman_multiband
+from kf_helpers import linear_problem
+
+
+def _spd_matrix(n, seed):
+    rs = np.random.RandomState(seed)
+    A = sp.random(n, n, density=0.02, random_state=rs)
+    return (A + A.T + 5*sp.eye(n)).tocsc()
+
+
+def test_symbolic_analysis_is_reused():
+    pytest.importorskip("sksparse.cholmod")
+    context = SolverContext()
+    A = _spd_matrix(200, 1)
+    b = np.random.rand(200)
+    for scale in [1., 2., 3.]:
+        x = context.solve(scale*A, b)
+        assert np.allclose((scale*A).dot(x), b)
+    assert context.n_analyses == 1
+    assert context.n_factorisations == 3
+    # A new pattern needs a new analysis
+    A = _spd_matrix(200, 2)
+    x = context.solve(A, b)
+    assert np.allclose(A.dot(x), b)
+    assert context.n_analyses == 2
+
+
+def test_superlu_solves():
+    # SuperLU analyses every matrix
+    context = SolverContext(use_cholmod=False)
+    A = _spd_matrix(200, 1)
+    b = np.random.rand(200)
+    for scale in [1., 2., 3.]:
+        x = context.solve(scale*A, b)
+        assert np.allclose((scale*A).dot(x), b)
+    assert context.n_analyses == 3
+    assert context.n_factorisations == 3
+
+
+def test_block_matrix():
+    context = SolverContext(use_cholmod=False)
+    blocks = np.random.rand(20, 3, 3)
+    blocks = np.einsum("nij,nkj->nik", blocks, blocks) + np.eye(3)
+    A = context.block_matrix(blocks)
+    assert np.allclose(A.toarray(), BlockDiagonalPrecision(blocks).toarray())
+    b = np.random.rand(60)
+    assert np.allclose(A.dot(context.solve(A, b, block_diagonal=True)), b)
+
+
+def test_multiband_with_context():
+    (observations, masks, state_mask, uncertainties, H_matrix,
+     n_params, x_forecast, P_forecast_inv) = linear_problem()
+    expected = variational_kalman_multiband(
+        observations, masks, state_mask, uncertainties, H_matrix, n_params,
+        x_forecast, x_forecast, None, P_forecast_inv, None)
+    context = SolverContext(use_cholmod=False)
+    for i in range(2):
+        retval = variational_kalman_multiband(
+            observations, masks, state_mask, uncertainties, H_matrix,
+            n_params, x_forecast, x_forecast, None, P_forecast_inv, None,
+            context=context)
+        assert np.allclose(retval[0], expected[0], atol=1e-3)
+        assert np.allclose(retval[2].toarray(), expected[2].toarray(),
+                           rtol=1e-4, atol=1e-2)
+        assert np.allclose(retval[3], expected[3], atol=1e-3)
+
+
+def test_multiband_context_fallback(monkeypatch):
+    (observations, masks, state_mask, uncertainties, H_matrix,
+     n_params, x_forecast, P_forecast_inv) = linear_problem()
+    # A forecast precision that couples two neighbouring pixels
+    P_coupled = sp.lil_matrix(P_forecast_inv)
+    P_coupled[0, n_params] = P_coupled[n_params, 0] = 10.
+    P_coupled = P_coupled.tocsr()
+    expected = variational_kalman_multiband(
+        observations, masks, state_mask, uncertainties, H_matrix, n_params,
+        x_forecast, x_forecast, None, P_coupled, None)
+    with pytest.raises(ValueError):
+        variational_kalman_multiband(
+            observations, masks, state_mask, uncertainties, H_matrix,
+            n_params, x_forecast, x_forecast, None, P_coupled, None,
+            solver_mode="block")
+    # The context takes the general assembly
+    retval = variational_kalman_multiband(
+        observations, masks, state_mask, uncertainties, H_matrix, n_params,
+        x_forecast, x_forecast, None, P_coupled, None,
+        context=SolverContext(use_cholmod=False))
+    assert np.allclose(retval[0], expected[0], atol=1e-3)
+    assert np.allclose(retval[2].toarray(), expected[2].toarray())
+
+    # Other errors of the block solver aren't taken for a coupled problem
+    def broken_solver(*args, **kwargs):
+        raise ValueError("Broken solver")
+    monkeypatch.setattr(solvers, "_solve_multiband_blocks", broken_solver)
+    with pytest.raises(ValueError) as error:
+        variational_kalman_multiband(
+            observations, masks, state_mask, uncertainties, H_matrix,
+            n_params, x_forecast, x_forecast, None, P_forecast_inv, None,
+            context=SolverContext(use_cholmod=False))
+    assert "Broken solver" in str(error.value)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+import os
+import sys
+
+import numpy as np
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+sys.path.insert(0, myPath)
+
+from kafka.inference.solvers import variational_kalman_multiband
+from kafka.inference.state_grid import as_state_grid
+from kf_helpers import linear_problem
+
+
+def test_block_solver_matches_splu():
+    (observations, masks, state_mask, uncertainties, H_matrix,
+     n_params, x_forecast, P_forecast_inv) = linear_problem()
+    retval_splu = variational_kalman_multiband(
+        observations, masks, state_mask, uncertainties, H_matrix, n_params,
+        x_forecast, x_forecast, None, P_forecast_inv, None)
+    retval_block = variational_kalman_multiband(
+        observations, masks, state_mask, uncertainties, H_matrix, n_params,
+        x_forecast, x_forecast, None, P_forecast_inv, None,
+        solver_mode="block")
+    assert np.allclose(retval_splu[0], retval_block[0], atol=1e-3)
+    A_splu = retval_splu[2].toarray()
+    A_block = retval_block[2].toarray()
+    assert np.allclose(A_splu, A_block, rtol=1e-4, atol=1e-2)
+    assert np.allclose(retval_splu[3], retval_block[3], atol=1e-3)
+
+
+def test_compact_solve_skips_unobserved_pixels():
+    (observations, masks, state_mask, uncertainties, H_matrix,
+     n_params, x_forecast, P_forecast_inv) = linear_problem(cloud=0.8)
+    unobserved = np.repeat(~np.any([mask[state_mask] for mask in masks],
+                                   axis=0), n_params)
+    assert unobserved.any()
+    for solver_mode in ["splu", "block"]:
+        retval_full = variational_kalman_multiband(
+            observations, masks, state_mask, uncertainties, H_matrix,
+            n_params, x_forecast, x_forecast, None, P_forecast_inv, None,
+            solver_mode=solver_mode)
+        retval = variational_kalman_multiband(
+            observations, masks, state_mask, uncertainties, H_matrix,
+            n_params, x_forecast, x_forecast, None, P_forecast_inv, None,
+            solver_mode=solver_mode, compact=True)
+        assert np.allclose(retval[0], retval_full[0], atol=1e-4)
+        assert np.allclose(retval[0][unobserved], x_forecast[unobserved])
+        assert np.allclose(retval[2].toarray(), retval_full[2].toarray())
+        assert np.allclose(retval[3], retval_full[3], atol=1e-4)
+
+
+def test_damping_pulls_towards_anchor():
+    (observations, masks, state_mask, uncertainties, H_matrix,
+     n_params, x_forecast, P_forecast_inv) = linear_problem(cloud=0.)
+    n_pixels = state_mask.sum()
+    x_anchor = x_forecast + 0.1
+    for solver_mode in ["splu", "block"]:
+        retval = variational_kalman_multiband(
+            observations, masks, state_mask, uncertainties, H_matrix,
+            n_params, x_forecast, x_forecast, None, P_forecast_inv, None,
+            solver_mode=solver_mode)
+        retval_zero = variational_kalman_multiband(
+            observations, masks, state_mask, uncertainties, H_matrix,
+            n_params, x_forecast, x_forecast, None, P_forecast_inv, None,
+            solver_mode=solver_mode, damping=np.zeros(n_pixels),
+            x_anchor=x_anchor)
+        assert np.allclose(retval_zero[0], retval[0], atol=1e-5)
+        damping = np.zeros(n_pixels)
+        damping[::2] = 1e4
+        retval_damped = variational_kalman_multiband(
+            observations, masks, state_mask, uncertainties, H_matrix,
+            n_params, x_forecast, x_forecast, None, P_forecast_inv, None,
+            solver_mode=solver_mode, damping=damping, x_anchor=x_anchor)
+        x = retval_damped[0].reshape((n_pixels, n_params))
+        assert np.allclose(x[::2], x_anchor.reshape((n_pixels,
+                                                     n_params))[::2],
+                           atol=1e-3)
+        assert np.allclose(x[1::2], retval[0].reshape(
+            (n_pixels, n_params))[1::2], atol=1e-5)
+        # The Hessian is the undamped one
+        assert np.allclose(retval_damped[2].toarray(), retval[2].toarray())
+
+
+def test_uncertainty_forms():
+    (observations, masks, state_mask, uncertainties, H_matrix,
+     n_params, x_forecast, P_forecast_inv) = linear_problem()
+    # The same inverse variances as state pixel vectors (with zeros for
+    # masked pixels) and as images, rather than diagonal N x N matrices
+    state_grid = as_state_grid(state_mask)
+    vectors = [np.where(state_grid.gather(mask),
+                        state_grid.gather(R.diagonal()), 0.).astype(
+                            np.float32)
+               for R, mask in zip(uncertainties, masks)]
+    images = [state_grid.scatter(vector) for vector in vectors]
+    for solver_mode in ["splu", "block"]:
+        expected = variational_kalman_multiband(
+            observations, masks, state_mask, uncertainties, H_matrix,
+            n_params, x_forecast, x_forecast, None, P_forecast_inv, None,
+            solver_mode=solver_mode)
+        for R in [vectors, images]:
+            retval = variational_kalman_multiband(
+                observations, masks, state_mask, R, H_matrix, n_params,
+                x_forecast, x_forecast, None, P_forecast_inv, None,
+                solver_mode=solver_mode)
+            assert np.all(retval[0] == expected[0])
+            assert np.all(retval[2].toarray() == expected[2].toarray())
+            assert np.all(retval[3] == expected[3])
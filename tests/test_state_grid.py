@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+import os
+import sys
+
+import numpy as np
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from kafka.inference.state_grid import StateGrid, as_state_grid
+
+
+def _state_mask():
+    state_mask = np.zeros((8, 10), dtype=bool)
+    state_mask[2:6, 3:9] = True
+    state_mask[3, 4] = False
+    return state_mask
+
+
+def test_gather_scatter():
+    state_mask = _state_mask()
+    grid = StateGrid(state_mask)
+    assert grid.n_pixels == state_mask.sum()
+    assert grid.window == (slice(2, 6), slice(3, 9))
+    image = np.random.rand(3, *state_mask.shape)
+    assert np.all(grid.gather(image[0]) == image[0][state_mask])
+    assert np.all(grid.gather(image[0].ravel()) == image[0][state_mask])
+    assert np.all(grid.gather(image[0][grid.window]) ==
+                  image[0][state_mask])
+    assert np.all(grid.gather(image) == image[:, state_mask])
+    values = grid.gather(image[1])
+    assert np.all(grid.scatter(values) ==
+                  np.where(state_mask, image[1], 0.))
+    assert np.all(grid.scatter(values, window=True) ==
+                  np.where(state_mask, image[1], 0.)[grid.window])
+    x = np.arange(grid.n_pixels*7.)
+    assert np.all(grid.parameter(x, 7, 6) == x.reshape((-1, 7))[:, 6])
+
+
+def test_used_as_state_mask():
+    state_mask = _state_mask()
+    grid = as_state_grid(state_mask)
+    assert as_state_grid(grid) is grid
+    image = np.random.rand(*state_mask.shape)
+    assert np.all(image[grid] == image[state_mask])
+    assert grid.sum() == state_mask.sum()
+    assert grid.shape == state_mask.shape
+    assert np.all(grid.flatten() == state_mask.flatten())
+    assert np.all(np.nonzero(grid)[0] == np.nonzero(state_mask)[0])
+    # The grid keeps its own copy of the mask
+    state_mask[0, 0] = True
+    assert not grid.mask[0, 0]
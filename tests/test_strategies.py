@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+import os
+import sys
+
+import numpy as np
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from kafka.inference.strategies import LevenbergMarquardt, LineSearch, \
+    get_strategy
+
+PRIOR = 1e-4
+
+
+def _atan_cost(x, x_forecast):
+    """The cost of each pixel of a one parameter problem, with a zero
+    observation of `arctan(x)` and a weak prior around `x_forecast`"""
+    return 0.5*np.arctan(x)**2 + 0.5*PRIOR*(x - x_forecast)**2
+
+
+def _minimise(strategy, x_forecast, n_iterations=25, tolerance=1e-6):
+    """Minimises `_atan_cost` with `strategy`, calling it as
+    `LinearKalman.do_all_bands` does. Returns the final point, its cost, and
+    the number of iterations each pixel took to converge. The lowest cost
+    the strategy evaluated is kept in `strategy.cost_seen`."""
+    strategy.reset(x_forecast, 1)
+    active = np.ones(len(x_forecast), dtype=bool)
+    converged = np.zeros(len(x_forecast), dtype=bool)
+    iterations = np.zeros(len(x_forecast), dtype=np.int32)
+    x = x_forecast.copy()
+    strategy.cost_seen = np.full(len(x_forecast), np.inf)
+    for i in range(n_iterations):
+        if strategy.needs_cost:
+            cost = _atan_cost(x, x_forecast)
+            strategy.cost_seen = np.minimum(strategy.cost_seen, cost)
+            strategy.evaluate(x, cost, active)
+        damping, x_anchor = strategy.damping()
+        # The linearised problem, and its (damped) solution
+        jac = 1./(1. + x**2)
+        A = jac**2 + PRIOR
+        b = jac*(jac*x - np.arctan(x)) + PRIOR*x_forecast
+        if damping is not None:
+            b = b + damping*A*x_anchor
+            A = A*(1. + damping)
+        x_next = strategy.next_point(x, b/A, active)
+        iterations[~converged] += 1
+        converged |= np.abs(x_next - x) < tolerance
+        x = x_next
+    x = strategy.final_point(x)
+    return x, _atan_cost(x, x_forecast), iterations
+
+
+def test_strategies_stop_overshooting():
+    # Gauss-Newton converges from 0.5, but overshoots further and further
+    # from 1.5
+    x_forecast = np.array([0.5, 1.5])
+    x_gn, cost_gn, iterations_gn = _minimise(get_strategy("gauss-newton"),
+                                             x_forecast)
+    assert iterations_gn[1] == 25
+    assert np.abs(x_gn[1]) > 1.5
+    # arctan(x) = x to within 1e-12 around the minimum
+    x_minimum = x_forecast*PRIOR/(1. + PRIOR)
+    for name in ["levenberg-marquardt", "line-search"]:
+        strategy = get_strategy(name)
+        x, cost, iterations = _minimise(strategy, x_forecast)
+        assert iterations[1] < 25
+        assert cost[1] < 1e-3*cost_gn[1]
+        assert np.all(cost <= strategy.cost_seen)
+        assert np.allclose(x, x_minimum, rtol=1e-6, atol=0.)
+        # Stopped early, they don't end on a step that made things worse
+        x, cost, iterations = _minimise(strategy, x_forecast,
+                                        n_iterations=5)
+        assert np.all(cost <= strategy.cost_seen)
+        # Pixels where Gauss-Newton behaves take its steps
+        assert iterations[0] == iterations_gn[0]
+        assert x[0] == x_gn[0]
+
+
+def test_levenberg_marquardt_damping():
+    strategy = LevenbergMarquardt(initial_damping=1., increase=10.,
+                                  decrease=10., min_damping=0.1,
+                                  max_damping=50.)
+    strategy.reset(np.zeros(6), 2)
+    assert strategy.damping() == (None, None)
+    active = np.array([True, True, False])
+    x1 = np.arange(6.)
+    strategy.evaluate(x1, np.array([1., 1., 1.]), active)
+    assert strategy.damping() == (None, None)
+    # A worse step damps the pixel, and its best point stays; equal costs
+    # count as better, and inactive pixels are left alone
+    strategy.evaluate(x1 + 1., np.array([1., 2., 0.]), active)
+    lambdas, x_best = strategy.damping()
+    assert np.all(lambdas == [0., 1., 0.])
+    assert np.all(x_best == [1., 2., 2., 3., 0., 0.])
+    assert np.all(strategy.final_point(x1 + 1.) == [1., 2., 2., 3., 5., 6.])
+    for expected in [10., 50., 50.]:
+        strategy.evaluate(x1, np.array([1., 3., 0.]), active)
+        assert strategy.damping()[0][1] == expected
+    # Better steps undamp it, down to nothing below `min_damping`
+    for expected in [5., 0.5]:
+        strategy.evaluate(x1, np.array([1., 0.5, 0.]), active)
+        assert strategy.damping()[0][1] == expected
+    strategy.evaluate(x1, np.array([1., 0.4, 0.]), active)
+    assert strategy.damping() == (None, None)
+
+
+def test_line_search_steps():
+    strategy = LineSearch(min_step=0.25)
+    strategy.reset(np.zeros(4), 2)
+    active = np.ones(2, dtype=bool)
+    x = np.zeros(4)
+    strategy.evaluate(x, np.array([1., 1.]), active)
+    x = strategy.next_point(x, np.array([2., 2., 4., 4.]), active)
+    assert np.all(x == [2., 2., 4., 4.])
+    # The second pixel got worse, so its step is halved
+    strategy.evaluate(x, np.array([0.5, 2.]), active)
+    # Stopping now would go back to its best point
+    assert np.all(strategy.final_point(x) == [2., 2., 0., 0.])
+    x = strategy.next_point(x, np.array([3., 3., 9., 9.]), active)
+    assert np.all(x == [3., 3., 2., 2.])
+    strategy.evaluate(x, np.array([0.4, 2.]), active)
+    x = strategy.next_point(x, np.array([3., 3., 9., 9.]), active)
+    assert np.all(x == [3., 3., 1., 1.])
+    # Below `min_step`, it gives up and stays at its best point
+    strategy.evaluate(x, np.array([0.4, 2.]), active)
+    x = strategy.next_point(x, np.array([3., 3., 9., 9.]), active)
+    assert np.all(x == [3., 3., 0., 0.])
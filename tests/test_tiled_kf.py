@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+import os
+import pickle
+import sys
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy as np
+
+import pytest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+sys.path.insert(0, myPath)
+
+import kafka.tiled_kf as tiled_kf
+from kafka.linear_kf import LinearKalman
+from kafka.tiled_kf import TiledKalman, define_chunks
+from kf_helpers import FakeDateObservations, FailingObservations, \
+    WindowOutput, kf_state_mask, run_kf
+
+
+def test_define_chunks():
+    state_mask = np.zeros((10, 10), dtype=bool)
+    state_mask[1:9, 2:7] = True
+    chunks = define_chunks(state_mask, chunk_size=(3, 4))
+    pixels = np.concatenate([chunk.pixels for chunk in chunks])
+    assert np.all(np.sort(pixels) == np.arange(state_mask.sum()))
+    for chunk in chunks:
+        assert np.all(chunk.state_mask == state_mask[chunk.window])
+
+
+def test_tiled_matches_untiled():
+    expected = run_kf(LinearKalman)
+    # A single chunk is the same problem
+    result = run_kf(TiledKalman, chunk_size=100, n_workers=1)
+    for timestep in expected:
+        assert np.all(result[timestep][0] == expected[timestep][0])
+    # Smaller chunks only differ in when the iterations stop
+    serial = run_kf(TiledKalman, chunk_size=(3, 4), n_workers=1)
+    parallel = run_kf(TiledKalman, chunk_size=(3, 4), n_workers=2)
+    assert sorted(parallel) == sorted(expected)
+    for timestep in expected:
+        assert np.all(parallel[timestep][0] == serial[timestep][0])
+        assert np.all(parallel[timestep][1] == serial[timestep][1])
+        assert np.allclose(parallel[timestep][0], expected[timestep][0],
+                           atol=0.1)
+
+
+def test_tile_seams():
+    # Pixels are independent, so when each of them stops on its own the
+    # chunks give the untiled analysis exactly, on both sides of the seams
+    state_mask = kf_state_mask()
+    expected = run_kf(LinearKalman, per_pixel_convergence=True)
+    for chunk_size in [(3, 4), (5, 2), (1, 100)]:
+        result = run_kf(TiledKalman, chunk_size=chunk_size, n_workers=1,
+                        per_pixel_convergence=True)
+        seams = np.zeros(state_mask.shape, dtype=bool)
+        for chunk in define_chunks(state_mask, chunk_size=chunk_size):
+            rows, cols = chunk.window
+            seams[rows.start, cols] = seams[rows.stop - 1, cols] = True
+            seams[rows, cols.start] = seams[rows, cols.stop - 1] = True
+        seams = np.repeat(seams[state_mask], 7)
+        assert seams.any()
+        for timestep in expected:
+            for field in range(2):
+                assert np.all(result[timestep][field][seams] ==
+                              expected[timestep][field][seams])
+                assert np.all(result[timestep][field] ==
+                              expected[timestep][field])
+
+
+def test_compact_uncertainties():
+    # Pixels stop on their own, so that chunks don't change the answer
+    expected = run_kf(LinearKalman, per_pixel_convergence=True)
+    for kf_class, kwargs in [(LinearKalman, {}),
+                             (TiledKalman, dict(chunk_size=(3, 4),
+                                                n_workers=1))]:
+        result = run_kf(kf_class, compact=True, per_pixel_convergence=True,
+                        **kwargs)
+        # Inverse variance vectors give the same analyses as N x N matrices
+        for timestep in expected:
+            for field in range(2):
+                assert np.all(result[timestep][field] ==
+                              expected[timestep][field])
+
+
+class CountingDateObservations(FakeDateObservations):
+    """Records the dates and bands read"""
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        super(CountingDateObservations, self).__init__(*args, **kwargs)
+        self.date_reads = []
+        self.band_reads = []
+        CountingDateObservations.instances.append(self)
+
+    def get_date_data(self, timestep):
+        self.date_reads.append(timestep)
+        return super(CountingDateObservations, self).get_date_data(timestep)
+
+    def get_band_data(self, timestep, band):
+        self.band_reads.append((timestep, band))
+        return super(CountingDateObservations, self).get_band_data(timestep,
+                                                                   band)
+
+
+def test_date_reads():
+    # Pixels stop on their own, so that chunks don't change the answer
+    expected = run_kf(LinearKalman, per_pixel_convergence=True)
+    n_chunks = len(define_chunks(kf_state_mask(), chunk_size=(3, 4)))
+    for kf_class, kwargs, n_reads in [
+            (LinearKalman, {}, 1),
+            (TiledKalman, dict(chunk_size=(3, 4), n_workers=1), n_chunks)]:
+        result = run_kf(kf_class, observations_class=CountingDateObservations,
+                        per_pixel_convergence=True, **kwargs)
+        for timestep in expected:
+            for field in range(2):
+                assert np.all(result[timestep][field] ==
+                              expected[timestep][field])
+        # Each date is read with a single call (per chunk), and no band is
+        # read on its own
+        observations = CountingDateObservations.instances[-1]
+        dates = observations.dates
+        assert sorted(observations.date_reads) == sorted(dates*n_reads)
+        assert observations.band_reads == []
+
+def test_windowed_output():
+    expected = run_kf(TiledKalman, chunk_size=(3, 4), n_workers=1)
+    for n_workers in [1, 2]:
+        output = run_kf(TiledKalman, chunk_size=(3, 4), n_workers=n_workers,
+                        output_class=WindowOutput)
+        state_mask = kf_state_mask()
+        n_chunks = len(define_chunks(state_mask, chunk_size=(3, 4)))
+        # Each chunk is written on its own, and the first one creates the
+        # files of its timestep
+        assert len(output.calls) == n_chunks*len(expected)
+        for timestep in expected:
+            creates = [create for t, create in output.calls
+                       if t == timestep]
+            assert creates == [True] + [False]*(n_chunks - 1)
+            full = np.zeros((state_mask.size, 7), dtype=bool)
+            full[state_mask.ravel()] = True
+            full = full.ravel()
+            assert np.all(output.output[timestep][0][full] ==
+                          expected[timestep][0])
+            assert np.all(output.output[timestep][1][full] ==
+                          expected[timestep][1])
+
+
+def test_worker_errors():
+    # Errors in the workers reach the caller, and nothing hangs
+    with pytest.raises(IOError):
+        run_kf(TiledKalman, chunk_size=(3, 4), n_workers=2, max_queue=1,
+               observations_class=FailingObservations)
+
+
+class RecordingTiledKalman(TiledKalman):
+    """Keeps a reference to the filter"""
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingTiledKalman, self).__init__(*args, **kwargs)
+        RecordingTiledKalman.instances.append(self)
+
+
+def test_pickled_workers(monkeypatch):
+    # Workers only get what they're given when they start (as with the
+    # spawn and forkserver start methods): the pickled filter, without its
+    # output, and the results queue
+    expected = run_kf(RecordingTiledKalman, chunk_size=(3, 4), n_workers=1)
+    kf = pickle.loads(pickle.dumps(RecordingTiledKalman.instances[-1], -1))
+    assert not hasattr(kf, "output")
+    results = queue.Queue()
+    monkeypatch.setattr(tiled_kf, "_WORKER", None)
+    tiled_kf._init_worker(kf, results)
+    for i_chunk, chunk in enumerate(kf.chunks):
+        assert tiled_kf._run_chunk(i_chunk) == i_chunk
+        for timestep in sorted(expected):
+            message = results.get_nowait()
+            assert message[:2] == (i_chunk, timestep)
+            x = expected[timestep][0].reshape((-1, kf.n_params))
+            assert np.all(message[2] == x[chunk.pixels].ravel())
+        assert results.get_nowait() == (i_chunk, None, None, None, None)
+    assert results.empty()
+
+
+class ScratchTiledKalman(TiledKalman):
+    """Checks that the timesteps waiting for chunks are kept on disk"""
+    max_pending = 0
+
+    def _stitch(self, message):
+        super(ScratchTiledKalman, self)._stitch(message)
+        for state in self._stitched.values():
+            assert all(isinstance(array, np.memmap) for array in state[:3]
+                       if array is not None)
+        ScratchTiledKalman.max_pending = max(ScratchTiledKalman.max_pending,
+                                             len(self._stitched))
+
+
+def test_stitch_scratch_files(tmpdir):
+    expected = run_kf(LinearKalman, per_pixel_convergence=True)
+    result = run_kf(ScratchTiledKalman, chunk_size=(3, 4), n_workers=1,
+                    scratch_dir=str(tmpdir), per_pixel_convergence=True)
+    # Chunks run one after the other, so all the timesteps wait for the
+    # last chunk
+    assert ScratchTiledKalman.max_pending == len(expected)
+    assert tmpdir.listdir() == []
+    for timestep in expected:
+        for field in range(2):
+            assert np.all(result[timestep][field] ==
+                          expected[timestep][field])
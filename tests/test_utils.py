@@ -7,12 +7,19 @@ from distutils import dir_util
 
 import numpy as np
 
+import scipy.sparse as sp
+
 from pytest import fixture
 
 myPath = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, myPath + '/../')
 
-from kafka.utils import iterate_time_grid
+from kafka.inference.utils import iterate_time_grid
+from kafka.inference.utils import gather_state_pixels, create_pixel_jacobian
+from kafka.inference.utils import run_emulator, emulate_clustered
+from kafka.inference.utils import quantise_lut, kmeans_lut, locate_in_lut
+from kafka.inference.utils import inverse_variance, inverse_variance_vector
+from kafka.inference.emulator_cache import EmulatorCache
 
 
 def test_iterate_time_grid():
@@ -36,3 +43,178 @@ def test_iterate_time_grid():
     for i, retval in enumerate(iterate_time_grid(time_grid, the_dates)):
         assert timesteps_good[i] == retval[0]
         assert np.all(obs_times[i] == retval[1])
+
+
+def test_create_pixel_jacobian():
+    n_params = 7
+    state_mapper = np.array([3, 4, 6, 5])
+    x_forecast = np.arange(5*n_params, dtype=np.float32)
+    pixels = np.array([0, 2, 3])
+    x0 = gather_state_pixels(x_forecast, n_params, pixels, state_mapper)
+    assert np.all(x0[1] == x_forecast[2*n_params + state_mapper])
+    dH = np.random.rand(len(pixels), len(state_mapper))
+    H_matrix = create_pixel_jacobian(dH, pixels, 5, n_params, state_mapper)
+    H_loop = sp.lil_matrix((5, 5*n_params), dtype=np.float32)
+    for n, i in enumerate(pixels):
+        H_loop[i, state_mapper + n_params*i] = dH[n]
+    assert H_matrix.shape == H_loop.shape
+    assert np.allclose(H_matrix.toarray(), H_loop.toarray())
+
+
+class LinearEmulator(object):
+    """A dummy emulator that records how many vectors it has seen"""
+    def __init__(self, weights):
+        self.weights = weights
+        self.n_evaluations = 0
+
+    def predict(self, x, do_unc=False):
+        self.n_evaluations += x.shape[0]
+        return x.dot(self.weights), np.tile(self.weights, (x.shape[0], 1))
+
+
+def test_run_emulator_unique():
+    gp = LinearEmulator(np.array([1., 2., 3.]))
+    x = np.array([[0., 0., 1.], [1., 0., 0.], [0., 0., 1.], [1., 0., 0.]])
+    H, dH = run_emulator(gp, x)
+    assert gp.n_evaluations == 2
+    assert np.allclose(H, [3., 1., 3., 1.])
+    assert dH.shape == x.shape
+
+
+class SineEmulator(object):
+    """A dummy emulator with curvature, so that LUT entries are off"""
+    def __init__(self):
+        self.n_evaluations = 0
+
+    def predict(self, x, do_unc=False):
+        self.n_evaluations += x.shape[0]
+        return np.sin(x).sum(axis=1), np.cos(x)
+
+
+def test_run_emulator_repeated_rows():
+    # Many rows, but few unique ones: no LUT
+    gp = LinearEmulator(np.array([1., 2., 3.]))
+    x = np.tile(np.eye(3), (1000, 1))
+    H, dH, max_error = run_emulator(gp, x, max_unique=100,
+                                    return_error=True)
+    assert gp.n_evaluations == 3
+    assert max_error == 0.
+    assert np.allclose(H, x.dot(gp.weights))
+
+
+def test_locate_in_lut():
+    np.random.seed(1)
+    lut = np.random.rand(50, 3)
+    im = np.random.rand(500, 3)
+    distances = ((im[:, None, :] - lut[None, :, :])**2).sum(axis=-1)
+    assert np.all(locate_in_lut(lut, im) == distances.argmin(axis=1))
+
+
+def test_quantise_lut():
+    np.random.seed(2)
+    x = np.random.rand(5000, 3)
+    lut, labels = quantise_lut(x, 200)
+    assert len(lut) <= 200
+    assert labels.shape == (5000,)
+    # Every entry is the mean of its rows
+    for entry in [0, len(lut)//2, len(lut) - 1]:
+        assert np.allclose(lut[entry], x[labels == entry].mean(axis=0))
+
+
+def test_kmeans_lut():
+    np.random.seed(3)
+    x = np.random.rand(5000, 3)
+    lut, labels = kmeans_lut(x, 100, n_sample=1000)
+    assert len(lut) == 100
+    assert np.all(labels == locate_in_lut(lut, x))
+
+
+def test_emulate_clustered():
+    np.random.seed(4)
+    x = np.random.rand(50000, 3)
+    direct, direct_grad = SineEmulator().predict(x)
+    gp = SineEmulator()
+    H, dH, max_error = run_emulator(gp, x, tol=2e-2, max_unique=1000,
+                                    lut_size=3000, return_error=True)
+    # Not every row is emulated, and the tolerance is met
+    assert gp.n_evaluations < x.shape[0]
+    assert 0 < max_error <= 2e-2
+    assert np.abs(H - direct).max() <= 2e-2
+    exact = H == direct
+    assert np.all(dH[exact] == direct_grad[exact])
+    # Without a tolerance, the error is reported
+    H, dH, max_error = emulate_clustered(SineEmulator(), x, lut_size=300)
+    assert max_error > 2e-2
+    assert np.abs(H - direct).max() <= max_error
+    # If the tolerance can't be met in time, every row is emulated exactly
+    H, dH, max_error = emulate_clustered(SineEmulator(), x, tol=1e-3,
+                                         lut_size=300, max_rounds=1)
+    assert max_error == 0.
+    assert np.all(H == direct) and np.all(dH == direct_grad)
+
+
+def test_emulator_cache():
+    gp = LinearEmulator(np.array([1., 2., 3.]))
+    cache = EmulatorCache(max_entries=3)
+    x = np.array([[0., 0., 1.], [1., 0., 0.]])
+    H, dH = run_emulator(cache.wrap(gp), x)
+    H, dH = run_emulator(cache.wrap(gp), x)
+    assert np.allclose(H, [3., 1.])
+    assert gp.n_evaluations == 2
+    assert cache.hits == 2 and cache.misses == 2
+    # Older entries get evicted
+    run_emulator(cache.wrap(gp), np.eye(3))
+    assert len(cache) == 3
+    # Emulators given the same key share their entries
+    cache = EmulatorCache()
+    run_emulator(cache.wrap(gp, key="gp"), x)
+    copy = LinearEmulator(gp.weights)
+    H, dH = run_emulator(cache.wrap(copy, key="gp"), x)
+    assert copy.n_evaluations == 0
+    assert np.allclose(H, [3., 1.])
+
+
+def test_emulator_cache_eviction():
+    cache = EmulatorCache(max_entries=4)
+    old_gp = LinearEmulator(np.array([1., 2., 3.]))
+    gp = LinearEmulator(np.array([3., 2., 1.]))
+    x = np.random.rand(3, 3)
+    cache.predict(old_gp, x)
+    cache.predict(gp, x[:2])
+    # Using an entry makes it the most recent one
+    cache.predict(old_gp, x[:1])
+    H, dH = cache.predict(gp, np.eye(3))
+    assert np.allclose(H, [3., 2., 1.])
+    assert len(cache) == 4
+    # The recently used entries are the ones left
+    n_evaluations = old_gp.n_evaluations
+    cache.predict(old_gp, x[:1])
+    assert old_gp.n_evaluations == n_evaluations
+    # Emulators without entries aren't kept alive
+    cache.predict(gp, np.random.rand(4, 3))
+    assert all(entries.emulator is gp
+               for entries in cache._entries.values())
+    # Duplicated rows are looked up once, and counted per row
+    cache = EmulatorCache()
+    H, dH = cache.predict(gp, np.vstack([x, x]))
+    assert gp.n_evaluations == 2 + 3 + 4 + 3
+    assert cache.misses == 6 and cache.hits == 0
+    assert np.allclose(H, np.vstack([x, x]).dot(gp.weights))
+
+
+def test_inverse_variance_vector():
+    state_mask = np.zeros((4, 5), dtype=bool)
+    state_mask[1:3, 1:4] = True
+    mask = np.ones_like(state_mask)
+    mask[1, 2] = False
+    sigma = np.random.rand(*state_mask.shape) + 0.5
+    expected = np.where(mask, 1./sigma**2, 0.)[state_mask]
+    compact = inverse_variance(sigma, mask, state_mask)
+    assert compact.dtype == np.float32
+    assert compact[1] == 0.
+    image = inverse_variance(sigma, mask)
+    full = sp.diags(image.ravel(), format="csr")
+    for uncertainty in [compact, image, image.ravel(), full]:
+        r = inverse_variance_vector(uncertainty, state_mask)
+        assert r.dtype == np.float32
+        assert np.allclose(r, expected)